@@ -1,8 +1,207 @@
 from Graph import *
+from clustering import group_indices, kmeans_1d, optimal_kmeans_1d, quantile_bins, kmeans
 from collections import Counter
 from statistics import mean
 from random import uniform
 import numpy as np
+import time
+
+
+def sequence_ids(init_ids, owner, pos, elem):
+    """
+    Give each owner a new id that identifies its old id together with its sequence of elements.
+
+    Args:
+        init_ids: An integer array of the old id of each owner.
+        owner: An integer array of the owner of each element.
+        pos: An integer array of the position of each element in the sequence of its owner, from 0 and without gaps.
+        elem: A non-negative integer array of the elements.
+
+    Returns: An integer array of the new ids, renumbered from 0 and in the order of (old id, sequence).
+    """
+    ids = np.asarray(init_ids, dtype=np.int64).copy()
+    size = int(ids.max()) + 1 if len(ids) else 0
+
+    # extend the ids by one position at a time, the new ids never collide with the ids of the finished sequences
+    order = np.argsort(pos, kind='stable')
+    ptr = np.searchsorted(pos[order], np.arange(int(pos.max()) + 2 if len(pos) else 1))
+    for k in range(len(ptr) - 1):
+        items = order[ptr[k]:ptr[k + 1]]
+        o = owner[items]
+        unique, inv = np.unique(combine_codes([ids[o], elem[items]], [size, int(elem.max()) + 1]), return_inverse=True)
+        ids[o] = size + inv.reshape(-1)
+        size += len(unique)
+
+    _, res = np.unique(ids, return_inverse=True)
+    return res.reshape(-1)
+
+
+def canonical_rows(rows, potential):
+    """
+    Sort the entries of each argument symmetry group of the potential (see Function.symmetry), so the rows that are
+    equal up to the permutations of the groups become equal.
+
+    Args:
+        rows: An array whose last axis is the arguments of the potential.
+        potential: The potential.
+
+    Returns: The canonical rows, as a new array.
+    """
+    rows = np.array(rows)
+    for group in getattr(potential, 'symmetry', None) or ():
+        group = sorted(group)
+        rows[..., group] = np.sort(rows[..., group], axis=-1)
+    return rows
+
+
+def canonical_nb(nb, potential):
+    """
+    Sort the entries of each argument symmetry group of the potential in a sequence of neighbors, the same as
+    canonical_rows, e.g. for the clusters of the neighbors of a factor.
+
+    Args:
+        nb: An iterable of comparable objects, one for each argument of the potential.
+        potential: The potential.
+
+    Returns: The canonical neighbors, as a tuple.
+    """
+    nb = list(nb)
+    for group in getattr(potential, 'symmetry', None) or ():
+        group = sorted(group)
+        for idx, item in zip(group, sorted(nb[idx] for idx in group)):
+            nb[idx] = item
+    return tuple(nb)
+
+
+def edge_groups(factors, edge_f, edge_pos):
+    """
+    Args:
+        factors: A list of factors.
+        edge_f: An integer array of the factor of each edge.
+        edge_pos: An integer array of the position of the rv of each edge in its factor.
+
+    Returns: An integer array of the argument symmetry group of each edge, a group is identified by its smallest
+             position, or None if no potential declares symmetry.
+    """
+    potential_idx = dict()
+    factor_potential = np.fromiter(
+        (potential_idx.setdefault(f.potential, len(potential_idx)) for f in factors),
+        dtype=np.int64, count=len(factors)
+    )
+    if all(getattr(p, 'symmetry', None) is None for p in potential_idx):
+        return None
+
+    table = np.tile(np.arange(int(np.max(edge_pos, initial=0)) + 1), (len(potential_idx), 1))
+    for p, idx in potential_idx.items():
+        for group in getattr(p, 'symmetry', None) or ():
+            table[idx, list(group)] = min(group)
+
+    return table[factor_potential[edge_f], edge_pos]
+
+
+def canonical_pos(edge_f, edge_pos, edge_group, elem):
+    """
+    Reassign the positions of the edges of each argument symmetry group of a factor in the order of their elements,
+    i.e. the smallest element takes the first position of the group, so the factors whose sequences of elements are
+    equal up to the permutations of the groups get the same sequence.
+
+    Args:
+        edge_f: An integer array of the factor of each edge.
+        edge_pos: An integer array of the position of the rv of each edge in its factor.
+        edge_group: An integer array of the symmetry group of each edge, see edge_groups.
+        elem: An integer array of the element of each edge.
+
+    Returns: An integer array of the canonical position of each edge.
+    """
+    by_elem = np.lexsort((elem, edge_group, edge_f))
+    by_pos = np.lexsort((edge_pos, edge_group, edge_f))
+    pos = np.empty_like(edge_pos)
+    pos[by_elem] = edge_pos[by_pos]
+    return pos
+
+
+def refine_colors(rv_color, factor_color, edge_f, edge_rv, edge_pos, hidden, max_rounds=None, min_ratio=None,
+                  stats=None, edge_group=None, edge_weight=None):
+    """
+    Color passing on integer arrays, with the same splitting rules of CompressedGraph.refine: the factors are split by
+    the ordered colors of their neighbors, the hidden rvs are split by the multiset of the colors of their neighboring
+    factors, and the observed rvs are never split. It stops when the number of rv colors does not change.
+
+    Args:
+        rv_color: An integer array of the initial color of each rv.
+        factor_color: An integer array of the initial color of each factor.
+        edge_f: An integer array of the factor of each edge.
+        edge_rv: An integer array of the rv of each edge.
+        edge_pos: An integer array of the position of the rv of each edge in its factor.
+        hidden: A boolean array indicating if each rv is hidden.
+        max_rounds: The maximum number of rounds, a round splits the factors and then the rvs.
+        min_ratio: Stop after the round in which the number of rvs per rv color drops below this value.
+        stats: An optional list, a record {'round', 'rvs', 'factors', 'time'} of the number of colors and the elapsed
+               time is appended after the initialization and after each round.
+        edge_group: An optional integer array of the argument symmetry group of each edge (see edge_groups), then the
+                    factors are split by the colors of their neighbors up to the permutations of the groups.
+        edge_weight: An optional integer array of the number of edges that each edge stands for on the side of its rv,
+                     e.g. on a quotient graph whose nodes are classes of interchangeable rvs and factors. By default,
+                     every edge counts once.
+
+    Returns: The final color arrays of the rvs and the factors, and a boolean value indicating if the colors are stable.
+             If the refinement is stopped early, the factors are split by the final rv colors, so only the rvs of the
+             same color may have different neighbors.
+    """
+    start_time = time.time()
+
+    _, rv_color = np.unique(rv_color, return_inverse=True)
+    _, factor_color = np.unique(factor_color, return_inverse=True)
+    rv_color, factor_color = rv_color.reshape(-1), factor_color.reshape(-1)
+
+    # the edges of hidden rvs, with repeated factor colors merged into (color, count) pairs when computing signatures
+    hidden_edge = np.flatnonzero(hidden[edge_rv])
+    rv_of_edge, f_of_edge = edge_rv[hidden_edge], edge_f[hidden_edge]
+    weight_of_edge = None if edge_weight is None else np.asarray(edge_weight, dtype=np.int64)[hidden_edge]
+
+    def split_factors(factor_color):
+        elem = rv_color[edge_rv]
+        pos = edge_pos if edge_group is None else canonical_pos(edge_f, edge_pos, edge_group, elem)
+        return sequence_ids(factor_color, edge_f, pos, elem)
+
+    num_colors = np.max(rv_color, initial=-1) + 1
+    if stats is not None:
+        stats.append({'round': 0, 'rvs': num_colors, 'factors': np.max(factor_color, initial=-1) + 1,
+                      'time': time.time() - start_time})
+
+    prev_num_colors, rounds = -1, 0
+    while prev_num_colors != num_colors:
+        if max_rounds is not None and rounds >= max_rounds or \
+                min_ratio is not None and len(rv_color) < min_ratio * num_colors:
+            # split the factors by the final rv colors, it does not change the factors if the colors are stable
+            factor_color = split_factors(factor_color)
+            return rv_color, factor_color, False
+
+        prev_num_colors = num_colors
+        rounds += 1
+
+        # split factors
+        factor_color = split_factors(factor_color)
+
+        # split hidden rvs
+        num_f_colors = np.max(factor_color, initial=0) + 1
+        pair, inv, count = np.unique(
+            rv_of_edge * num_f_colors + factor_color[f_of_edge], return_inverse=True, return_counts=True
+        )
+        if weight_of_edge is not None:
+            count = np.zeros(len(pair), dtype=np.int64)
+            np.add.at(count, inv.reshape(-1), weight_of_edge)
+        pair_rv = pair // num_f_colors
+        elem = combine_codes([pair % num_f_colors, count], [num_f_colors, np.max(count, initial=0) + 1])
+        pos = np.arange(len(pair)) - np.searchsorted(pair_rv, pair_rv)
+        rv_color = sequence_ids(rv_color, pair_rv, pos, elem)
+
+        num_colors = np.max(rv_color, initial=-1) + 1
+        if stats is not None:
+            stats.append({'round': rounds, 'rvs': num_colors, 'factors': num_f_colors,
+                          'time': time.time() - start_time})
+
+    return rv_color, factor_color, True
 
 
 class SuperRV:
@@ -75,44 +274,44 @@ class SuperRV:
 
         return res
 
-    def split_by_evidence(self, k=2, iteration=10):
-        # can only be split into two when it is evidence rv, and there are multiple rvs
+    def split_by_evidence(self, k=2, iteration=10, method='kmeans'):
+        """
+        Split the evidence by clustering the values of the rvs.
+
+        Args:
+            k: The number of clusters.
+            iteration: The maximum number of iterations of k-means.
+            method: 'kmeans' for Lloyd's k-means, 'optimal' for the optimal 1 dimensional k-means, or 'quantile' for
+                    the bins of about the same number of rvs. Only k-means supports vector values, which are clustered
+                    in their own space.
+
+        Returns: The set of the super rvs after splitting, which includes this super rv.
+        """
+        # can only be split when it is evidence rv, and there are multiple rvs
         if len(self.rvs) <= 1:
             return {self}
 
-        # store all values
-        values = Counter()
-        for rv in self.rvs:
-            values[rv.value] += 1
-
-        if len(values) < k:
-            k = len(values)
-            if k <= 1:
-                return {self}
-
-        # initialize centroid
-        centroids = []
-        i = iter(values)
-        for _ in range(k):
-            centroids.append(next(i))
-        centroids = np.array(centroids)
-
-        # k-mean
-        sum_table = np.zeros((k, 2))
-        for _ in range(iteration):
-            for v, n in values.items():
-                idx = (np.abs(centroids - v)).argmin()
-                sum_table[idx, 0] += v * n
-                sum_table[idx, 1] += n
-            for idx in range(k):
-                centroids[idx] = sum_table[idx, 0] / sum_table[idx, 1]
-            sum_table.fill(0)
-
-        # clustering
-        clusters = [set() for _ in range(k)]
-        for rv in self.rvs:
-            idx = (np.abs(centroids - rv.value)).argmin()
-            clusters[idx].add(rv)
+        rvs = tuple(self.rvs)
+        values = np.array(tuple(map(self.get_rv_value, rvs)), dtype=float)
+        if method not in ('kmeans', 'optimal', 'quantile'):
+            raise Exception('Unknown clustering method ' + str(method) + '.')
+        if values.ndim > 1 and method != 'kmeans':
+            raise Exception('The ' + method + ' clustering only supports 1 dimensional values.')
+
+        if values.ndim > 1:
+            labels, centroids = kmeans(values.reshape(len(rvs), -1), k, iteration)
+            centroids = centroids.reshape((-1,) + values.shape[1:])
+        elif method == 'kmeans':
+            labels, centroids = kmeans_1d(values, k, iteration)
+        elif method == 'optimal':
+            labels, centroids = optimal_kmeans_1d(values, k)
+        else:
+            labels, centroids = quantile_bins(values, k)
+
+        if len(centroids) <= 1:
+            return {self}
+
+        clusters = [set(map(rvs.__getitem__, idx.tolist())) for idx in group_indices(labels, len(centroids))]
 
         res = set()
         # reuse THIS super rv instance
@@ -121,7 +320,7 @@ class SuperRV:
         self.variance = self.get_variance()
         res.add(self)
 
-        for idx in range(1, k):
+        for idx in range(1, len(clusters)):
             res.add(SuperRV(clusters[idx], self.domain, centroids[idx]))
 
         for rv in res:
@@ -145,14 +344,19 @@ class SuperF:
     def get_cluster(instance):
         return instance.cluster
 
+    def signature(self, f):
+        # the clusters of the neighbors in order, up to the permutations of the argument symmetry groups
+        return canonical_nb(map(self.get_cluster, f.nb), self.potential)
+
     def update_nb(self):
-        f = next(iter(self.factors))
-        self.nb = tuple(map(self.get_cluster, f.nb))
+        # for a symmetric potential, the neighbors are in the canonical order, which may differ from the order of the
+        # neighbors of some factors, but it does not change the potential value
+        self.nb = self.signature(next(iter(self.factors)))
 
     def split_by_structure(self):
         clusters = dict()
         for f in self.factors:
-            signature = tuple(map(self.get_cluster, f.nb))
+            signature = self.signature(f)
             if signature in clusters:
                 clusters[signature].add(f)
             else:
@@ -183,6 +387,22 @@ class CompressedGraph:
         self.factors = set()
         self.clustered_evidence = set()
 
+        self.stats = list()  # The number of colors and the elapsed time after each round of the last run
+        self.converged = None
+
+        # the colors of the last run, for updating the clusters incrementally
+        self.compiled = None
+        self.hidden = None
+        self.rv_color = None
+        self.factor_color = None
+        self.rv_signature = dict()  # key=signature, value=color
+        self.factor_signature = dict()
+        self.rv_color_sig = list()  # The signature of each color
+        self.factor_color_sig = list()
+        self.rv_clusters = dict()  # key=color, value=SuperRV
+        self.factor_clusters = dict()
+        self.exact = None  # if the clusters updated since the last run are the same as a full run
+
     def init_cluster(self, is_split_cont_evidence=True):
         self.rvs.clear()
         self.factors.clear()
@@ -232,11 +452,42 @@ class CompressedGraph:
         for _, cluster in color_table.items():
             self.factors.add(SuperF(cluster))
 
-    def split_evidence(self, k=2, iteration=10, epsilon=0):
+    def init_cluster_from_colors(self, rvs, rv_color, factors, factor_color):
+        """
+        Initialize the clusters from precomputed colors instead of the domains and potentials, e.g. the lifted coloring
+        of RelationalGraph.compress. The colors must separate the rvs by domain and evidence value, and the factors by
+        potential.
+
+        Args:
+            rvs: A list of rvs.
+            rv_color: An integer array of the color of each rv.
+            factors: A list of factors.
+            factor_color: An integer array of the color of each factor.
+        """
+        self.rvs.clear()
+        self.factors.clear()
+        self.clustered_evidence.clear()
+
+        for items, color, cluster_class, clusters in (
+                (rvs, rv_color, SuperRV, self.rvs), (factors, factor_color, SuperF, self.factors)):
+            if len(items) == 0:
+                continue
+            order = np.argsort(color, kind='stable')
+            starts = np.flatnonzero(np.r_[True, color[order][1:] != color[order][:-1]])
+            for group in np.split(order, starts[1:]):
+                clusters.add(cluster_class({items[i] for i in group.tolist()}))
+
+    def update_nb(self):
+        for rv in self.rvs:
+            rv.update_nb()
+        for f in self.factors:
+            f.update_nb()
+
+    def split_evidence(self, k=2, iteration=10, epsilon=0, method='kmeans'):
         for rv in tuple(self.clustered_evidence):
             if np.sqrt(rv.variance) > epsilon:
-                # split evidence
-                new_rvs = rv.split_by_evidence(k, iteration)
+                # split evidence, see SuperRV.split_by_evidence for the clustering methods
+                new_rvs = rv.split_by_evidence(k, iteration, method)
                 if len(new_rvs) > 1:
                     for rv_ in new_rvs:
                         if rv_.variance > epsilon:
@@ -260,9 +511,251 @@ class CompressedGraph:
         for f in tuple(self.factors):
             self.factors |= f.split_by_structure()
 
-    def run(self):
-        self.init_cluster(is_split_cont_evidence=True)
+    def run(self, max_rounds=None, min_compression_ratio=None):
+        """
+        Color passing on the integer arrays of the compiled graph, the super rvs and factors are only created for the
+        final colors, which are the same clusters as init_cluster(True) followed by refine. The factors of a potential
+        with argument symmetry (see Function.symmetry) are compared up to the permutations of its groups. The
+        refinement can be stopped early, which gives an approximately lifted graph, where the rvs of a super rv may
+        have different neighbors, and the neighbors of the super rv are the neighbors of one of its rvs.
+
+        Args:
+            max_rounds: The maximum number of rounds of splitting the factors and the rvs.
+            min_compression_ratio: Stop after the round in which the number of rvs per super rv drops below this value.
+
+        Returns: The compression ratio, i.e. the number of rvs per super rv.
+        """
+        compiled = self.g.compile()
+        rv_color, factor_color = self.init_colors(compiled)
+
+        edge_group = edge_groups(compiled.factors, compiled.edge_f, compiled.edge_pos)
+
+        self.stats = list()
+        rv_color, factor_color, self.converged = refine_colors(
+            rv_color, factor_color, compiled.edge_f, compiled.f_nb, compiled.edge_pos, ~compiled.observed,
+            max_rounds, min_compression_ratio, self.stats, edge_group
+        )
+
+        self.init_cluster_from_colors(compiled.rvs, rv_color, compiled.factors, factor_color)
+        self.update_nb()
+
+        # only the stable colors can be updated incrementally
+        if self.converged:
+            self.init_signatures(compiled, rv_color, factor_color)
+        else:
+            self.compiled = None
+
+        return self.compression_ratio
+
+    @property
+    def compression_ratio(self):
+        return len(self.g.rvs) / max(len(self.rvs), 1)
+
+    def init_signatures(self, compiled, rv_color, factor_color):
+        # record the signature and the cluster of each color, a color is identified by its signature after refinement
+        self.compiled = compiled
+        self.hidden = ~compiled.observed
+        self.exact = True
+        self.rv_color, self.factor_color = rv_color, factor_color
+
+        # the colors are 0 to the number of colors - 1, with distinct signatures
+        _, rep = np.unique(rv_color, return_index=True)
+        self.rv_color_sig = [self.rv_sig(i) for i in rep.tolist()]
+        self.rv_signature = {s: color for color, s in enumerate(self.rv_color_sig)}
+        self.rv_clusters = {color: compiled.rvs[i].cluster for color, i in enumerate(rep.tolist())}
+
+        _, rep = np.unique(factor_color, return_index=True)
+        self.factor_color_sig = [self.factor_sig(j) for j in rep.tolist()]
+        self.factor_signature = {s: color for color, s in enumerate(self.factor_color_sig)}
+        self.factor_clusters = {color: compiled.factors[j].cluster for color, j in enumerate(rep.tolist())}
+
+    def rv_sig(self, i):
+        # the evidence is identified by its value, and the hidden rvs by the multiset of the colors of their factors
+        rv = self.compiled.rvs[i]
+        if not self.hidden[i]:
+            return rv.domain, rv.value
+        fs = self.compiled.rv_nb[self.compiled.rv_ptr[i]:self.compiled.rv_ptr[i + 1]]
+        return rv.domain, None, tuple(sorted(Counter(self.factor_color[fs].tolist()).items()))
+
+    def factor_sig(self, j):
+        potential = self.compiled.factors[j].potential
+        return potential, tuple(canonical_rows(self.rv_color[self.compiled.factor_rvs(j)], potential).tolist())
 
+    @staticmethod
+    def gather(ptr, values, ids):
+        # the distinct values of the CSR rows ids
+        count = ptr[ids + 1] - ptr[ids]
+        offset = np.arange(np.sum(count)) - np.repeat(np.cumsum(count) - count, count)
+        return np.unique(values[np.repeat(ptr[ids], count) + offset])
+
+    @staticmethod
+    def recolor(ids, colors, sig, signature, color_sig, size, is_rv):
+        """
+        Find the new color of each instance from its current signature. If the signature is in the table, the instance
+        joins its color. Otherwise the instances with the same old color and signature split into a new color, unless
+        they are all instances of the old color, then the old color takes the new signature, since the partition does
+        not change. The colors of the observed rvs are never renamed, since their clusters hold the value.
+
+        Args:
+            ids: An integer array of the ids of the instances.
+            colors: An integer array of the colors of all instances.
+            sig: A function that computes the signature of an instance.
+            signature: A dictionary of signature to color.
+            color_sig: A list of the signature of each color.
+            size: A function that gives the number of instances of a color.
+            is_rv: A boolean value indicating if the instances are rvs.
+
+        Returns: The ids and the new colors of the instances whose color changes, and a boolean value indicating if a
+                 signature that is not in the table is given to a color, either by a new color or by a renaming.
+        """
+        groups = dict()
+        for i in ids.tolist():
+            groups.setdefault((int(colors[i]), sig(i)), list()).append(i)
+
+        # a color can not be renamed if other instances take its old signature
+        wanted = {s for _, s in groups}
+
+        moved, new_colors, is_new = list(), list(), False
+        for (color, s), members in groups.items():
+            if s in signature:
+                new_color = signature[s]
+            elif len(members) == size(color) and color_sig[color] not in wanted and \
+                    (not is_rv or s[1] is None and color_sig[color][1] is None):
+                del signature[color_sig[color]]
+                signature[s], color_sig[color] = color, s
+                is_new = True
+                continue
+            else:
+                new_color = signature[s] = len(color_sig)
+                color_sig.append(s)
+                is_new = True
+            if new_color != color:
+                moved.extend(members)
+                new_colors.extend([new_color] * len(members))
+
+        return np.array(moved, dtype=np.int64), np.array(new_colors, dtype=np.int64), is_new
+
+    def recolor_rvs(self, ids):
+        return self.recolor(
+            ids, self.rv_color, self.rv_sig, self.rv_signature, self.rv_color_sig,
+            lambda color: len(self.rv_clusters[color].rvs), True
+        )
+
+    def move(self, ids, new_colors, instances, colors, clusters, super_instances, cluster_class):
+        # move the instances to the clusters of their new colors, and remove the clusters that become empty
+        for i, color in zip(ids.tolist(), new_colors.tolist()):
+            instance = instances[i]
+            old = instance.cluster
+            members = old.rvs if cluster_class is SuperRV else old.factors
+            members.discard(instance)
+            if len(members) == 0:
+                super_instances.discard(old)
+                del clusters[colors[i]]
+
+            if color in clusters:
+                cluster = clusters[color]
+                (cluster.rvs if cluster_class is SuperRV else cluster.factors).add(instance)
+                instance.cluster = cluster
+            else:
+                cluster = cluster_class({instance})
+                super_instances.add(cluster)
+                clusters[color] = cluster
+            colors[i] = color
+
+    def update_evidence(self, changed_rvs):
+        """
+        Update the clusters after the values of some rvs are changed, without running color passing again. Starting
+        from the colors of the last run, only the changed rvs, and the factors and hidden rvs whose neighbors change
+        color, are recolored. An instance whose signature matches an existing color joins that color, and the cost is
+        proportional to the neighborhood of the changed rvs.
+
+        The instances are recolored one signature at a time, so instances that only become equivalent together, e.g.
+        two rvs whose factors are both recolored, are not merged. If every recolored instance joins an existing color,
+        the colors keep the signatures of the last run, which has the fewest colors, and the clusters are the same as
+        a full run. Otherwise the clusters are still a valid lifting, but a full run may give fewer clusters.
+
+        Args:
+            changed_rvs: An iterable of rvs whose value is set, changed or removed since the last run.
+
+        Returns: True if the clusters are the same as a full run, i.e. no update since the last run gives a color a
+                 signature that is not in the table. False otherwise.
+        """
+        compiled = self.compiled
+        if compiled is None:
+            raise Exception('The clusters must be computed by a converged run before updating evidence')
+
+        ids = np.unique(compiled.rv_ids(changed_rvs))
+        self.hidden[ids] = [compiled.rvs[i].value is None for i in ids.tolist()]
+
+        rv_ids, rv_colors, is_new = self.recolor_rvs(ids)
+
+        touched_rvs, touched_factors = [rv_ids], list()
+        while len(rv_ids) > 0:
+            self.move(rv_ids, rv_colors, compiled.rvs, self.rv_color, self.rv_clusters, self.rvs, SuperRV)
+
+            fs = self.gather(compiled.rv_ptr, compiled.rv_nb, rv_ids)
+            touched_factors.append(fs)
+            f_ids, f_colors, f_is_new = self.recolor(
+                fs, self.factor_color, self.factor_sig, self.factor_signature, self.factor_color_sig,
+                lambda color: len(self.factor_clusters[color].factors), False
+            )
+            self.move(f_ids, f_colors, compiled.factors, self.factor_color, self.factor_clusters, self.factors, SuperF)
+
+            rvs = self.gather(compiled.f_ptr, compiled.f_nb, f_ids)
+            touched_rvs.append(rvs)
+            rv_ids, rv_colors, rv_is_new = self.recolor_rvs(rvs[self.hidden[rvs]])
+            is_new = is_new or f_is_new or rv_is_new
+
+        # the clusters that gain or lose instances, or have recolored neighbors
+        for cluster in {compiled.rvs[i].cluster for i in np.concatenate(touched_rvs).tolist()}:
+            cluster.update_nb()
+        if touched_factors:
+            for cluster in {compiled.factors[j].cluster for j in np.concatenate(touched_factors).tolist()}:
+                cluster.update_nb()
+
+        # a later update can not undo the splits of this one
+        self.exact = self.exact and not is_new
+        return self.exact
+
+    @staticmethod
+    def init_colors(compiled):
+        """
+        Compute the colors of init_cluster(True), i.e. the rvs are colored by domain and evidence value, and the factors
+        are colored by potential.
+
+        Args:
+            compiled: A CompiledGraph instance.
+
+        Returns: The integer arrays of the colors of the rvs and the factors, in the order of the compiled graph.
+        """
+        domain_idx = dict()
+        domain = np.fromiter(
+            (domain_idx.setdefault(rv.domain, len(domain_idx)) for rv in compiled.rvs),
+            dtype=np.int64, count=compiled.num_rvs
+        )
+
+        # the hidden rvs get value 0, and the evidence gets the index of its value from 1
+        value = np.zeros(compiled.num_rvs, dtype=np.int64)
+        observed = compiled.values[compiled.observed]
+        try:
+            _, inv = np.unique(observed, return_inverse=True)
+        except TypeError:
+            value_idx = dict()
+            inv = np.array([value_idx.setdefault(v, len(value_idx)) for v in observed], dtype=np.int64)
+        value[compiled.observed] = inv.reshape(-1) + 1
+
+        rv_color = combine_codes([domain, value], [len(domain_idx), int(value.max(initial=0)) + 1])
+
+        potential_idx = dict()
+        factor_color = np.fromiter(
+            (potential_idx.setdefault(f.potential, len(potential_idx)) for f in compiled.factors),
+            dtype=np.int64, count=compiled.num_factors
+        )
+
+        return rv_color, factor_color
+
+    def refine(self):
+        # split the clusters until the number of super rvs does not change
         prev_rvs_num = -1
         while prev_rvs_num != len(self.rvs):
             prev_rvs_num = len(self.rvs)
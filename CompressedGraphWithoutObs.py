@@ -1,4 +1,5 @@
 from Graph import *
+from CompressedGraphWithObs import canonical_nb
 from collections import Counter
 from statistics import mean
 from random import uniform
@@ -63,14 +64,17 @@ class SuperF:
     def get_cluster(instance):
         return instance.cluster
 
+    def signature(self, f):
+        # the clusters of the neighbors in order, up to the permutations of the argument symmetry groups
+        return canonical_nb(map(self.get_cluster, f.nb), self.potential)
+
     def update_nb(self):
-        f = next(iter(self.factors))
-        self.nb = tuple(map(self.get_cluster, f.nb))
+        self.nb = self.signature(next(iter(self.factors)))
 
     def split_by_structure(self):
         clusters = dict()
         for f in self.factors:
-            signature = tuple(map(self.get_cluster, f.nb))
+            signature = self.signature(f)
             if signature in clusters:
                 clusters[signature].add(f)
             else:
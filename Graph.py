@@ -1,4 +1,29 @@
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from itertools import count
+
+
+def combine_codes(codes, sizes):
+    """
+    Combine the integer codes of several columns into one integer code per row, such that two rows get the same code if
+    and only if they have the same codes in all columns.
+
+    Args:
+        codes: A list of equal length integer arrays, the k-th array has values in range(sizes[k]).
+        sizes: A list of the number of possible values of each column.
+
+    Returns: An integer array.
+    """
+    res = np.zeros(len(codes[0]) if codes else 0, dtype=np.int64)
+    size = 1
+    for column, column_size in zip(codes, sizes):
+        if size * max(column_size, 1) >= 2 ** 62:
+            _, res = np.unique(res, return_inverse=True)
+            res, size = res.reshape(-1), int(res.max()) + 1
+        res = res * column_size + column
+        size *= max(column_size, 1)
+    return res
 
 
 class Domain:
@@ -57,18 +82,66 @@ class RV:
     """
     The Random Variable.
     """
+    __slots__ = ('domain', 'value', 'name', 'N', 'cluster', '_id', '_nb', '_idx')
+
+    id_counter = count()
+
     def __init__(self, domain, value=None, name=None):
         self.domain = domain
         self.value = value
         self.name = name
-        self.nb = list()  # A list of neighboring factors
+        self.cluster = None  # The SuperRV that contains this rv, set by the compressed graph
+        self._id = None
+        self._nb = ()  # The neighboring factors, or the flyweight graph that stores them
+        self._idx = None  # The position of the rv in its flyweight graph
         self.N = 0  # The number of neighboring factors
 
+    @property
+    def id(self):
+        """
+        A unique and stable integer id, assigned on the first access.
+        """
+        if self._id is None:
+            self._id = next(RV.id_counter)
+        return self._id
+
+    @property
+    def nb(self):
+        """
+        A list of neighboring factors, or a tuple built on every access if the rv is in a flyweight graph, so that it
+        cannot be modified in place.
+        """
+        if self._idx is None:
+            return self._nb
+        else:
+            return self._nb.rv_nb(self._idx)
+
+    @nb.setter
+    def nb(self, nb):
+        self._nb = nb
+        self._idx = None
+
+    def set_flyweight_nb(self, graph, idx):
+        """
+        Let the neighboring factors be looked up from the shared arrays of a flyweight graph,
+        instead of being stored in the rv.
+
+        Args:
+            graph: The flyweight Graph instance.
+            idx: The position of the rv in the graph.
+        """
+        self._nb = graph
+        self._idx = idx
+
 
 class F:
     """
     The Factor (a clique of variables that associates with a potential function).
     """
+    __slots__ = ('potential', 'nb', 'name', 'cluster', '_id')
+
+    id_counter = count()
+
     def __init__(self, potential=None, nb=None, name=None):
         """
         Args:
@@ -81,19 +154,44 @@ class F:
         else:
             self.nb = nb
         self.name = name
+        self.cluster = None  # The SuperF that contains this factor, set by the compressed graph
+        self._id = None
+
+    @property
+    def id(self):
+        """
+        A unique and stable integer id, assigned on the first access.
+        """
+        if self._id is None:
+            self._id = next(F.id_counter)
+        return self._id
 
 
 class Graph:
     """
     The Graphical Model, representing by a set of random variables and a set of factors.
     """
-    def __init__(self, rvs, factors, condition_rvs=None):
+    def __init__(self, rvs, factors, condition_rvs=None, flyweight=False):
+        """
+        Args:
+            rvs: A collection of random variables.
+            factors: A collection of factors.
+            condition_rvs: A set of variables that are always conditioned on.
+            flyweight: A boolean value indicating if the neighboring factors of the rvs are stored in arrays shared
+                       by the graph, instead of a list per rv. It saves memory on large graphs, at the cost of
+                       creating a (read-only) tuple on every access of rv.nb.
+        """
         self.rvs = rvs
         self.factors = factors
         self.condition_rvs = set() if condition_rvs is None else condition_rvs
+        self.flyweight = flyweight
         self.init_nb()
 
     def init_nb(self):
+        if self.flyweight:
+            self.init_flyweight_nb()
+            return
+
         for rv in self.rvs:
             rv.nb = list()
         for f in self.factors:
@@ -101,3 +199,355 @@ class Graph:
                 rv.nb.append(f)
         for rv in self.rvs:
             rv.N = len(rv.nb)
+
+    def init_flyweight_nb(self):
+        # the neighboring factors of all rvs are stored in CSR format
+        self.factor_list = tuple(self.factors)
+
+        for idx, rv in enumerate(self.rvs):
+            rv.set_flyweight_nb(self, idx)
+
+        arity = np.fromiter((len(f.nb) for f in self.factor_list), dtype=np.int64, count=len(self.factor_list))
+        f_nb = np.fromiter((rv._idx for f in self.factor_list for rv in f.nb), dtype=np.int64, count=np.sum(arity))
+        order = np.argsort(f_nb, kind='stable')
+
+        N = np.bincount(f_nb, minlength=len(self.rvs))
+        self.rv_ptr = np.zeros(len(self.rvs) + 1, dtype=np.int64)
+        np.cumsum(N, out=self.rv_ptr[1:])
+        self.rv_nb_idx = np.repeat(np.arange(len(self.factor_list), dtype=np.int64), arity)[order]
+
+        for rv, n in zip(self.rvs, N.tolist()):
+            rv.N = n
+
+    def rv_nb(self, idx):
+        """
+        Returns: A tuple of neighboring factors of the rv at position idx (only for flyweight graph).
+        """
+        factors = self.factor_list
+        return tuple(factors[j] for j in self.rv_nb_idx[self.rv_ptr[idx]:self.rv_ptr[idx + 1]].tolist())
+
+    def compile(self):
+        """
+        Freeze the current structure and evidence of the graph into an integer indexed view.
+
+        Returns: A CompiledGraph instance.
+        """
+        return CompiledGraph(self)
+
+    def components(self):
+        """
+        Split the graph into its connected components, which can be inferred independently.
+
+        Returns: A list of Graph instances, one for each connected component, in the order of their first rv. They
+                 share the RV and F instances with this graph, and keep the order of the rvs and the factors. An rv
+                 without factors is a component by itself.
+        """
+        cg = self.compile()
+
+        # connect every rv of a factor to the first rv of the factor
+        first = cg.f_nb[cg.f_ptr[cg.edge_f]]
+        adjacency = coo_matrix((np.ones(cg.num_edges), (cg.f_nb, first)), shape=(cg.num_rvs, cg.num_rvs))
+        _, labels = connected_components(adjacency, directed=False)
+
+        # renumber the components in the order of their first rv
+        _, first_rv, labels = np.unique(labels, return_index=True, return_inverse=True)
+        labels = np.argsort(np.argsort(first_rv))[labels.reshape(-1)]
+        factor_labels = labels[cg.f_nb[cg.f_ptr[:-1][cg.arity > 0]]]
+        factor_ids = np.flatnonzero(cg.arity > 0)
+
+        rv_order = np.argsort(labels, kind='stable')
+        rv_bounds = np.searchsorted(labels[rv_order], np.arange(len(first_rv) + 1))
+        f_order = np.argsort(factor_labels, kind='stable')
+        f_bounds = np.searchsorted(factor_labels[f_order], np.arange(len(first_rv) + 1))
+
+        res = list()
+        for c in range(len(first_rv)):
+            rvs = [cg.rvs[i] for i in rv_order[rv_bounds[c]:rv_bounds[c + 1]].tolist()]
+            factors = [cg.factors[j] for j in factor_ids[f_order[f_bounds[c]:f_bounds[c + 1]]].tolist()]
+            condition_rvs = {rv for rv in rvs if rv in self.condition_rvs}
+            res.append(Graph(rvs, factors, condition_rvs, self.flyweight))
+
+        return res
+
+    def factor_batches(self):
+        """
+        Returns: A list of FactorBatch instances, one for each distinct potential (and arity) of the graph.
+        """
+        return self.compile().factor_batches
+
+
+class FactorBatch:
+    """
+    A group of factors that share the same potential function, such that they can be evaluated together
+    with a single potential.batch_call.
+    """
+    def __init__(self, potential, factor_ids, nb, observed):
+        """
+        Args:
+            potential: The potential function shared by the factors.
+            factor_ids: An array of n factor ids.
+            nb: A (n, arity) array, where each row is the rv ids of a factor.
+            observed: A (n, arity) boolean array indicating if the corresponding rv is observed.
+        """
+        self.potential = potential
+        self.factor_ids = factor_ids
+        self.nb = nb
+        self.observed = observed
+        self.arity = nb.shape[1]
+
+    def __len__(self):
+        return len(self.factor_ids)
+
+    @staticmethod
+    def row_groups(signature):
+        """
+        Group the rows of a batch by their signature.
+
+        Args:
+            signature: A (n, c) array, where each row is the signature of a factor in the batch.
+
+        Returns: A list of row index arrays, one for each distinct signature.
+        """
+        _, inverse = np.unique(signature, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind='stable')
+        split = np.flatnonzero(np.diff(inverse[order])) + 1
+        return np.split(order, split)
+
+
+class CompiledGraph:
+    """
+    A frozen, integer indexed view of a Graph.
+
+    Random variables and factors are numbered by contiguous ids (following the iteration order of the graph),
+    and the adjacency is stored in CSR format in both directions. Every (factor, position) pair is an edge,
+    numbered in factor-major order, so that edge e connects factor edge_f[e] with variable f_nb[e].
+    The view shares the RV and F instances with the original graph, so it can be passed to any inferer that
+    accepts a Graph, but the structure and the evidence are copied, i.e. later changes of the graph
+    (or rv.value) are not reflected in the view.
+    """
+    def __init__(self, g):
+        self.g = g
+        self.rvs = tuple(g.rvs)
+        self.factors = tuple(g.factors)
+        self.condition_rvs = g.condition_rvs
+
+        self.rv_idx = {rv: i for i, rv in enumerate(self.rvs)}
+        self.f_idx = {f: j for j, f in enumerate(self.factors)}
+
+        self.num_rvs = len(self.rvs)
+        self.num_factors = len(self.factors)
+
+        # factor -> rv adjacency
+        self.arity = np.fromiter((len(f.nb) for f in self.factors), dtype=np.int64, count=self.num_factors)
+        self.f_ptr = np.zeros(self.num_factors + 1, dtype=np.int64)
+        np.cumsum(self.arity, out=self.f_ptr[1:])
+        self.num_edges = int(self.f_ptr[-1])
+
+        rv_idx = self.rv_idx
+        self.f_nb = np.fromiter(
+            (rv_idx[rv] for f in self.factors for rv in f.nb), dtype=np.int64, count=self.num_edges
+        )
+        self.edge_f = np.repeat(np.arange(self.num_factors, dtype=np.int64), self.arity)
+        self.edge_pos = np.arange(self.num_edges, dtype=np.int64) - self.f_ptr[self.edge_f]
+
+        # rv -> factor adjacency, the edges of each rv are sorted by factor id
+        self.rv_edge = np.argsort(self.f_nb, kind='stable')
+        self.N = np.bincount(self.f_nb, minlength=self.num_rvs).astype(np.int64)
+        self.rv_ptr = np.zeros(self.num_rvs + 1, dtype=np.int64)
+        np.cumsum(self.N, out=self.rv_ptr[1:])
+        self.rv_nb = self.edge_f[self.rv_edge]
+        self.rv_pos = self.edge_pos[self.rv_edge]
+
+        # evidence and domain information
+        self.observed = np.fromiter((rv.value is not None for rv in self.rvs), dtype=bool, count=self.num_rvs)
+        self.continuous = np.fromiter((rv.domain.continuous for rv in self.rvs), dtype=bool, count=self.num_rvs)
+        self.values = self.value_array(rv.value for rv in self.rvs)
+
+        self._factor_batches = None
+        self.frame = None  # The frame of each rv id, see FrameGraph
+
+        for a in (self.arity, self.f_ptr, self.f_nb, self.edge_f, self.edge_pos,
+                  self.rv_edge, self.N, self.rv_ptr, self.rv_nb, self.rv_pos,
+                  self.observed, self.continuous, self.values):
+            a.flags.writeable = False
+
+    @staticmethod
+    def value_array(values):
+        """
+        Args:
+            values: An iterable of assignments, where None stands for an unassigned (hidden) variable.
+
+        Returns: An array of values (nan for None), with float dtype if all the values are numeric,
+                 and object dtype otherwise.
+        """
+        values = [
+            np.nan if v is None else v.item() if isinstance(v, np.ndarray) and v.size == 1 else v
+            for v in values
+        ]
+        try:
+            return np.array(values, dtype=float)
+        except (TypeError, ValueError):
+            res = np.empty(len(values), dtype=object)
+            res[:] = values
+            return res
+
+    @property
+    def factor_batches(self):
+        if self._factor_batches is None:
+            self._factor_batches = self.build_factor_batches()
+        return self._factor_batches
+
+    def build_factor_batches(self):
+        if self.num_factors == 0:
+            return list()
+
+        potential_idx = dict()
+        f_potential = np.fromiter(
+            (potential_idx.setdefault(f.potential, len(potential_idx)) for f in self.factors),
+            dtype=np.int64, count=self.num_factors
+        )
+        potentials = list(potential_idx)
+
+        res = list()
+        for fids in FactorBatch.row_groups(np.stack([f_potential, self.arity], axis=1)):
+            arity = self.arity[fids[0]]
+            nb = self.f_nb[self.f_ptr[fids][:, np.newaxis] + np.arange(arity)]
+            res.append(FactorBatch(potentials[f_potential[fids[0]]], fids, nb, self.observed[nb]))
+
+        return res
+
+    def rv_ids(self, rvs):
+        return np.fromiter((self.rv_idx[rv] for rv in rvs), dtype=np.int64)
+
+    def rv_id(self, rv, frame=None):
+        # the id of the rv, the frame is only used by a FrameGraph
+        return self.rv_idx[rv]
+
+    def factor_ids(self, factors):
+        return np.fromiter((self.f_idx[f] for f in factors), dtype=np.int64)
+
+    def factor_rvs(self, j):
+        """
+        Returns: The ids of the neighboring variables of factor j, in the order of the potential arguments.
+        """
+        return self.f_nb[self.f_ptr[j]:self.f_ptr[j + 1]]
+
+    def rv_edges(self, i):
+        """
+        Returns: The ids of the edges connecting to variable i.
+        """
+        return self.rv_edge[self.rv_ptr[i]:self.rv_ptr[i + 1]]
+
+    def rv_factors(self, i):
+        """
+        Returns: The ids of the neighboring factors of variable i, and the position of i in each of them.
+        """
+        return self.rv_nb[self.rv_ptr[i]:self.rv_ptr[i + 1]], self.rv_pos[self.rv_ptr[i]:self.rv_ptr[i + 1]]
+
+    def compile(self):
+        return self
+
+
+class FrameGraph(CompiledGraph):
+    """
+    The disjoint union of M frames, i.e. copies of a compiled graph with different evidence, so that an inferer runs
+    all frames together on the ids of a single CompiledGraph, e.g. to denoise a set of images of the same size.
+
+    The rv i of frame t has id t * n + i, and the factor j of frame t has id t * m + j, where n and m are the numbers of
+    rvs and factors of a frame, so every array of the view is the concatenation of the arrays of the frames. The RV and
+    F instances are shared by all frames, so rv_idx and f_idx give the ids of frame 0, and rv_id gives the id of an rv
+    in a frame. The evidence of the rvs (rv.value) is replaced by the evidence of the frames.
+    """
+    def __init__(self, g, evidence, mask=None):
+        """
+        Args:
+            g: The Graph or CompiledGraph instance of the structure of a frame.
+            evidence: A (M, n) array of the values of the rvs in each frame, in the order of the rvs of g.compile().
+            mask: A (M, n) boolean array, True for the observed rvs. By default, the rvs with nan (or None) values are
+                  hidden and the others are observed.
+        """
+        cg = g.compile()
+        evidence = np.asarray(evidence)
+        if evidence.ndim != 2 or evidence.shape[1] != cg.num_rvs:
+            raise Exception('the evidence must be an array of shape (M, ' + str(cg.num_rvs) + ')')
+        if mask is None:
+            if evidence.dtype == object:
+                mask = np.vectorize(lambda v: v is not None and v == v, otypes=[bool])(evidence)
+            else:
+                mask = ~np.isnan(evidence.astype(float))
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != evidence.shape:
+            raise Exception('the mask must have the shape of the evidence')
+
+        M, n, m = evidence.shape[0], cg.num_rvs, cg.num_factors
+        self.base = cg
+        self.num_frames = M
+        self.frame_rvs = n
+        self.frame_factors = m
+
+        self.g = cg.g
+        self.rvs = cg.rvs * M
+        self.factors = cg.factors * M
+        self.condition_rvs = cg.condition_rvs
+        self.rv_idx = cg.rv_idx
+        self.f_idx = cg.f_idx
+
+        self.num_rvs = n * M
+        self.num_factors = m * M
+        self.num_edges = cg.num_edges * M
+
+        # the arrays of the frames, with the ids of frame t shifted by t times the size of a frame
+        shift = np.arange(M, dtype=np.int64)[:, np.newaxis]
+        self.arity = np.tile(cg.arity, M)
+        self.f_ptr = np.zeros(self.num_factors + 1, dtype=np.int64)
+        np.cumsum(self.arity, out=self.f_ptr[1:])
+        self.f_nb = (cg.f_nb + shift * n).reshape(-1)
+        self.edge_f = (cg.edge_f + shift * m).reshape(-1)
+        self.edge_pos = np.tile(cg.edge_pos, M)
+
+        self.rv_edge = (cg.rv_edge + shift * cg.num_edges).reshape(-1)
+        self.N = np.tile(cg.N, M)
+        self.rv_ptr = np.zeros(self.num_rvs + 1, dtype=np.int64)
+        np.cumsum(self.N, out=self.rv_ptr[1:])
+        self.rv_nb = self.edge_f[self.rv_edge]
+        self.rv_pos = np.tile(cg.rv_pos, M)
+
+        self.observed = mask.reshape(-1)
+        self.continuous = np.tile(cg.continuous, M)
+        if evidence.dtype == object:
+            self.values = self.value_array(np.where(self.observed, evidence.reshape(-1), None))
+        else:
+            self.values = np.where(self.observed, evidence.reshape(-1).astype(float), np.nan)
+        self.frame = np.repeat(np.arange(M, dtype=np.int64), n)
+
+        self._factor_batches = None
+
+        for a in (self.arity, self.f_ptr, self.f_nb, self.edge_f, self.edge_pos,
+                  self.rv_edge, self.N, self.rv_ptr, self.rv_nb, self.rv_pos,
+                  self.observed, self.continuous, self.values, self.frame):
+            a.flags.writeable = False
+
+    def build_factor_batches(self):
+        # the batches of the frames are the batches of a frame, repeated with shifted ids
+        res = list()
+        for batch in self.base.factor_batches:
+            shift = np.arange(self.num_frames, dtype=np.int64)[:, np.newaxis]
+            fids = (batch.factor_ids + shift * self.frame_factors).reshape(-1)
+            nb = (batch.nb[np.newaxis] + shift[:, :, np.newaxis] * self.frame_rvs).reshape(-1, batch.arity)
+            res.append(FactorBatch(batch.potential, fids, nb, self.observed[nb]))
+        return res
+
+    def rv_id(self, rv, frame=None):
+        if frame is None:
+            raise Exception('the frame of the rv is required')
+        return frame * self.frame_rvs + self.rv_idx[rv]
+
+    def frame_ids(self, ids):
+        """
+        Args:
+            ids: An integer array of the rv ids of a frame.
+
+        Returns: The (M, len(ids)) array of the ids of the rvs in each frame.
+        """
+        return np.arange(self.num_frames, dtype=np.int64)[:, np.newaxis] * self.frame_rvs + ids
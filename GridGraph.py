@@ -0,0 +1,115 @@
+from Graph import *
+import numpy as np
+
+
+class GridGraph:
+    """
+    An implicit grid shaped model for images, where each hidden pixel is connected to its observed pixel by a node
+    potential, and to its 4 neighbors (left, right, up and down) by an edge potential.
+
+    Only the image shape, the potentials and the evidence image are stored, the rvs and factors are never created
+    unless they are asked for by to_graph. Neighboring pixels are accessed by shifting the pixel arrays.
+    """
+
+    # the shifts of the 4 neighbors, in the order of left, right, up and down
+    directions = ((0, -1), (0, 1), (-1, 0), (1, 0))
+    opposite = (1, 0, 3, 2)
+
+    def __init__(self, domain, node_potential, edge_potential, evidence):
+        """
+        Args:
+            domain: The domain of the hidden pixels.
+            node_potential: The potential between a hidden pixel and its observed pixel, with arguments
+                            (hidden, observed).
+            edge_potential: The potential between two neighboring hidden pixels, with arguments (pixel, right pixel)
+                            for horizontal edges, and (pixel, lower pixel) for vertical edges.
+            evidence: A (row, col) array of the observed image.
+        """
+        self.domain = domain
+        self.node_potential = node_potential
+        self.edge_potential = edge_potential
+        self.evidence = np.asarray(evidence, dtype=float)
+        self.shape = self.evidence.shape
+        self.row, self.col = self.shape
+
+        # mask[d] indicates if the pixel has a neighbor in direction d
+        self.mask = np.ones((4,) + self.shape, dtype=bool)
+        self.mask[0, :, 0] = False
+        self.mask[1, :, -1] = False
+        self.mask[2, 0, :] = False
+        self.mask[3, -1, :] = False
+
+        # the number of neighboring factors of each hidden pixel (including the node factor)
+        self.N = 1 + np.sum(self.mask, axis=0)
+
+    def shift(self, a, d):
+        """
+        Move the neighbors of each pixel in direction d onto the pixel, i.e. res[i, j] = a[i + di, j + dj],
+        and pad the border with zero.
+
+        Args:
+            a: An array with the shape of the grid as its leading dimensions.
+            d: The index of the direction.
+
+        Returns: An array with the same shape of a.
+        """
+        di, dj = self.directions[d]
+        res = np.zeros_like(a)
+        res[max(-di, 0):self.row - max(di, 0), max(-dj, 0):self.col - max(dj, 0)] = \
+            a[max(di, 0):self.row - max(-di, 0), max(dj, 0):self.col - max(-dj, 0)]
+        return res
+
+    def edges(self, d):
+        """
+        Returns: The slices of the first and the second arguments of all horizontal (d=0) or vertical (d=1) edges.
+        """
+        if d == 0:
+            return np.s_[:, :-1], np.s_[:, 1:]
+        else:
+            return np.s_[:-1, :], np.s_[1:, :]
+
+    def log_likelihood(self, image):
+        """
+        The same as utils.log_likelihood, for an assignment of the hidden pixels given by a (row, col) array.
+        """
+        first, second = self.edges(0)
+        value = [
+            self.node_potential.batch_call(np.stack([image, self.evidence], -1).reshape(-1, 2)),
+            self.edge_potential.batch_call(np.stack([image[first], image[second]], -1).reshape(-1, 2))
+        ]
+        first, second = self.edges(1)
+        value.append(self.edge_potential.batch_call(np.stack([image[first], image[second]], -1).reshape(-1, 2)))
+
+        value = np.concatenate(value)
+        if np.any(value == 0):
+            return -np.Inf
+
+        return -np.sum(np.log(value))
+
+    def to_graph(self):
+        """
+        Create the explicit graph of the grid model.
+
+        Returns: The Graph instance, and a (row, col) array of the hidden rvs.
+        """
+        row, col = self.shape
+
+        rvs = np.empty(self.shape, dtype=object)
+        evidence = np.empty(self.shape, dtype=object)
+        for i in range(row):
+            for j in range(col):
+                rvs[i, j] = RV(self.domain)
+                evidence[i, j] = RV(self.domain, self.evidence[i, j])
+
+        fs = list()
+        for i in range(row):
+            for j in range(col):
+                fs.append(F(self.node_potential, (rvs[i, j], evidence[i, j])))
+        for i in range(row):
+            for j in range(col - 1):
+                fs.append(F(self.edge_potential, (rvs[i, j], rvs[i, j + 1])))
+        for i in range(row - 1):
+            for j in range(col):
+                fs.append(F(self.edge_potential, (rvs[i, j], rvs[i + 1, j])))
+
+        return Graph(list(rvs.reshape(-1)) + list(evidence.reshape(-1)), fs), rvs
@@ -1,7 +1,10 @@
 from Graph import *
+from CompressedGraphWithObs import CompressedGraph, refine_colors, canonical_rows, edge_groups
 import numpy as np
 from itertools import product
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, Counter, deque
+import multiprocessing
+import math
 import re
 
 
@@ -35,6 +38,28 @@ class Atom:
                     self.sub_idx.append(idx)
                     self.lv_idx[term] = idx
 
+        def project(self, keys):
+            """
+            Project the ground terms to the substitutions of the logical variables of the atom, the ground terms that do
+            not match the constants of the atom are dropped.
+            """
+            const = [(idx, term) for idx, term in enumerate(self.terms) if idx not in self.sub_idx]
+            return {tuple(key[idx] for idx in self.sub_idx) for key in keys if all(key[idx] == t for idx, t in const)}
+
+        def ground_terms(self, subs):
+            """
+            Returns: The ground terms of the atom for each row of a (m, number of logical variables of the atom) array.
+            """
+            if len(self.sub_idx) == len(self.terms):
+                return map(tuple, subs.tolist())
+            res = list()
+            for sub in subs.tolist():
+                terms = list(self.terms)
+                for idx, ins in zip(self.sub_idx, sub):
+                    terms[idx] = ins
+                res.append(tuple(terms))
+            return res
+
         def ground(self, sub):
             terms = list(self.terms)
             for idx, ins in zip(self.sub_idx, sub):
@@ -42,8 +67,157 @@ class Atom:
             return tuple([self.base] + terms)
 
 
+class Const:
+    """
+    A constant term of a declarative constraint, e.g. Eq('U', Const('u1')), so that it is not taken for the name of a
+    logical variable.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+
+class Eq:
+    """
+    A declarative constraint of a parametric factor that requires two logical variables (or a logical variable and a
+    constant) to be equal. During enumeration, the logical variable is bound by copying instead of the cross product.
+    """
+
+    def __init__(self, lv, other):
+        """
+        Args:
+            lv: The name of a logical variable.
+            other: The name of a logical variable, or a constant. A string is always the name of a logical variable, so
+                   a string constant must be wrapped by Const.
+        """
+        self.lv = lv
+        self.other = other
+
+    def is_const(self):
+        return not isinstance(self.other, str)
+
+    def const(self):
+        return self.other.value if isinstance(self.other, Const) else self.other
+
+    def lvs_(self, pf_lvs):
+        # the logical variables of the constraint, the unknown ones are reported by ParamF.enumeration_plan
+        return [self.lv] + ([] if self.is_const() else [self.other])
+
+    def operand(self, table):
+        return self.const() if self.is_const() else table[self.other]
+
+    def mask(self, table):
+        return table[self.lv] == self.operand(table)
+
+
+class Neq(Eq):
+    """
+    A declarative constraint that requires two logical variables (or a logical variable and a constant) to be different.
+    """
+
+    def mask(self, table):
+        return table[self.lv] != self.operand(table)
+
+
+class Lt(Eq):
+    """
+    A declarative constraint that requires the instance of a logical variable to be smaller than the other one, e.g. for
+    breaking the symmetry of pairs of the same logical variable.
+    """
+
+    def mask(self, table):
+        return table[self.lv] < self.operand(table)
+
+
+class In:
+    """
+    A declarative constraint that requires the instances of a list of logical variables to be a row of a relation.
+    During enumeration, the relation is joined with the partial substitutions instead of taking the cross product.
+    """
+
+    def __init__(self, lvs, relation):
+        """
+        Args:
+            lvs: A list of logical variables.
+            relation: An iterable of tuples, or a 2 dimensional array with one column per logical variable.
+        """
+        self.lvs = list(lvs)
+
+        # keep one array per column, so the columns of different types are not converted to a common type
+        if isinstance(relation, np.ndarray):
+            relation = relation.reshape(-1, len(self.lvs))
+            self.columns = [relation[:, k] for k in range(len(self.lvs))]
+        else:
+            relation = list(relation)
+            self.columns = [np.array([row[k] for row in relation]) for k in range(len(self.lvs))]
+        self.size = len(self.columns[0])
+
+        # the sorted distinct values and the value codes of each column
+        self.uniques, self.codes = list(), list()
+        for column in self.columns:
+            unique, inv = np.unique(column, return_inverse=True)
+            self.uniques.append(unique)
+            self.codes.append(inv.reshape(-1))
+
+        self.indexes = dict()
+
+    def lvs_(self, pf_lvs):
+        return self.lvs
+
+    def index(self, lvs):
+        # the rows of the relation sorted by the combined codes of the given columns
+        if lvs not in self.indexes:
+            ks = [self.lvs.index(lv) for lv in lvs]
+            if ks:
+                key = combine_codes([self.codes[k] for k in ks], [len(self.uniques[k]) for k in ks])
+            else:
+                key = np.zeros(self.size, dtype=np.int64)
+            order = np.argsort(key, kind='stable')
+            self.indexes[lvs] = ks, order, key[order]
+        return self.indexes[lvs]
+
+    def match(self, table, lvs):
+        """
+        Find the rows of the relation that agree with each substitution on the given logical variables.
+
+        Returns: The (start, count) arrays of the matched range of each substitution in the order of index(lvs).
+        """
+        ks, order, sorted_key = self.index(lvs)
+        size = len(next(iter(table.values()))) if table else 1
+
+        codes, found = list(), np.ones(size, dtype=bool)
+        for lv, k in zip(lvs, ks):
+            unique = self.uniques[k]
+            code = np.searchsorted(unique, table[lv]).clip(max=max(len(unique) - 1, 0))
+            found &= unique[code] == table[lv] if len(unique) > 0 else False
+            codes.append(code)
+        key = combine_codes(codes, [len(self.uniques[k]) for k in ks]) if codes else np.zeros(size, dtype=np.int64)
+
+        start = np.searchsorted(sorted_key, key, side='left')
+        count = np.searchsorted(sorted_key, key, side='right') - start
+        count[~found] = 0
+
+        return start, count
+
+    def mask(self, table):
+        return self.match(table, tuple(self.lvs))[1] > 0
+
+
 class ParamF:
+    chunk_size = 100000  # The maximum number of substitutions created at once during enumeration
+
     def __init__(self, potential, atoms, lvs, subs=None, constrain=None):
+        """
+        Args:
+            potential: The potential function.
+            atoms: A list of atoms.
+            lvs: A list of the names of the logical variables.
+            subs: An optional array or iterable of substitutions. If it is not given, the substitutions are enumerated
+                  from the instances of the logical variables when they are first used.
+            constrain: A callable that takes a substitution and returns if it is valid, a declarative constraint
+                       (Eq, Neq, Lt or In), or a list of them. The declarative constraints are applied during
+                       enumeration, so the cross product of the instances is never created.
+        """
         self.potential = potential
         self.atoms = atoms
         self.lvs = lvs
@@ -58,32 +232,477 @@ class ParamF:
 
         self.atom_sub_idx = [[self.lv_idx[atom.terms[idx]] for idx in atom.sub_idx] for atom in atoms]
 
-        if subs is None:
-            subs = product(*[lv.instances for lv in self.lvs_])
+        if constrain is None:
+            constrain = list()
+        elif not isinstance(constrain, (list, tuple)):
+            constrain = [constrain]
+        self.constraints = [c for c in constrain if not callable(c)]
+        self.constrain = [c for c in constrain if callable(c)]
+        for c in self.constraints:
+            unknown = [lv for lv in c.lvs_(self.lv_idx) if lv not in self.lv_idx]
+            if unknown:
+                raise Exception('Constraint on unknown logical variables ' + str(unknown) + '.')
 
-        if constrain is not None:
-            subs = self.sub_filter(subs, constrain)
+        self._subs = None
+        self.given_subs = None
+        self.is_enumerated = subs is None  # If the substitutions are enumerated from the instances
+        self.indexes = dict()  # key=projected columns, value=dict of projected substitution to row ids
+        if subs is not None:
+            if not isinstance(subs, np.ndarray):
+                subs = np.array(list(subs))
+            if constrain:
+                self.given_subs = subs
+            else:
+                self._subs = subs
 
-        if isinstance(subs, np.ndarray):
-            self.subs = subs
+    @property
+    def subs(self):
+        if self._subs is None:
+            chunks = list(self.iter_subs())
+            self._subs = np.concatenate(chunks) if chunks else np.empty((0, len(self.lvs)))
+        return self._subs
+
+    @subs.setter
+    def subs(self, subs):
+        self._subs = subs
+        self.is_enumerated = False
+        self.indexes = dict()
+
+    def iter_subs(self, chunk_size=None):
+        """
+        Yield the substitutions in chunks, without materializing all of them if they are not already cached.
+
+        Args:
+            chunk_size: The maximum number of substitutions created at once, the default is ParamF.chunk_size.
+
+        Yields: (m, number of logical variables) arrays of substitutions.
+        """
+        return self.iter_shard(0, 1, chunk_size)
+
+    def iter_shard(self, k, n, chunk_size=None):
+        """
+        Yield the substitutions of the k-th of n shards, which are contiguous ranges of the substitutions, so the
+        substitutions of the shards 0 to n - 1 together are the same as iter_subs and in the same order. The shards are
+        split before the enumeration, i.e. the first steps of the enumeration plan are bound until there are at least
+        n partial substitutions, and each shard only enumerates its range of them, so n processes can enumerate the n
+        shards in parallel.
+
+        Args:
+            k: The index of the shard.
+            n: The number of shards.
+            chunk_size: The maximum number of substitutions created at once, the default is ParamF.chunk_size.
+
+        Yields: (m, number of logical variables) arrays of substitutions, the empty chunks are not yielded.
+        """
+        chunk_size = chunk_size or self.chunk_size
+
+        if self._subs is not None or self.given_subs is not None:
+            subs = self._subs if self._subs is not None else self.given_subs
+            for start in range(k * len(subs) // n, (k + 1) * len(subs) // n, chunk_size):
+                chunk = subs[start:min(start + chunk_size, (k + 1) * len(subs) // n)]
+                if self._subs is None:
+                    table = {lv: chunk[:, idx] for idx, lv in enumerate(self.lvs)}
+                    mask = np.ones(len(chunk), dtype=bool)
+                    for c in self.constraints:
+                        mask &= c.mask(table)
+                    chunk = self.sub_filter(chunk[mask])
+                if len(chunk) > 0:
+                    yield chunk
+            return
+
+        steps, filters = self.enumeration_plan()
+
+        # bind the first steps at once, they create less than n times the size of a step of partial substitutions
+        table, size, i = dict(), 1, 0
+        while i < len(steps) and size < n:
+            pieces = list(self.enumerate_subs(table, size, steps[:i + 1], filters[:i + 1], i, 2 ** 40))
+            if not pieces:
+                return
+            (table, size), i = pieces[0], i + 1
+
+        begin, end = k * size // n, (k + 1) * size // n
+        if begin == end:
+            return
+        table = {lv: column[begin:end] for lv, column in table.items()}
+
+        for table, size in self.enumerate_subs(table, end - begin, steps, filters, i, chunk_size):
+            chunk = np.stack([table[lv] for lv in self.lvs], axis=1) if self.lvs else np.empty((size, 0))
+            chunk = self.sub_filter(chunk)
+            if len(chunk) > 0:
+                yield chunk
+
+    def enumeration_plan(self):
+        """
+        Decide the order of binding the logical variables. The In constraints are joined first, then the logical
+        variables that are equal to a bound one or a constant are copied, and the rest are bound by cross product.
+        Every other constraint is applied as soon as all its logical variables are bound. The copied instances and the
+        constants are kept only if they are instances of the logical variable.
+
+        Returns: A list of steps (kind, lv or constraint, the bound lvs of a constraint, the copied lv or the
+                 constant), and a list of the filters applied after each step.
+        """
+        steps, used, bound = list(), set(), set()
+
+        for c in self.constraints:
+            if isinstance(c, In) and not set(c.lvs) <= bound:
+                steps.append(('join', c, tuple(lv for lv in c.lvs if lv in bound)))
+                used.add(id(c))
+                bound.update(c.lvs)
+
+        for lv in self.lvs:
+            if lv in bound:
+                continue
+            for c in self.constraints:
+                if type(c) is Eq and id(c) not in used:
+                    if c.lv == lv and c.is_const():
+                        # a constant that is not an instance of the logical variable has no substitution
+                        value = c.const()
+                        in_domain = value in set(self.lvs_[self.lv_idx[lv]].instances)
+                        steps.append(('const', lv, value) if in_domain else ('product', lv, np.array([])))
+                        break
+                    if c.lv == lv and c.other in bound:
+                        steps.append(('copy', lv, c.other))
+                        break
+                    if c.other == lv and c.lv in bound:
+                        steps.append(('copy', lv, c.lv))
+                        break
+            else:
+                steps.append(('product', lv, np.array(list(self.lvs_[self.lv_idx[lv]].instances))))
+                bound.add(lv)
+                continue
+            used.add(id(c))
+            bound.add(lv)
+
+        filters, bound = [list() for _ in steps], set()
+        for i, step in enumerate(steps):
+            bound.update(step[1].lvs if step[0] == 'join' else [step[1]])
+            for c in self.constraints:
+                if id(c) not in used and set(c.lvs_(self.lv_idx)) <= bound:
+                    filters[i].append(c)
+                    used.add(id(c))
+
+        if len(used) < len(self.constraints):
+            raise Exception('Constraint on unknown logical variables.')
+
+        # the copied instances that are not instances of the logical variable are removed
+        for i, (kind, lv, other) in enumerate(steps):
+            if kind == 'copy':
+                instances = self.lvs_[self.lv_idx[lv]].instances
+                if not set(self.lvs_[self.lv_idx[other]].instances) <= set(instances):
+                    filters[i].append(In([lv], [(x,) for x in instances]))
+
+        return steps, filters
+
+    def enumerate_subs(self, table, size, steps, filters, i, chunk_size):
+        # bind the logical variables of steps[i:], splitting the partial substitutions so no step creates more than
+        # chunk_size rows at once, and yield the (table, size) of the complete substitutions
+        if i == len(steps):
+            yield table, size
+            return
+
+        kind, arg, lvs = steps[i]
+        if kind == 'product':
+            count = np.full(size, len(lvs))
+        elif kind in ('copy', 'const'):
+            count = np.ones(size, dtype=np.int64)
         else:
-            self.subs = np.array(list(subs))
+            start, count = arg.match(table, lvs)
 
-    @staticmethod
-    def sub_filter(subs, constrain):
-        for sub in subs:
-            if constrain(sub):
-                yield sub
+        total = np.cumsum(count)
+        begin = 0
+        while begin < size:
+            end = max(int(np.searchsorted(total, total[begin] - count[begin] + chunk_size, side='right')), begin + 1)
+            rows = np.arange(begin, end)
+            begin = end
+
+            # expand the rows of this piece
+            if kind == 'product':
+                new_table = {lv: np.repeat(column[rows], len(lvs)) for lv, column in table.items()}
+                new_table[arg] = np.tile(lvs, len(rows))
+            elif kind == 'copy':
+                new_table = {lv: column[rows] for lv, column in table.items()}
+                new_table[arg] = table[lvs][rows]
+            elif kind == 'const':
+                new_table = {lv: column[rows] for lv, column in table.items()}
+                new_table[arg] = np.full(len(rows), lvs)
+            else:
+                left = np.repeat(rows, count[rows])
+                offset = np.arange(len(left)) - np.repeat(np.cumsum(count[rows]) - count[rows], count[rows])
+                right = arg.index(lvs)[1][start[left] + offset]
+                new_table = {lv: column[left] for lv, column in table.items()}
+                for k, lv in enumerate(arg.lvs):
+                    if lv not in new_table:
+                        new_table[lv] = arg.columns[k][right]
+
+            new_size = len(new_table[arg.lvs[0] if kind == 'join' else arg])
+            if filters[i]:
+                mask = np.ones(new_size, dtype=bool)
+                for c in filters[i]:
+                    mask &= c.mask(new_table)
+                new_table = {lv: column[mask] for lv, column in new_table.items()}
+                new_size = int(np.sum(mask))
+
+            if new_size > 0:
+                yield from self.enumerate_subs(new_table, new_size, steps, filters, i + 1, chunk_size)
+
+    def sub_filter(self, subs):
+        # apply the callable constraints to an array of substitutions
+        if not self.constrain or len(subs) == 0:
+            return subs
+        mask = np.array([all(c(sub) for c in self.constrain) for sub in map(tuple, subs.tolist())], dtype=bool)
+        return subs[mask]
+
+    def index(self, sub_idx):
+        """
+        Build (or get the cached) hash index of the substitutions projected on the given columns.
+
+        Returns: A dictionary with key=tuple of the projected substitution and value=group id, and the arrays (order,
+                 ptr), where the row ids of group k are order[ptr[k]:ptr[k + 1]].
+        """
+        sub_idx = tuple(sub_idx)
+        if sub_idx not in self.indexes:
+            subs = self.subs
+            if len(subs) == 0:
+                index = dict(), np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64)
+            elif len(sub_idx) == 0:
+                index = {(): 0}, np.arange(len(subs)), np.array([0, len(subs)])
+            else:
+                projected = subs[:, sub_idx]
+                codes = list()
+                for k in range(len(sub_idx)):
+                    _, inv = np.unique(projected[:, k], return_inverse=True)
+                    codes.append(inv.reshape(-1))
+                key = combine_codes(codes, [int(c.max()) + 1 for c in codes])
+
+                order = np.argsort(key, kind='stable')
+                key = key[order]
+                starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+                index = (
+                    dict(zip(map(tuple, projected[order[starts]].tolist()), range(len(starts)))),
+                    order,
+                    np.r_[starts, len(key)]
+                )
+            self.indexes[sub_idx] = index
+
+        return self.indexes[sub_idx]
+
+    def unified_rows(self, subs, sub_idx):
+        """
+        Find the substitutions that agree with any of the given projected substitutions, with the cost proportional to
+        the number of given substitutions.
+
+        Args:
+            subs: An iterable of tuples.
+            sub_idx: The columns of the projection.
+
+        Returns: A sorted array of row ids.
+        """
+        index, order, ptr = self.index(sub_idx)
+        groups = np.fromiter((index[sub] for sub in subs if sub in index), dtype=np.int64)
+
+        count = ptr[groups + 1] - ptr[groups]
+        offset = np.arange(np.sum(count)) - np.repeat(np.cumsum(count) - count, count)
+        return np.sort(order[np.repeat(ptr[groups], count) + offset])
 
     def unified_subs(self, subs, sub_idx, return_mask=False):
-        res = np.apply_along_axis(lambda r: tuple(r) in subs, 1, self.subs[:, sub_idx])
-        return res if return_mask else self.subs[res]
+        rows = self.unified_rows(subs, sub_idx)
+        if return_mask:
+            res = np.zeros(len(self.subs), dtype=bool)
+            res[rows] = True
+            return res
+        return self.subs[rows]
 
     def ground(self, sub):
         return [atom.ground(sub[idx]) for atom, idx in zip(self.atoms, self.atom_sub_idx)]
 
 
+class GroundedGraph:
+    """
+    The grounding of a list of parametric factors, in the form of integer arrays.
+
+    Each distinct ground atom gets an rv id, ordered by atom and then by the interned ids of its terms. The factors of
+    each parametric factor are given as a (num_subs, num_atoms) array of rv ids. The RV and F instances are only created
+    by to_graph.
+    """
+
+    def __init__(self, pf_subs):
+        """
+        Args:
+            pf_subs: A list of tuples (parametric factor, substitutions), where the substitutions are given as an array
+                     or an iterable of chunks. A chunk is an array, or a tuple from intern_locally.
+        """
+        self.pfs = [pf for pf, _ in pf_subs]
+
+        # intern all instances and constants to integers
+        self.values = list()
+        self.value_idx = dict()
+
+        # codes of the terms of the distinct ground atoms of each chunk, grouped by the atom base, and the indices of
+        # the ground atoms of the factors of the chunk in them
+        atom_codes, atom_inverse = defaultdict(list), defaultdict(list)
+        num_subs, num_chunks = list(), list()
+        for pf, subs in pf_subs:
+            rows, inverse = [list() for _ in pf.atoms], [list() for _ in pf.atoms]
+            n = 0
+            for chunk in [subs] if isinstance(subs, np.ndarray) else subs:
+                if isinstance(chunk, np.ndarray):
+                    chunk = self.intern_locally(chunk, pf)
+                values, size, atom_rows = chunk
+                value_codes = np.array([self.intern(v) for v in values], dtype=np.int64)
+                for idx, (unique, inv) in enumerate(atom_rows):
+                    rows[idx].append(value_codes[unique])
+                    inverse[idx].append(inv)
+                n += size
+            num_subs.append(n)
+            num_chunks.append(len(inverse[0]) if pf.atoms else 0)
+
+            # the constants are interned after the substitutions, so the codes do not depend on the chunks
+            for idx, atom in enumerate(pf.atoms):
+                for sub_rows, inv in zip(rows[idx], inverse[idx]):
+                    codes = np.empty((len(sub_rows), len(atom.terms)), dtype=np.int64)
+                    codes[:, atom.sub_idx] = sub_rows
+                    for term_idx, term in enumerate(atom.terms):
+                        if term_idx not in atom.sub_idx:
+                            codes[:, term_idx] = self.intern(term)
+                    atom_codes[atom.base].append(codes)
+                    atom_inverse[atom.base].append(inv)
+
+        # assign rv ids to the distinct rows of each atom base
+        self.atoms = list(atom_codes)
+        self.atom_ptr = np.zeros(len(self.atoms) + 1, dtype=np.int64)
+        self.rv_codes = list()  # The term codes of the rvs of each atom base
+        inverse = dict()
+        for i, atom in enumerate(self.atoms):
+            unique, inv = self.unique_rows(np.concatenate(atom_codes[atom]), len(self.values))
+            self.rv_codes.append(unique)
+            self.atom_ptr[i + 1] = self.atom_ptr[i] + len(unique)
+            offsets = np.cumsum([0] + [len(codes) for codes in atom_codes[atom]])
+            inverse[atom] = deque(inv[offset + local] + self.atom_ptr[i]
+                                  for offset, local in zip(offsets.tolist(), atom_inverse[atom]))
+
+        self.num_rvs = int(self.atom_ptr[-1])
+
+        # the rv ids of the neighbors of all factors
+        self.factor_nb = list()
+        for pf, n, m in zip(self.pfs, num_subs, num_chunks):
+            nb = np.empty((n, len(pf.atoms)), dtype=np.int64)
+            for idx, atom in enumerate(pf.atoms):
+                pieces = [inverse[atom.base].popleft() for _ in range(m)]
+                if pieces:
+                    nb[:, idx] = np.concatenate(pieces)
+            self.factor_nb.append(nb)
+
+        self.num_factors = sum(len(nb) for nb in self.factor_nb)
+
+    def intern(self, value):
+        if value not in self.value_idx:
+            self.value_idx[value] = len(self.values)
+            self.values.append(value)
+        return self.value_idx[value]
+
+    def intern_subs(self, subs, num_lvs):
+        # map the substitution array to the integer codes of its instances, the new instances are interned in the order
+        # of their first appearance row by row, so splitting the substitutions into chunks does not change the codes
+        subs = np.asarray(subs)
+        if len(subs) == 0 or num_lvs == 0:
+            return np.empty((len(subs), num_lvs), dtype=np.int64)
+
+        flat = subs.reshape(-1)
+        try:
+            unique, first, inv = np.unique(flat, return_index=True, return_inverse=True)
+        except TypeError:
+            # unorderable mixed instances, intern them one by one
+            return np.array([self.intern(v) for v in flat], dtype=np.int64).reshape(len(subs), num_lvs)
+
+        order = np.argsort(first)
+        codes = np.empty(len(unique), dtype=np.int64)
+        codes[order] = [self.intern(v) for v in unique[order]]
+        return codes[inv.reshape(-1)].reshape(len(subs), num_lvs)
+
+    @staticmethod
+    def intern_locally(subs, pf):
+        """
+        Intern a chunk of substitutions with its own table of values and find the distinct ground atoms of each atom
+        of the parametric factor, e.g. in a worker process. Interning the values in the order of the table later gives
+        the same codes as interning the chunk directly.
+
+        Returns: A tuple (values, number of substitutions, atom rows), where the atom rows are a tuple (distinct rows,
+                 inverse) for each atom, and the rows are the local codes of the logical variables of the atom.
+        """
+        local = GroundedGraph([])
+        codes = local.intern_subs(subs, len(pf.lvs))
+        atom_rows = [GroundedGraph.unique_rows(codes[:, sub_idx], len(local.values)) for sub_idx in pf.atom_sub_idx]
+        return local.values, len(codes), atom_rows
+
+    @staticmethod
+    def unique_rows(codes, size):
+        # distinct rows of an integer array and the inverse indices, hashing the rows to scalars when possible
+        if len(codes) == 0 or codes.shape[1] == 0:
+            return codes[:1], np.zeros(len(codes), dtype=np.int64)
+        if size ** codes.shape[1] < 2 ** 62:
+            keys = np.ravel_multi_index(codes.T, (size,) * codes.shape[1])
+            unique, idx, inv = np.unique(keys, return_index=True, return_inverse=True)
+            return codes[idx], inv.reshape(-1)
+        unique, inv = np.unique(codes, axis=0, return_inverse=True)
+        return unique, inv.reshape(-1)
+
+    def rv_atom(self, i):
+        return self.atoms[np.searchsorted(self.atom_ptr, i, side='right') - 1]
+
+    def rv_keys(self):
+        """
+        Returns: The keys (atom base, *terms) of all rvs, ordered by rv id.
+        """
+        values = np.empty(len(self.values), dtype=object)
+        values[:] = self.values
+
+        res = list()
+        for atom, codes in zip(self.atoms, self.rv_codes):
+            res.extend(zip([atom] * len(codes), *values[codes].T))
+        return res
+
+    def edges(self):
+        """
+        Returns: The integer arrays (factor, rv, position) of all edges, with the factors in the order of to_graph.
+        """
+        if not self.factor_nb:
+            return (np.empty(0, dtype=np.int64),) * 3
+
+        arity = np.concatenate([np.full(len(nb), nb.shape[1], dtype=np.int64) for nb in self.factor_nb])
+        edge_f = np.repeat(np.arange(len(arity)), arity)
+        edge_rv = np.concatenate([nb.reshape(-1) for nb in self.factor_nb])
+        edge_pos = np.concatenate([np.tile(np.arange(nb.shape[1]), len(nb)) for nb in self.factor_nb])
+
+        return edge_f, edge_rv, edge_pos
+
+    def to_graph(self, data=None):
+        """
+        Create the RV and F instances of the grounding.
+
+        Returns: The Graph instance and the dictionary of rvs, the same as RelationalGraph.ground.
+        """
+        rvs = [RV(key[0].domain, name=key) for key in self.rv_keys()]
+        rvs_dict = {rv.name: rv for rv in rvs}
+
+        rv_array = np.empty(len(rvs), dtype=object)
+        rv_array[:] = rvs
+
+        fs = list()
+        for pf, nb in zip(self.pfs, self.factor_nb):
+            fs.extend(F(potential=pf.potential, nb=row) for row in rv_array[nb].tolist())
+
+        g = Graph(rvs, fs)
+
+        if data is not None:
+            RelationalGraph.add_evidence(rvs_dict, data)
+
+        return g, rvs_dict
+
+
 class RelationalGraph:
+    shard_pfs = None  # The parametric factors being grounded by the worker processes of ground_arrays
+    shards_per_worker = 4  # The shards of a parametric factor per worker, more shards balance the uneven shards
+
     def __init__(self, parametric_factors):
         self.pfs = parametric_factors
         self.init_atom_pfs(parametric_factors)
@@ -112,69 +731,450 @@ class RelationalGraph:
                 rvs_dict[key] = res[-1]
         return res
 
-    def ground(self, data=None):
-        fs = list()
-        rvs_dict = dict()
+    @staticmethod
+    def ground_shard(job):
+        pf_idx, k, n = job
+        pf = RelationalGraph.shard_pfs[pf_idx]
+        return [GroundedGraph.intern_locally(chunk, pf) for chunk in pf.iter_shard(k, n)]
+
+    def ground_arrays(self, workers=None):
+        """
+        Ground all parametric factors without creating the RV and F instances.
+
+        Args:
+            workers: The number of processes. If it is more than 1, the substitutions of each parametric factor are
+                     split into shards (see ParamF.iter_shard), which are enumerated, filtered and interned by a pool
+                     of forked processes, and merged in the order of the shards, so the result is identical to the
+                     serial grounding.
+
+        Returns: A GroundedGraph instance.
+        """
+        if workers is None or workers <= 1:
+            return GroundedGraph([(pf, pf.iter_subs()) for pf in self.pfs])
+
+        # the forked processes read the parametric factors from the class, so the constraints need not be picklable
+        RelationalGraph.shard_pfs = self.pfs
+        n = workers * self.shards_per_worker
+        try:
+            jobs = [(pf_idx, k, n) for pf_idx in range(len(self.pfs)) for k in range(n)]
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                shards = pool.map(RelationalGraph.ground_shard, jobs, chunksize=1)
+        finally:
+            RelationalGraph.shard_pfs = None
+
+        pf_subs = list()
+        for pf_idx, pf in enumerate(self.pfs):
+            pf_subs.append((pf, [chunk for shard in shards[pf_idx * n:(pf_idx + 1) * n] for chunk in shard]))
+
+        return GroundedGraph(pf_subs)
+
+    def ground(self, data=None, workers=None):
+        return self.ground_arrays(workers).to_graph(data)
+
+    def compress(self, data=None):
+        """
+        Ground the model and compress the ground graph by color passing. If the parametric factors are symmetric (see
+        is_symmetric), the colors are computed by lifted_colors on the classes of interchangeable rvs and factors,
+        which are read from the parametric factors, so the color passing scales with the number of classes instead of
+        the number of ground factors. Otherwise, it falls back to CompressedGraph.run on the ground graph. In both
+        cases, the SuperRV and SuperF instances are only created for the final clusters, which are the same clusters as
+        CompressedGraph.run.
+
+        Returns: The CompressedGraph instance, which is already compressed, and the dictionary of rvs.
+        """
+        grounding = self.ground_arrays()
+        g, rvs_dict = grounding.to_graph(data)
+
+        compressed_g = CompressedGraph(g)
+        if not self.is_symmetric():
+            compressed_g.run()
+            return compressed_g, rvs_dict
+
+        compressed_g.stats = list()
+        rv_color, factor_color = self.lifted_colors(grounding, data, compressed_g.stats)
+        compressed_g.init_cluster_from_colors(g.rvs, rv_color, g.factors, factor_color)
+        compressed_g.update_nb()
+        compressed_g.converged = True
+        compressed_g.init_signatures(g.compile(), rv_color, factor_color)
 
-        # go through all parametric factors
+        return compressed_g, rvs_dict
+
+    def is_symmetric(self):
+        """
+        Returns: If the substitutions of every parametric factor are enumerated from the instances of its logical
+                 variables, and only constrained by Eq and Neq. Then the instances that are not mentioned by any
+                 constant or evidence can be permuted without changing the ground graph, which is required by
+                 lifted_colors.
+        """
         for pf in self.pfs:
-            for sub in pf.subs:
-                nb = self.register_rvs(pf.atoms, pf.ground(sub), rvs_dict)
-                fs.append(F(potential=pf.potential, nb=nb))
+            if not pf.is_enumerated or pf.given_subs is not None or pf.constrain:
+                return False
+            if any(type(c) not in (Eq, Neq) for c in pf.constraints):
+                return False
+            if any(len(set(lv.instances)) != len(lv.instances) for lv in pf.lvs_):
+                return False
+        return True
 
-        g = Graph(set(rvs_dict.values()), fs)
+    def distinguished_instances(self, data=None):
+        # the constants of the atoms and the constraints, and the instances of the evidence
+        res = set()
+        for pf in self.pfs:
+            for atom in pf.atoms:
+                res.update(term for idx, term in enumerate(atom.terms) if idx not in atom.sub_idx)
+            res.update(c.const() for c in pf.constraints if c.is_const())
 
-        if data is not None:
-            self.add_evidence(rvs_dict, data)
+        bases = {atom.base for pf in self.pfs for atom in pf.atoms}
+        for key in data or ():
+            if key[0] in bases:
+                res.update(key[1:])
 
-        return g, rvs_dict
+        return res
 
-    def partial_ground(self, queries, data, depth=2):
-        fs = list()
-        rvs_dict = dict()
+    @staticmethod
+    def holds(c, pattern):
+        # evaluate an Eq or Neq constraint on the symbols of a substitution pattern
+        other = ('d', c.const()) if c.is_const() else pattern[c.other]
+        return (pattern[c.lv] == other) == (type(c) is Eq)
 
-        atom_subs = defaultdict(set)
-        pf_subs_mask = defaultdict(bool)
+    @staticmethod
+    def pattern_size(symbols, class_size):
+        # the number of ground tuples of a pattern, i.e. the number of ways of giving distinct instances of its class
+        # to the distinct generic symbols
+        labels = Counter(s[1] for s in set(symbols) if s[0] == 'g')
+        res = 1
+        for c, n in labels.items():
+            res *= math.perm(class_size[c], n)
+        return res
 
-        new_atom_subs = defaultdict(set)
-        atom_obs = defaultdict(set)
+    def sub_patterns(self, pf, lv_dist, lv_classes, class_size):
+        """
+        Enumerate the substitution patterns of a parametric factor in the order of its enumeration plan. A pattern maps
+        each logical variable to a symbol, which is ('d', instance) for a distinguished instance, or ('g', class,
+        label) for any instance of a class of interchangeable instances, where the same label stands for the same
+        instance. The substitutions of a pattern form an orbit of the permutations of the classes.
 
+        Returns: A list of dictionaries with key=logical variable and value=symbol.
+        """
+        steps, filters = pf.enumeration_plan()
 
-        for key in queries:
-            new_atom_subs[key[0]].add(key[1:])
+        patterns = [dict()]
+        for (kind, lv, arg), step_filters in zip(steps, filters):
+            new_patterns = list()
+            for pattern in patterns:
+                if kind == 'product':
+                    lv_ = pf.lvs_[pf.lv_idx[lv]]
+                    options = [('d', ins) for ins in lv_dist[id(lv_)]]
+                    for c in lv_classes[id(lv_)]:
+                        labels = {s[2] for s in pattern.values() if s[0] == 'g' and s[1] == c}
+                        options.extend(('g', c, label) for label in range(len(labels)))
+                        if len(labels) < class_size[c]:
+                            options.append(('g', c, len(labels)))
+                elif kind == 'copy':
+                    options = [pattern[arg]]
+                else:
+                    options = [('d', arg)]
+
+                for s in options:
+                    new_pattern = dict(pattern)
+                    new_pattern[lv] = s
+                    if all(self.holds(c, new_pattern) for c in step_filters):
+                        new_patterns.append(new_pattern)
+            patterns = new_patterns
+
+        return patterns
+
+    def lifted_colors(self, grounding, data=None, stats=None):
+        """
+        Color passing on the quotient of the ground graph by the permutations of the interchangeable instances, i.e.
+        the instances that have the same logical variables and are not mentioned by any constant or evidence. Each
+        node of the quotient is an orbit of ground atoms or substitutions, which is read from the parametric factors
+        (see sub_patterns), and its edges are weighted by the number of ground edges of each ground atom, so the
+        refinement gives the same colors as the refinement of the ground graph. The colors are then mapped to the
+        ground graph by the orbit of each rv. It requires is_symmetric.
+
+        Args:
+            grounding: The GroundedGraph instance of the model.
+            data: The dictionary of evidence.
+            stats: An optional list, see refine_colors.
+
+        Returns: The integer arrays of the final colors of the rvs and the factors, in the order of to_graph.
+        """
+        distinguished = self.distinguished_instances(data)
+
+        # the classes of interchangeable instances are identified by the logical variables that contain them
+        lvs = list({id(lv): lv for pf in self.pfs for lv in pf.lvs_}.values())
+        membership = defaultdict(list)
+        for k, lv in enumerate(lvs):
+            for ins in lv.instances:
+                if ins not in distinguished:
+                    membership[ins].append(k)
+        class_idx, ins_class = dict(), dict()
+        for ins, ks in membership.items():
+            ins_class[ins] = class_idx.setdefault(tuple(ks), len(class_idx))
+        class_size = np.bincount(list(ins_class.values()), minlength=len(class_idx)).tolist()
+
+        lv_dist = {id(lv): [ins for ins in lv.instances if ins in distinguished] for lv in lvs}
+        lv_classes = {id(lv): sorted({ins_class[ins] for ins in lv.instances if ins not in distinguished})
+                      for lv in lvs}
+
+        # the quotient graph, an atom orbit is identified by its symbols with the labels replaced by the position of
+        # the first appearance of the symbol
+        orbit_idx, orbit_size, orbit_keys = dict(), list(), list()
+        factor_pfs, factor_size = list(), list()
+        edge_f, edge_rv, edge_pos = list(), list(), list()
+        for pf in self.pfs:
+            for pattern in self.sub_patterns(pf, lv_dist, lv_classes, class_size):
+                size = self.pattern_size(pattern.values(), class_size)
+                for pos, atom in enumerate(pf.atoms):
+                    symbols = [pattern[term] if idx in atom.sub_idx else ('d', term)
+                               for idx, term in enumerate(atom.terms)]
+                    key = (atom.base,) + tuple(
+                        s if s[0] == 'd' else ('g', s[1], symbols.index(s)) for s in symbols
+                    )
+                    if key not in orbit_idx:
+                        orbit_idx[key] = len(orbit_idx)
+                        orbit_size.append(self.pattern_size(symbols, class_size))
+                        orbit_keys.append(key)
+                    edge_f.append(len(factor_pfs))
+                    edge_rv.append(orbit_idx[key])
+                    edge_pos.append(pos)
+                factor_pfs.append(pf)
+                factor_size.append(size)
+
+        # every ground atom of an orbit has the same number of edges from the substitutions of a factor orbit
+        edge_weight = np.array([factor_size[j] // orbit_size[i] for j, i in zip(edge_f, edge_rv)], dtype=np.int64)
+        edge_f, edge_rv, edge_pos = (np.array(a, dtype=np.int64) for a in (edge_f, edge_rv, edge_pos))
+
+        # the initial colors by domain and evidence, and by potential, the same as CompressedGraph.init_colors
+        base_idx, hidden = dict(), np.ones(len(orbit_keys), dtype=bool)
+        rv_color = np.empty(len(orbit_keys), dtype=np.int64)
+        for i, key in enumerate(orbit_keys):
+            value = None
+            if data is not None and all(s[0] == 'd' for s in key[1:]):
+                value = data.get((key[0],) + tuple(s[1] for s in key[1:]))
+            hidden[i] = value is None
+            rv_color[i] = base_idx.setdefault((key[0].domain, value), len(base_idx))
 
+        potential_idx = dict()
+        factor_color = np.array(
+            [potential_idx.setdefault(pf.potential, len(potential_idx)) for pf in factor_pfs], dtype=np.int64
+        )
+
+        rv_color, _, _ = refine_colors(
+            rv_color, factor_color, edge_f, edge_rv, edge_pos, hidden, stats=stats,
+            edge_group=edge_groups(factor_pfs, edge_f, edge_pos), edge_weight=edge_weight
+        )
+
+        # map the colors of the orbits to the ground rvs by the codes of their symbols, a distinguished instance is
+        # coded by its index, and an instance of a class by the class and the position of its first appearance
+        dist_idx = {ins: k for k, ins in enumerate(distinguished)}
+        num_dist = len(dist_idx)
+        value_sym = np.array([dist_idx[v] if v in dist_idx else num_dist + ins_class[v] for v in grounding.values],
+                             dtype=np.int64)
+        size = num_dist + len(class_idx)
+
+        ground_color = np.full(grounding.num_rvs, -1, dtype=np.int64)
+        for a, (atom, codes) in enumerate(zip(grounding.atoms, grounding.rv_codes)):
+            arity = codes.shape[1]
+            orbits = [i for i, key in enumerate(orbit_keys) if key[0] is atom]
+            orbit_codes = np.array([
+                [dist_idx[s[1]] * arity if s[0] == 'd' else (num_dist + s[1]) * arity + s[2] for s in orbit_keys[i][1:]]
+                for i in orbits
+            ], dtype=np.int64).reshape(len(orbits), arity)
+
+            sym = value_sym[codes]
+            rv_codes = sym * arity
+            for j in range(arity):
+                first = np.full(len(codes), j, dtype=np.int64)
+                for k in range(j - 1, -1, -1):
+                    first[codes[:, k] == codes[:, j]] = k
+                rv_codes[:, j] += np.where(sym[:, j] >= num_dist, first, 0)
+
+            _, inv = grounding.unique_rows(np.concatenate([orbit_codes, rv_codes]), size * max(arity, 1))
+            lookup = np.full(int(inv.max(initial=-1)) + 1, -1, dtype=np.int64)
+            lookup[inv[:len(orbits)]] = rv_color[orbits]
+            ground_color[grounding.atom_ptr[a]:grounding.atom_ptr[a + 1]] = lookup[inv[len(orbits):]]
+
+        if np.any(ground_color < 0):
+            raise Exception('Ground atoms outside of the orbits of the parametric factors.')
+
+        # the factors are colored by potential and the colors of their neighbors, which are stable
+        factor_color, color_idx = list(), dict()
+        for pf, nb in zip(grounding.pfs, grounding.factor_nb):
+            if len(nb) == 0:
+                continue
+            unique, inv = grounding.unique_rows(
+                canonical_rows(ground_color[nb], pf.potential), int(ground_color.max()) + 1
+            )
+            p = potential_idx.setdefault(pf.potential, len(potential_idx))
+            ids = [color_idx.setdefault((p,) + row, len(color_idx)) for row in map(tuple, unique.tolist())]
+            factor_color.append(np.array(ids, dtype=np.int64)[inv])
+        factor_color = np.concatenate(factor_color) if factor_color else np.empty(0, dtype=np.int64)
+
+        return ground_color, factor_color
+
+    @staticmethod
+    def observed_atoms(data):
+        atom_obs = defaultdict(set)
         if data is not None:
             for key in data:
                 atom_obs[key[0]].add(key[1:])
+        return atom_obs
+
+    @staticmethod
+    def expand(new_atom_subs, atom_obs, depth, atom_subs=None):
+        """
+        Expand a frontier of ground atoms by a number of hops, the observed atoms are not expanded.
 
+        Args:
+            new_atom_subs: The frontier, a dictionary with key=atom base and value=set of ground terms.
+            atom_obs: The observed atoms, in the same form of the frontier.
+            depth: The number of hops.
+            atom_subs: The visited atoms, in the same form of the frontier. It is updated in place.
+
+        Returns: A list (one item per hop) of dictionaries with key=parametric factor and value=array of row ids, and
+                 the frontier after the last hop.
+        """
+        if atom_subs is None:
+            atom_subs = defaultdict(set)
+
+        hops = list()
         for _ in range(depth):
-            pf_temp_mask = defaultdict(bool)
+            pf_temp_rows = defaultdict(list)
 
+            # find the substitutions connected to the frontier by the hash indexes of the parametric factors
             for atom, subs in new_atom_subs.items():
                 for pf, idx in atom.pfs:
-                    mask = pf.unified_subs(subs, pf.atom_sub_idx[idx], return_mask=True)
-                    pf_temp_mask[pf] |= mask
-                    pf_subs_mask[pf] |= mask
+                    rows = pf.unified_rows(pf.atoms[idx].project(subs), pf.atom_sub_idx[idx])
+                    pf_temp_rows[pf].append(rows)
 
             new_atom_subs = defaultdict(set)
+            pf_rows = dict()
 
-            for pf, mask in pf_temp_mask.items():
+            for pf, rows in pf_temp_rows.items():
+                rows = np.unique(np.concatenate(rows))
+                pf_rows[pf] = rows
                 for idx, atom in enumerate(pf.atoms):
-                    subs = pf.subs[np.ix_(mask, pf.atom_sub_idx[idx])]
-                    new_atom_subs[atom.base].update(map(tuple, subs))
+                    subs = pf.subs[np.ix_(rows, pf.atom_sub_idx[idx])]
+                    new_atom_subs[atom.base].update(atom.ground_terms(subs))
 
             for atom in new_atom_subs:
                 new_atom_subs[atom] -= atom_subs[atom] | atom_obs[atom]
                 atom_subs[atom].update(new_atom_subs[atom])
 
-        for pf in pf_subs_mask:
-            for sub in pf.subs[pf_subs_mask[pf]]:
-                nb = self.register_rvs(pf.atoms, pf.ground(sub), rvs_dict)
-                fs.append(F(potential=pf.potential, nb=nb))
+            hops.append(pf_rows)
 
-        g = Graph(set(rvs_dict.values()), fs)
+        return hops, new_atom_subs
 
-        if data is not None:
-            self.add_evidence(rvs_dict, data)
+    @staticmethod
+    def merge_hops(hops):
+        """
+        Merge the row ids of the hops of one or more expansions.
 
-        return g, rvs_dict
+        Returns: A list of tuples (parametric factor, substitution array) for GroundedGraph.
+        """
+        pf_rows = defaultdict(list)
+        for pf_hop in hops:
+            for pf, rows in pf_hop.items():
+                pf_rows[pf].append(rows)
+
+        return [(pf, pf.subs[np.unique(np.concatenate(rows))]) for pf, rows in pf_rows.items()]
+
+    def partial_ground(self, queries, data, depth=2):
+        new_atom_subs = defaultdict(set)
+        for key in queries:
+            new_atom_subs[key[0]].add(key[1:])
+
+        hops, _ = self.expand(new_atom_subs, self.observed_atoms(data), depth)
+
+        return GroundedGraph(self.merge_hops(hops)).to_graph(data)
+
+
+class GroundingCache:
+    """
+    A cache of the query neighborhoods for repeated RelationalGraph.partial_ground calls on the same model.
+
+    The expansion of each ground query atom is cached per hop, together with its frontier, so a later query of the same
+    atom reuses it, and a query with a larger depth continues from the frontier. The entries are evicted in the least
+    recently used order when the total number of cached row ids and ground atoms exceeds max_size.
+
+    The neighborhoods depend on which atoms are observed (the observed atoms are not expanded), so the cache is cleared
+    when the set of observed atoms changes. The evidence values are applied to the graph on every call.
+    """
+
+    def __init__(self, rel_g, max_size=1000000):
+        self.rel_g = rel_g
+        self.max_size = max_size
+
+        self.entries = OrderedDict()  # key=ground atom, value=[hops, frontier, visited atoms, size]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.obs_keys = None
+        self.atom_obs = None
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.size = 0
+
+    @staticmethod
+    def entry_size(entry):
+        hops, frontier, atom_subs = entry[:3]
+        return sum(len(rows) for pf_rows in hops for rows in pf_rows.values()) + \
+            sum(len(subs) for subs in frontier.values()) + \
+            sum(len(subs) for subs in atom_subs.values())
+
+    def set_evidence(self, data):
+        keys = set(data) if data is not None else set()
+        if keys != self.obs_keys:
+            self.clear()
+            self.obs_keys = keys
+            self.atom_obs = RelationalGraph.observed_atoms(data)
+
+    def neighborhood(self, key, depth):
+        """
+        Returns: The list of the first depth hops of the expansion of the ground atom.
+        """
+        entry = self.entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            frontier = defaultdict(set)
+            frontier[key[0]].add(key[1:])
+            entry = [list(), frontier, defaultdict(set), 0]
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            self.size -= entry[3]
+
+        if len(entry[0]) < depth:
+            hops, entry[1] = RelationalGraph.expand(entry[1], self.atom_obs, depth - len(entry[0]), entry[2])
+            entry[0].extend(hops)
+
+        entry[3] = self.entry_size(entry)
+        self.entries[key] = entry
+        self.size += entry[3]
+
+        res = entry[0][:depth]
+
+        # evict the least recently used entries, but keep the current one
+        while self.size > self.max_size and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted[3]
+            self.evictions += 1
+
+        return res
+
+    def partial_ground(self, queries, data, depth=2):
+        """
+        The same as RelationalGraph.partial_ground, with the neighborhoods of the queries taken from the cache.
+        """
+        self.set_evidence(data)
+
+        hops = list()
+        for key in queries:
+            hops.extend(self.neighborhood(tuple(key), depth))
+
+        return GroundedGraph(self.rel_g.merge_hops(hops)).to_graph(data)
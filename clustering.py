@@ -0,0 +1,210 @@
+import numpy as np
+
+
+def group_indices(labels, k=None):
+    """
+    Args:
+        labels: An integer array of the cluster of each item, from 0 to k - 1.
+        k: The number of clusters, the default is the max label + 1.
+
+    Returns: A list of index arrays, the i-th array holds the indices of the items of cluster i.
+    """
+    labels = np.asarray(labels)
+    k = int(np.max(labels, initial=-1)) + 1 if k is None else k
+    order = np.argsort(labels, kind='stable')
+    bounds = np.searchsorted(labels[order], np.arange(k + 1))
+    return [order[bounds[i]:bounds[i + 1]] for i in range(k)]
+
+
+def compact_labels(labels, centroids):
+    # remove the empty clusters and renumber the labels from 0
+    used, labels = np.unique(labels, return_inverse=True)
+    return labels.reshape(-1), centroids[used]
+
+
+def weighted_unique(values, weights=None, axis=None):
+    """
+    Returns: The distinct values (sorted), the index of the distinct value of each item, and the total weight of each
+             distinct value (the number of occurrences if no weights are given).
+    """
+    x, inv = np.unique(values, return_inverse=True, axis=axis)
+    inv = inv.reshape(-1)
+    w = np.bincount(inv, weights=weights, minlength=len(x)).astype(float)
+    return x, inv, w
+
+
+def kmeans_1d(values, k, iteration=10, weights=None, centroids=None):
+    """
+    Lloyd's k-means of 1 dimensional values. The distinct values are sorted once, then in each iteration the boundaries
+    between the clusters are found by binary search, and the cluster means by prefix sums, so an iteration only costs
+    O(k log n). A value at the same distance of two centroids goes to the smaller one.
+
+    Args:
+        values: A 1 dimensional array.
+        k: The number of clusters.
+        iteration: The maximum number of iterations, it stops earlier if the centroids do not change.
+        weights: An optional array of the weight of each value.
+        centroids: The optional initial centroids, the default is k distinct values at evenly spaced ranks.
+
+    Returns: An integer array of the cluster of each value, and the sorted array of the centroids of the non-empty
+             clusters.
+    """
+    x, inv, w = weighted_unique(np.asarray(values, dtype=float), weights)
+    k = min(k, len(x))
+    if k <= 1:
+        return np.zeros(len(inv), dtype=np.int64), np.array([np.sum(w * x) / np.sum(w)]) if len(x) else np.empty(0)
+
+    if centroids is None:
+        centroids = x[np.round(np.linspace(0, len(x) - 1, k)).astype(np.int64)]
+    centroids = np.sort(np.asarray(centroids, dtype=float))
+
+    cum_w, cum_wx = np.r_[0, np.cumsum(w)], np.r_[0, np.cumsum(w * x)]
+    for _ in range(iteration):
+        bounds = np.r_[0, np.searchsorted(x, (centroids[1:] + centroids[:-1]) * 0.5, side='right'), len(x)]
+        n = cum_w[bounds[1:]] - cum_w[bounds[:-1]]
+        s = cum_wx[bounds[1:]] - cum_wx[bounds[:-1]]
+        new_centroids = np.sort(np.where(n > 0, s / np.where(n > 0, n, 1), centroids))
+        if np.array_equal(new_centroids, centroids):
+            break
+        centroids = new_centroids
+
+    labels = np.searchsorted((centroids[1:] + centroids[:-1]) * 0.5, x, side='left')
+    return compact_labels(labels[inv], centroids)
+
+
+def optimal_kmeans_1d(values, k, weights=None):
+    """
+    The optimal k-means (least squares quantization) of 1 dimensional values, by dynamic programming over the sorted
+    distinct values. The optimal split points are monotone, so each layer of the program is solved by divide and
+    conquer, with all the subproblems of the same depth computed at once, i.e. O(k n log n) in total.
+
+    Args:
+        values: A 1 dimensional array.
+        k: The number of clusters.
+        weights: An optional array of the weight of each value.
+
+    Returns: An integer array of the cluster of each value, and the sorted array of the centroids.
+    """
+    x, inv, w = weighted_unique(np.asarray(values, dtype=float), weights)
+    n = len(x)
+    k = min(k, n)
+    if k <= 1:
+        return np.zeros(len(inv), dtype=np.int64), np.array([np.sum(w * x) / np.sum(w)]) if n else np.empty(0)
+
+    cum_w, cum_wx, cum_wxx = np.r_[0, np.cumsum(w)], np.r_[0, np.cumsum(w * x)], np.r_[0, np.cumsum(w * x * x)]
+
+    def cost(i, j):
+        # the sum of squared errors of the values x[i:j], with i < j
+        s = cum_wx[j] - cum_wx[i]
+        return cum_wxx[j] - cum_wxx[i] - s * s / (cum_w[j] - cum_w[i])
+
+    # cost[m][j] is the optimal cost of the first j values in m + 1 clusters, and split[m][j] its last split point
+    prev = cost(np.zeros(n + 1, dtype=np.int64), np.arange(n + 1).clip(1))
+    prev[0] = np.inf
+    splits = list()
+    for m in range(1, k):
+        current = np.full(n + 1, np.inf)
+        split = np.zeros(n + 1, dtype=np.int64)
+
+        # the subproblems (lo, hi, opt_lo, opt_hi): find the split points of j in [lo, hi] within [opt_lo, opt_hi]
+        lo, hi = np.array([m + 1]), np.array([n])
+        opt_lo, opt_hi = np.array([m]), np.array([n - 1])
+        while len(lo) > 0:
+            mid = (lo + hi) // 2
+            top = np.minimum(mid - 1, opt_hi)
+            count = top - opt_lo + 1
+            owner = np.repeat(np.arange(len(mid)), count)
+            i = opt_lo[owner] + np.arange(np.sum(count)) - np.repeat(np.cumsum(count) - count, count)
+            total = prev[i] + cost(i, mid[owner])
+
+            # the first minimum of each subproblem
+            order = np.lexsort((total, owner))
+            first = order[np.searchsorted(owner[order], np.arange(len(mid)))]
+            current[mid], split[mid] = total[first], i[first]
+
+            left, right = lo <= mid - 1, mid + 1 <= hi
+            lo, hi, opt_lo, opt_hi = (
+                np.r_[lo[left], mid[right] + 1], np.r_[mid[left] - 1, hi[right]],
+                np.r_[opt_lo[left], split[mid[right]]], np.r_[split[mid[left]], opt_hi[right]]
+            )
+
+        prev = current
+        splits.append(split)
+
+    # trace back the boundaries of the clusters
+    bounds = [n]
+    for split in reversed(splits):
+        bounds.append(split[bounds[-1]])
+    bounds = np.array([0] + bounds[::-1])
+
+    centroids = (cum_wx[bounds[1:]] - cum_wx[bounds[:-1]]) / (cum_w[bounds[1:]] - cum_w[bounds[:-1]])
+    labels = np.searchsorted(bounds[1:], np.arange(n), side='right')
+    return labels[inv], centroids
+
+
+def quantile_bins(values, k, weights=None):
+    """
+    Split 1 dimensional values into k bins of about the same weight.
+
+    Returns: An integer array of the bin of each value, and the sorted array of the weighted means of the non-empty
+             bins.
+    """
+    x, inv, w = weighted_unique(np.asarray(values, dtype=float), weights)
+    if len(x) == 0:
+        return np.zeros(0, dtype=np.int64), np.empty(0)
+
+    # the bin of a distinct value is decided by the weight before its middle
+    cum_w = np.cumsum(w)
+    labels = np.minimum(((cum_w - w * 0.5) / cum_w[-1] * k).astype(np.int64), k - 1)
+    n = np.bincount(labels, weights=w, minlength=k)
+    centroids = np.bincount(labels, weights=w * x, minlength=k) / np.maximum(n, 1e-300)
+    return compact_labels(labels[inv], centroids)
+
+
+def kmeans(values, k, iteration=10, weights=None, centroids=None):
+    """
+    Lloyd's k-means of multi dimensional values, on the distinct values. The default initial centroids are chosen by
+    farthest point traversal, starting from the value nearest to the mean, so the result is deterministic.
+
+    Args:
+        values: A (n, d) array.
+        k: The number of clusters.
+        iteration: The maximum number of iterations, it stops earlier if the centroids do not change.
+        weights: An optional array of the weight of each value.
+        centroids: The optional (k, d) array of the initial centroids.
+
+    Returns: An integer array of the cluster of each value, and the (number of non-empty clusters, d) array of the
+             centroids.
+    """
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+    x, inv, w = weighted_unique(values, weights, axis=0)
+    k = min(k, len(x))
+    if k <= 1:
+        return np.zeros(len(inv), dtype=np.int64), (w @ x / np.sum(w))[np.newaxis] if len(x) else np.empty((0, 0))
+
+    if centroids is None:
+        mean = w @ x / np.sum(w)
+        chosen = [int(np.argmin(np.sum((x - mean) ** 2, axis=1)))]
+        distance = np.sum((x - x[chosen[0]]) ** 2, axis=1)
+        for _ in range(1, k):
+            chosen.append(int(np.argmax(distance)))
+            distance = np.minimum(distance, np.sum((x - x[chosen[-1]]) ** 2, axis=1))
+        centroids = x[chosen]
+    centroids = np.array(centroids, dtype=float)
+
+    def assign(centroids):
+        distance = np.sum(x * x, axis=1)[:, np.newaxis] - 2 * x @ centroids.T + np.sum(centroids ** 2, axis=1)
+        return np.argmin(distance, axis=1)
+
+    for _ in range(iteration):
+        labels = assign(centroids)
+        n = np.bincount(labels, weights=w, minlength=k)
+        s = np.stack([np.bincount(labels, weights=w * x[:, d], minlength=k) for d in range(x.shape[1])], axis=1)
+        new_centroids = np.where(n[:, np.newaxis] > 0, s / np.maximum(n, 1e-300)[:, np.newaxis], centroids)
+        if np.array_equal(new_centroids, centroids):
+            break
+        centroids = new_centroids
+
+    return compact_labels(assign(centroids)[inv], centroids)
@@ -100,56 +100,56 @@ pxy.set_parameters(pxy_params)
 l1_loss = list()
 l2_loss = list()
 
-for image_idx, (noisy_image, gt_image) in enumerate(zip(noisy_data, gt_data)):
-    evidence = [None] * (col * row)
-    for i in range(row):
-        for j in range(col):
-            evidence[i * col + j] = RV(domain, noisy_image[i, j])
-
-    rvs = list()
-    for _ in range(row * col):
-        rvs.append(RV(domain))
-
-    fs = list()
-
-    # create hidden-obs factors
-    for i in range(row):
-        for j in range(col):
-            fs.append(
-                F(
-                    pxo,
-                    (rvs[i * col + j], evidence[i * col + j])
-                )
+# the graph of an image is built once, and the noisy images are the evidence of the frames of a single inference
+evidence = [RV(domain, 0.) for _ in range(row * col)]
+rvs = [RV(domain) for _ in range(row * col)]
+
+fs = list()
+
+# create hidden-obs factors
+for i in range(row):
+    for j in range(col):
+        fs.append(
+            F(
+                pxo,
+                (rvs[i * col + j], evidence[i * col + j])
             )
-
-    # create hidden-hidden factors
-    for i in range(row):
-        for j in range(col - 1):
-            fs.append(
-                F(
-                    pxy,
-                    (rvs[i * col + j], rvs[i * col + j + 1])
-                )
+        )
+
+# create hidden-hidden factors
+for i in range(row):
+    for j in range(col - 1):
+        fs.append(
+            F(
+                pxy,
+                (rvs[i * col + j], rvs[i * col + j + 1])
             )
-    for i in range(row - 1):
-        for j in range(col):
-            fs.append(
-                F(
-                    pxy,
-                    (rvs[i * col + j], rvs[(i + 1) * col + j])
-                )
+        )
+for i in range(row - 1):
+    for j in range(col):
+        fs.append(
+            F(
+                pxy,
+                (rvs[i * col + j], rvs[(i + 1) * col + j])
             )
+        )
+
+g = Graph(rvs + evidence, fs)
 
-    g = Graph(rvs + evidence, fs)
+frames = np.hstack([
+    np.full((len(noisy_data), row * col), np.nan),
+    np.asarray(noisy_data, dtype=float).reshape(len(noisy_data), -1)
+])
 
-    infer = PBP(g, n=50)
-    infer.run(50, log_enable=True)
+infer = PBP(FrameGraph(g, frames), n=50)
+infer.run(50, log_enable=True)
 
+for image_idx, (noisy_image, gt_image) in enumerate(zip(noisy_data, gt_data)):
     predict_image = np.empty([row, col])
 
     for i in range(row):
         for j in range(col):
-            predict_image[i, j] = infer.map(rvs[i * col + j])
+            predict_image[i, j] = infer.map(rvs[i * col + j], image_idx)
 
     show_images([gt_image, noisy_image, predict_image])
 
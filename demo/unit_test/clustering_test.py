@@ -0,0 +1,58 @@
+from Graph import *
+from CompressedGraphWithObs import SuperRV
+from clustering import kmeans_1d, optimal_kmeans_1d, quantile_bins
+from itertools import combinations
+
+
+def sse(values, labels):
+    return sum(np.sum((values[labels == i] - np.mean(values[labels == i])) ** 2) for i in np.unique(labels))
+
+
+def brute_force_sse(values, k):
+    # try all splits of the sorted distinct values into k contiguous clusters
+    x = np.unique(values)
+    res = np.inf
+    for cuts in combinations(range(1, len(x)), k - 1):
+        bounds = np.r_[0, cuts, len(x)]
+        labels = np.searchsorted(x[bounds[1:-1]], values, side='right')
+        res = min(res, sse(values, labels))
+    return res
+
+
+np.random.seed(0)
+
+# the optimal k-means is the best split, and never worse than Lloyd's k-means
+for _ in range(20):
+    values = np.round(np.random.randn(12) * 3, 1)
+    for k in (2, 3, 4):
+        labels, centroids = kmeans_1d(values, k)
+        optimal_labels, optimal_centroids = optimal_kmeans_1d(values, k)
+        if not np.isclose(sse(values, optimal_labels), brute_force_sse(values, k)) or \
+                sse(values, optimal_labels) > sse(values, labels) + 1e-9:
+            print('wrong optimal k-means', values, k)
+
+# both methods find the clusters of well separated values
+values = np.r_[np.random.randn(50) * 0.1, 10 + np.random.randn(50) * 0.1, 20 + np.random.randn(50) * 0.1]
+labels, centroids = kmeans_1d(values, 3)
+optimal_labels, optimal_centroids = optimal_kmeans_1d(values, 3)
+print(np.allclose(centroids, optimal_centroids), np.array_equal(labels, optimal_labels), np.round(centroids))
+
+# the quantile bins are contiguous ranges of the sorted values with about the same number of values
+values = np.random.rand(1000)
+labels, centroids = quantile_bins(values, 4)
+order = np.argsort(values)
+edges = [(values[labels == i].min(), values[labels == i].max()) for i in range(4)]
+print(np.all(np.diff(labels[order]) >= 0), np.bincount(labels), np.all(np.diff(centroids) > 0))
+print(all(edges[i][1] < edges[i + 1][0] for i in range(3)), np.round(edges, 2))
+
+# the weights are taken as the numbers of occurrences
+labels, centroids = quantile_bins(np.array([0., 1., 2., 3.]), 2, weights=np.array([3., 1., 1., 1.]))
+print(labels, centroids)
+
+# splitting the evidence of a super rv with each method
+d = Domain([-5, 5], continuous=True)
+for method in ('kmeans', 'optimal', 'quantile'):
+    rvs = {RV(d, value) for value in (-3., -2.9, -3.1, 2., 2.1, 1.9)}
+    super_rv = SuperRV(rvs)
+    new_rvs = super_rv.split_by_evidence(2, 10, method)
+    print(method, sorted((len(rv.rvs), round(float(rv.value), 2)) for rv in new_rvs))
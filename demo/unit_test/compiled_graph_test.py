@@ -0,0 +1,59 @@
+from Graph import *
+from functions.Potentials import GaussianFunction
+from inferer.PBP import PBP
+from inferer.GaBP import GaBP
+
+
+d = Domain([-5, 5], continuous=True)
+
+p = GaussianFunction([0., 0.], [[2., 0.8], [0.8, 2.]])
+
+x1 = RV(d, 1.)
+x2 = RV(d)
+x3 = RV(d)
+
+f1 = F(p, nb=[x1, x2])
+f2 = F(p, nb=[x2, x3])
+f3 = F(p, nb=[x3, x1])
+
+g = Graph(rvs=[x1, x2, x3], factors=[f1, f2, f3])
+cg = g.compile()
+
+print(cg.f_ptr, cg.f_nb)
+print(cg.rv_ptr, cg.rv_nb, cg.rv_pos)
+print(cg.observed, cg.values)
+
+for batch in cg.factor_batches:
+    print(batch.potential, batch.factor_ids, batch.nb, batch.observed)
+
+infer = PBP(cg, n=20)
+infer.run(10)
+
+print(infer.map(x2), infer.map(x3))
+
+infer = GaBP(cg)
+infer.run(10)
+
+print(infer.map(x2), infer.map(x3))
+
+# on a chain with nonzero means, GaBP gives the exact conditional means of the hidden rvs given the evidence
+p = GaussianFunction([1., 2.], [[2., 0.8], [0.8, 1.5]])
+
+rvs = [RV(d, 3.), RV(d), RV(d), RV(d, -1.)]
+fs = [F(p, nb=[rvs[k], rvs[k + 1]]) for k in range(3)]
+
+# the joint precision and information vector of the product of the factors
+prec, info = np.zeros((4, 4)), np.zeros(4)
+for k in range(3):
+    a = np.linalg.inv(p.sig)
+    prec[k:k + 2, k:k + 2] += a
+    info[k:k + 2] += a @ p.mu
+
+hidden, observed = [1, 2], [0, 3]
+y = np.array([rvs[k].value for k in observed])
+exact = np.linalg.solve(prec[np.ix_(hidden, hidden)], info[hidden] - prec[np.ix_(hidden, observed)] @ y)
+
+infer = GaBP(Graph(rvs, fs))
+infer.run(10)
+
+print(np.allclose([infer.map(rvs[1]), infer.map(rvs[2])], exact), exact)
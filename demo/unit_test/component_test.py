@@ -0,0 +1,38 @@
+from Graph import *
+from functions.Potentials import GaussianFunction
+from inferer.GaBP import GaBP
+from inferer.LiftedVarInference import VarInference as LiftedVarInference
+from inferer.ComponentInference import ComponentInference
+
+
+d = Domain([-5, 5], continuous=True)
+
+p = GaussianFunction([0., 0.], [[2., 0.8], [0.8, 2.]])
+
+rvs, fs = list(), list()
+for value in (1., -1.):
+    x1 = RV(d, value)
+    x2 = RV(d)
+    x3 = RV(d)
+    rvs.extend([x1, x2, x3])
+    fs.extend([F(p, nb=[x1, x2]), F(p, nb=[x2, x3]), F(p, nb=[x3, x1])])
+
+g = Graph(rvs, fs)
+
+print([len(c.rvs) for c in g.components()], [len(c.factors) for c in g.components()])
+
+infer = GaBP(g)
+infer.run(10)
+
+print([infer.map(rv) for rv in rvs])
+
+infer = ComponentInference(g, GaBP, workers=2)
+infer.run(10)
+
+print([infer.map(rv) for rv in rvs])
+
+# the clusters of a lifted inferer are linked to the rvs of this process after the inference in the worker processes
+infer = ComponentInference(g, lambda c: LiftedVarInference(c, num_mixtures=1), workers=2)
+infer.run(10)
+
+print([infer.map(rv) for rv in rvs], all(rv.cluster is not None for rv in rvs))
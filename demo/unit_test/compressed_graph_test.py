@@ -0,0 +1,64 @@
+from Graph import *
+from CompressedGraphWithObs import CompressedGraph
+from functions.Potentials import TableFunction
+
+
+d = Domain([0, 1])
+p = TableFunction(np.array([[1., 2.], [3., 1.]]))
+
+
+def make_graph(n, edges, values):
+    rvs = [RV(d, value) for value in values]
+    return rvs, Graph(rvs, [F(p, nb=[rvs[i], rvs[j]]) for i, j in edges])
+
+
+def rv_partition(rvs, compressed_g):
+    idx = {rv: i for i, rv in enumerate(rvs)}
+    return {frozenset(idx[rv] for rv in cluster.rvs) for cluster in compressed_g.rvs}
+
+
+def refines(a, b):
+    # if each cluster of a is in a cluster of b
+    return all(any(c <= c_ for c_ in b) for c in a)
+
+
+# the clusters after adding evidence, where the update alone does not merge x4 and x5
+rvs, g = make_graph(8, [(0, 2), (6, 6), (5, 7), (4, 0)], [None] * 7 + [1])
+compressed_g = CompressedGraph(g)
+compressed_g.run()
+rvs[0].value = 1
+exact = compressed_g.update_evidence([rvs[0]])
+
+fresh_rvs, fresh_g = make_graph(8, [(0, 2), (6, 6), (5, 7), (4, 0)], [1] + [None] * 6 + [1])
+fresh = CompressedGraph(fresh_g)
+fresh.run()
+print(exact, rv_partition(rvs, compressed_g) == rv_partition(fresh_rvs, fresh))
+
+# on random graphs, the update gives the clusters of a full run whenever it is exact, and a finer lifting otherwise
+np.random.seed(0)
+num_exact, num_wrong = 0, 0
+for _ in range(200):
+    n = np.random.randint(4, 12)
+    edges = [tuple(e) for e in np.random.randint(0, n, (np.random.randint(2, 2 * n), 2)).tolist()]
+    values = [None if np.random.rand() < 0.6 else int(np.random.randint(2)) for _ in range(n)]
+
+    rvs, g = make_graph(n, edges, values)
+    compressed_g = CompressedGraph(g)
+    compressed_g.run()
+
+    for _ in range(3):
+        changed = np.random.choice(n, np.random.randint(1, 3), replace=False).tolist()
+        for i in changed:
+            values[i] = None if np.random.rand() < 0.3 else int(np.random.randint(2))
+            rvs[i].value = values[i]
+        exact = compressed_g.update_evidence([rvs[i] for i in changed])
+
+        fresh_rvs, fresh_g = make_graph(n, edges, values)
+        fresh = CompressedGraph(fresh_g)
+        fresh.run()
+
+        a, b = rv_partition(rvs, compressed_g), rv_partition(fresh_rvs, fresh)
+        num_exact += exact
+        num_wrong += (a != b) if exact else not refines(a, b)
+
+print(num_exact, num_wrong)
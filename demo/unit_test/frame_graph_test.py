@@ -0,0 +1,58 @@
+from Graph import *
+from functions.Potentials import GaussianFunction
+from inferer.PBP import PBP
+from inferer.VarInference import VarInference
+
+
+d = Domain([-5, 5], continuous=True)
+
+p = GaussianFunction([0., 0.], [[2., 0.8], [0.8, 2.]])
+
+x1 = RV(d)
+x2 = RV(d)
+x3 = RV(d)
+
+f1 = F(p, nb=[x1, x2])
+f2 = F(p, nb=[x2, x3])
+f3 = F(p, nb=[x3, x1])
+
+g = Graph(rvs=[x1, x2, x3], factors=[f1, f2, f3])
+
+# three frames of evidence, where x1 is observed in the first two frames, and x3 in the last one
+evidence = np.array([
+    [1., np.nan, np.nan],
+    [-1., np.nan, np.nan],
+    [np.nan, np.nan, 2.]
+])
+
+fg = FrameGraph(g, evidence)
+
+print(fg.f_nb, fg.rv_nb, fg.rv_pos)
+print(fg.observed, fg.values, fg.frame)
+
+for batch in fg.factor_batches:
+    print(batch.potential, batch.factor_ids, batch.nb, batch.observed)
+
+# the gradients of the frames are the gradients of the graphs with the evidence of each frame
+infer = VarInference(fg, num_mixtures=2)
+infer.compile_graph()
+infer.init_param()
+
+for t in range(3):
+    for i, rv in enumerate((x1, x2, x3)):
+        rv.value = None if np.isnan(evidence[t, i]) else evidence[t, i]
+
+    frame_infer = VarInference(g, num_mixtures=2)
+    frame_infer.compile_graph()
+    frame_infer.init_param()
+    frame_infer.w[:] = infer.w[t]
+    frame_infer.eta_c[:] = infer.eta_c[t * 3:(t + 1) * 3]
+
+    g_w, g_c, _ = infer.gradients()
+    frame_g_w, frame_g_c, _ = frame_infer.gradients()
+    print(np.max(np.abs(g_w[t] - frame_g_w)), np.max(np.abs(g_c[t * 3:(t + 1) * 3] - frame_g_c)))
+
+infer = PBP(fg, n=20)
+infer.run(10)
+
+print([[infer.map(rv, t) for rv in (x1, x2, x3)] for t in range(3)])
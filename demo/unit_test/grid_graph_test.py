@@ -0,0 +1,38 @@
+from Graph import *
+from GridGraph import GridGraph
+from functions.Potentials import GaussianFunction
+from inferer.GaBP import GaBP
+from inferer.GridGaBP import GridGaBP
+from inferer.GridPBP import GridPBP
+from inferer.GridVarInference import GridVarInference
+
+
+d = Domain([0, 1], continuous=True)
+
+pxo = GaussianFunction([0.5, 0.5], [[1., 0.5], [0.5, 1.]], eps=0.01)
+pxy = GaussianFunction([0.5, 0.5], [[1., 0.7], [0.7, 1.5]], eps=0.01)
+
+noisy_image = np.random.rand(5, 6)
+
+grid = GridGraph(d, pxo, pxy, noisy_image)
+g, rvs = grid.to_graph()
+
+infer = GaBP(g)
+infer.run(20)
+
+print(np.array([[infer.map(rv) for rv in row] for row in rvs]))
+
+infer = GridGaBP(grid)
+infer.run(20)
+
+print(infer.map_image())
+
+infer = GridPBP(grid, n=20)
+infer.run(10)
+
+print(infer.map_image(), grid.log_likelihood(infer.map_image()))
+
+infer = GridVarInference(grid, num_mixtures=2, num_quadrature_points=3)
+infer.run(100, lr=0.05, is_log=False)
+
+print(infer.map_image(), grid.log_likelihood(infer.map_image()))
@@ -0,0 +1,107 @@
+from RelationalGraph import *
+
+
+d = Domain([0, 1], continuous=False)
+
+lv_user = LV(['u1', 'u2', 'u3', 'u4', 'u5'])
+lv_movie = LV(['m1', 'm2', 'm3'])
+
+rating = Atom(d, [lv_user, lv_movie], name='rating')
+gender = Atom(d, [lv_user], name='gender')
+same_gender = Atom(d, [lv_user, lv_user], name='same_gender')
+
+f1 = ParamF(
+    'p1', atoms=[rating('U1', 'M'), rating('U2', 'M'), same_gender('U1', 'U2')], lvs=['U1', 'U2', 'M'],
+    constrain=Lt('U1', 'U2')
+)
+f2 = ParamF('p2', atoms=[gender('U'), rating('U', 'm1')], lvs=['U'])
+
+rel_g = RelationalGraph([f1, f2])
+
+grounding = rel_g.ground_arrays()
+
+print(grounding.num_rvs, grounding.num_factors)
+print(grounding.atom_ptr, [atom.name for atom in grounding.atoms])
+for pf, nb in zip(grounding.pfs, grounding.factor_nb):
+    print(pf.potential, nb)
+
+parallel_grounding = rel_g.ground_arrays(workers=2)
+
+print(all(np.array_equal(a, b) for a, b in zip(grounding.factor_nb, parallel_grounding.factor_nb)))
+
+# the shards are contiguous ranges of the substitutions, so they do not depend on the chunks
+subs = np.concatenate(list(f1.iter_subs(chunk_size=5)))
+print(np.array_equal(subs, np.concatenate([c for k in range(3) for c in f1.iter_shard(k, 3, chunk_size=7)])))
+
+ParamF.chunk_size = 7
+parallel_grounding = rel_g.ground_arrays(workers=3)
+ParamF.chunk_size = 100000
+
+print(all(np.array_equal(a, b) for a, b in zip(grounding.factor_nb, parallel_grounding.factor_nb)),
+      grounding.values == parallel_grounding.values)
+
+g, rvs_dict = rel_g.ground(data={(gender, 'u1'): 1})
+
+print(len(g.rvs), len(g.factors))
+print([rv.name[1:] for rv in g.factors[0].nb], rvs_dict[(gender, 'u1')].value)
+
+print(f1.index(f1.atom_sub_idx[0])[0])
+
+g, rvs_dict = rel_g.partial_ground(queries=[(gender, 'u1')], data={(rating, 'u2', 'm1'): 0}, depth=2)
+
+print(len(g.rvs), len(g.factors))
+
+cache = GroundingCache(rel_g, max_size=1000)
+
+for queries in ([(gender, 'u1')], [(gender, 'u1'), (gender, 'u2')], [(gender, 'u2')]):
+    g, rvs_dict = cache.partial_ground(queries=queries, data={(rating, 'u2', 'm1'): 0}, depth=2)
+    print(len(g.rvs), len(g.factors), cache.hits, cache.misses)
+
+compressed_g, rvs_dict = rel_g.compress(data={(gender, 'u1'): 1})
+
+print(len(compressed_g.rvs), len(compressed_g.factors))
+
+rvs_dict[(gender, 'u2')].value = 1
+
+print(compressed_g.update_evidence([rvs_dict[(gender, 'u2')]]), len(compressed_g.rvs), len(compressed_g.factors))
+
+# a string in a constraint is the name of a logical variable, the constants are wrapped by Const
+f3 = ParamF('p3', atoms=[rating('U', 'M')], lvs=['U', 'M'], constrain=[Eq('M', Const('m2')), Neq('U', Const('u1'))])
+
+print(f3.subs)
+
+try:
+    ParamF('p3', atoms=[rating('U', 'M')], lvs=['U', 'M'], constrain=Eq('M', 'm2'))
+except Exception as e:
+    print(e)
+
+# the constants and the copied instances that are not instances of the logical variable give no substitution
+f5 = ParamF('p5', atoms=[rating('U', 'M')], lvs=['U', 'M'], constrain=Eq('M', Const('m4')))
+
+print(f5.subs.shape, list(f5.iter_shard(1, 2)))
+
+admin = Atom(d, [LV(['u2', 'u4', 'u6'])], name='admin')
+f6 = ParamF('p6', atoms=[gender('U'), admin('V')], lvs=['U', 'V'], constrain=Eq('V', 'U'))
+
+print(f6.subs.tolist())
+
+# without the Lt constraint, the colors are computed on the orbits of the interchangeable users and movies, and give
+# the same clusters as color passing on the ground graph
+f4 = ParamF(
+    'p1', atoms=[rating('U1', 'M'), rating('U2', 'M'), same_gender('U1', 'U2')], lvs=['U1', 'U2', 'M'],
+    constrain=Neq('U1', 'U2')
+)
+
+rel_g = RelationalGraph([f4, f2])
+
+print(rel_g.is_symmetric())
+
+compressed_g, rvs_dict = rel_g.compress(data={(gender, 'u1'): 1})
+
+g, _ = rel_g.ground(data={(gender, 'u1'): 1})
+ground_compressed_g = CompressedGraph(g)
+ground_compressed_g.run()
+
+print(len(compressed_g.rvs), len(ground_compressed_g.rvs), len(compressed_g.factors), len(ground_compressed_g.factors))
+print(sorted(len(rv.rvs) for rv in compressed_g.rvs) == sorted(len(rv.rvs) for rv in ground_compressed_g.rvs))
+print(compressed_g.stats[-1]['rvs'], compressed_g.stats[0])
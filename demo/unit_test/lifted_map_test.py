@@ -0,0 +1,36 @@
+from Graph import *
+from functions.Function import Function
+from functions.Potentials import GaussianFunction
+from inferer.LiftedVarInference import VarInference as LiftedVarInference
+from inferer.C2FVarInference import VarInference as C2FVarInference
+
+
+class LabelFunction(Function):
+    # a potential of two rvs with string values that prefers equal values
+    def __call__(self, *parameters):
+        return 2. if parameters[0] == parameters[1] else 0.5
+
+
+dc = Domain([-5, 5], continuous=True)
+dl = Domain(['a', 'b', 'c'])
+di = Domain([0, 1, 2])
+
+pc = GaussianFunction([1., 1.], [[2., 0.8], [0.8, 2.]])
+pl = LabelFunction()
+
+cs = [RV(dc, 2.), RV(dc), RV(dc), RV(dc)]
+ls = [RV(dl), RV(dl), RV(dl)]
+ds = [RV(di, 1), RV(di)]
+
+fs = [F(pc, nb=[cs[0], cs[1]]), F(pc, nb=[cs[1], cs[2]]), F(pc, nb=[cs[2], cs[3]])]
+fs += [F(pl, nb=[ls[0], ls[1]]), F(pl, nb=[ls[1], ls[2]]), F(pl, nb=[ds[0], ds[1]])]
+
+# the MAP of the discrete rvs keep the type of their values, and the continuous rvs get the modes of their beliefs
+for inferer in (LiftedVarInference, C2FVarInference):
+    np.random.seed(0)
+    infer = inferer(Graph(cs + ls + ds, fs), num_mixtures=2)
+    infer.run(20, lr=0.2)
+
+    res = infer.batch_map(cs + ls + ds)
+    print(res[4:], [type(x).__name__ for x in res[7:]])
+    print(all(np.isclose(x, infer.map(rv)) for x, rv in zip(res[:4], cs)))
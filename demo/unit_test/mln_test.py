@@ -1,5 +1,5 @@
-from functions.MLNPotential import MLNPotential
-from functions.Potentials import TableFunction
+from functions.MLNPotential import MLNPotential, HMLNPotential
+from functions.Potentials import TableFunction, GaussianFunction
 from Graph import *
 from inferer.PBP import PBP
 
@@ -28,3 +28,17 @@ infer.run(3)
 
 print(infer.belief(np.array(d.values), x))
 print(infer.belief(np.array(d.values), y))
+
+# the hybrid potential has no vectorized batch_call, the default one calls it on each row
+dc = Domain([-5, 5], continuous=True)
+z = RV(dc, name='z')
+
+p_h = HMLNPotential(lambda x: x[0] == 1, [None, GaussianFunction([1.], [[1.]])], [d, dc], w=1)
+print(p_h.batch_call(np.array([[1, 0.5], [0, 0.5]])), p_h(1, 0.5), p_h(0, 0.5))
+
+g = Graph([x, y, z], [fy, f1, F(p_h, [x, z], name='fh')])
+
+infer = PBP(g, n=20)
+infer.run(3)
+
+print(infer.belief(np.array(d.values), x))
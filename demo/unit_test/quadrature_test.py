@@ -0,0 +1,55 @@
+from Graph import *
+from functions.Potentials import GaussianFunction
+from inferer.VarInference import VarInference
+from quadrature import make_rule
+from itertools import product
+
+
+def normal_moment(a):
+    # E[x ** a] of the standard normal distribution
+    return 0. if a % 2 else float(np.prod(np.arange(a - 1, 0, -2)))
+
+
+def max_error(points, weights, exponents):
+    # the largest error of the rule over the monomials with the given exponents
+    res = 0
+    for a in exponents:
+        exact = np.prod([normal_moment(k) for k in a])
+        res = max(res, abs(np.sum(weights * np.prod(points ** np.array(a), axis=1)) - exact))
+    return res
+
+
+d, n = 3, 3
+
+# the product rule is exact up to degree 2n - 1 in each variable, and the smolyak rule up to total degree 2n - 1
+points, weights = make_rule('product', d, n)
+print('product', np.sum(weights), max_error(points, weights, product(range(2 * n), repeat=d)))
+
+points, weights = make_rule('smolyak', d, n)
+print('smolyak', np.sum(weights), max_error(points, weights, [a for a in product(range(2 * n), repeat=d)
+                                                              if sum(a) <= 2 * n - 1]))
+
+# the unscented and cubature rules are exact up to total degree 3
+for name in ('unscented', 'cubature'):
+    points, weights = make_rule(name, d, n)
+    print(name, np.sum(weights), max_error(points, weights, [a for a in product(range(4), repeat=d) if sum(a) <= 3]))
+
+# the degree 2n monomials are not integrated exactly
+points, weights = make_rule('product', 1, n)
+print(max_error(points, weights, [(2 * n,)]) > 1e-6)
+
+points, weights = make_rule(('qmc', 128), d, n)
+print('qmc', np.sum(weights), len(points))
+
+# the potential evaluations of the worker processes are counted in the inferer
+dm = Domain([-5, 5], continuous=True)
+p = GaussianFunction([0., 0., 0.], np.eye(3) * 2 + 0.5)
+
+rvs = [RV(dm) for _ in range(6)]
+fs = [F(p, nb=[rvs[i], rvs[(i + 1) % 6], rvs[(i + 2) % 6]]) for i in range(6)]
+g = Graph(rvs, fs)
+
+for workers in (None, 2):
+    infer = VarInference(g, num_mixtures=2, workers=workers, quadrature_rules={3: 'smolyak'})
+    infer.run(3, lr=0.1)
+    print(workers, infer.num_evaluations, 3 * sum(infer.evaluation_cost().values()))
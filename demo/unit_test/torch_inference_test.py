@@ -0,0 +1,49 @@
+from Graph import *
+from functions.Potentials import GaussianFunction, TableFunction
+from inferer.VarInference import VarInference
+from inferer.TorchVarInference import TorchVarInference
+
+
+def max_errors(g, quadrature_rules=None):
+    # the largest differences of the gradients of the two inferers with the same parameters
+    np.random.seed(0)
+    infer = VarInference(g, num_mixtures=2, quadrature_rules=quadrature_rules)
+    infer.run(3, lr=0.2)
+
+    torch_infer = TorchVarInference(g, num_mixtures=2, quadrature_rules=quadrature_rules)
+    torch_infer.compile_graph()
+    torch_infer.init_param()
+    torch_infer.w_tau[...], torch_infer.w[...] = infer.w_tau, infer.w
+    torch_infer.eta_c[...], torch_infer.eta_d_tau[...] = infer.eta_c, infer.eta_d_tau
+    torch_infer.update_categories()
+
+    return [float(np.max(np.abs(a - b))) for a, b in zip(infer.gradients(), torch_infer.gradients())]
+
+
+dc = Domain([-5, 5], continuous=True)
+dd = Domain([0, 1, 2])
+
+pc = GaussianFunction([0., 0., 0.], np.eye(3) * 2 + 0.5)
+pd = TableFunction(np.array([[1., 2., 0.5], [2., 1., 0.5], [0.5, 0.5, 3.]]))
+pu = GaussianFunction([0.5], [[1.5]])
+
+cs = [RV(dc), RV(dc), RV(dc, 1.), RV(dc)]
+ds = [RV(dd), RV(dd, 2), RV(dd)]
+
+fs = [F(pc, nb=[cs[0], cs[1], cs[2]]), F(pc, nb=[cs[1], cs[3], cs[0]]), F(pu, nb=[cs[3]])]
+fs += [F(pd, nb=[ds[0], ds[1]]), F(pd, nb=[ds[1], ds[2]]), F(pd, nb=[ds[2], ds[0]])]
+
+g = Graph(cs + ds, fs)
+
+# the product rules, and a multivariate rule for the factors of 3 hidden continuous rvs
+print(max_errors(g))
+print(max_errors(g, {3: 'smolyak'}))
+
+# the frames of evidence, each with its own parameters
+evidence = np.array([
+    [np.nan, 1., np.nan, np.nan, np.nan, 2, np.nan],
+    [-1., np.nan, 1., np.nan, 0, np.nan, np.nan]
+])
+cs[2].value, ds[1].value = None, None
+
+print(max_errors(FrameGraph(g, evidence)))
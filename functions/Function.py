@@ -1,7 +1,13 @@
+import numpy as np
 from abc import ABC, abstractmethod
 
 
 class Function(ABC):
+    # The groups of argument positions that can be permuted without changing the function value, e.g. ((0, 1),) for
+    # a potential with f(x, y, z) = f(y, x, z). The lifted inference compresses the factors of such a potential up to
+    # the permutations of the groups, and may evaluate them with the arguments in any order within each group.
+    symmetry = None
+
     @abstractmethod
     def __call__(self, *parameters):
         """A method return a function value.
@@ -16,6 +22,19 @@ class Function(ABC):
         """
         pass
 
+    def batch_call(self, x):
+        """A method return the function values of a batch of assignments.
+
+        The subclasses should override it with a vectorized version, the default calls the function on each row.
+
+        Args:
+            x: A (n, d) array, where each row is an assignment to the parameters.
+
+        Returns: A (n,) array of function values.
+
+        """
+        return np.array([self(*row) for row in x], dtype=float).reshape(-1)
+
     def slice(self, *parameters):
         """A method that creates a slice function.
 
@@ -330,6 +330,8 @@ class ImageNodePotential(Function):
 
 
 class ImageEdgePotential(Function):
+    symmetry = ((0, 1),)
+
     def __init__(self, scaling_cof, max_threshold):
         Function.__init__(self)
         self.dimension = 2
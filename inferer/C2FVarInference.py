@@ -1,25 +1,35 @@
 from CompressedGraphWithObs import CompressedGraph
 import numpy as np
 from numpy.polynomial.hermite import hermgauss
-from scipy.optimize import minimize
 from math import sqrt, pi, e, log
 from itertools import product
 import time
 from utils import log_likelihood
-from optimization_tools import AdamOptimizer
+from optimization_tools import AdamOptimizer, ConvergenceMonitor, clusters_map
 
 
 class VarInference:
     var_threshold = 0.1
     k_mean_k = 2
     k_mean_its = 10
+    split_method = 'kmeans'  # The clustering of the evidence, see SuperRV.split_by_evidence
     update_obs_its = 10
     output_its = 0
     min_obs_var = 0
     gaussian_obs = True
 
-    def __init__(self, g, num_mixtures=5, num_quadrature_points=3):
+    def __init__(self, g, num_mixtures=5, num_quadrature_points=3, max_rounds=None, min_compression_ratio=None):
+        """
+        Args:
+            g: The Graph instance.
+            num_mixtures: The number of mixture components.
+            num_quadrature_points: The number of quadrature points of each continuous rv.
+            max_rounds: The maximum number of rounds of each color passing run.
+            min_compression_ratio: Stop color passing when the number of rvs per super rv drops below this value.
+        """
         self.g = CompressedGraph(g)
+        self.max_rounds = max_rounds
+        self.min_compression_ratio = min_compression_ratio
 
         self.K = num_mixtures
         self.T = num_quadrature_points
@@ -31,11 +41,11 @@ class VarInference:
         self.eta_tau = dict()
         self.eta = dict()  # key=rv, value={continuous eta: [k, [mu, var]], discrete eta: [k, d]}
 
-    def split_evidence(self, epsilon):
+    def split_evidence(self, epsilon, method='kmeans'):
         prev_rvs_num = -1
         while prev_rvs_num != len(self.g.rvs):
             prev_rvs_num = len(self.g.rvs)
-            self.g.split_evidence(self.k_mean_k, self.k_mean_its, epsilon)
+            self.g.split_evidence(self.k_mean_k, self.k_mean_its, epsilon, method)
 
     def split_rvs(self):
         for rv in tuple(self.g.rvs):
@@ -62,12 +72,31 @@ class VarInference:
             self.g.rvs |= new_rvs
 
     def cp_run(self):
-        prev_rvs_num = -1
+        start_time = time.time()
+        self.g.stats = [{'round': 0, 'rvs': len(self.g.rvs), 'factors': len(self.g.factors), 'time': 0}]
+
+        prev_rvs_num, rounds = -1, 0
         while prev_rvs_num != len(self.g.rvs):
+            if self.max_rounds is not None and rounds >= self.max_rounds or \
+                    self.min_compression_ratio is not None and self.g.compression_ratio < self.min_compression_ratio:
+                # approximate lifting, split the factors by the final rv clusters
+                self.g.split_factors()
+                for rv in self.g.rvs:
+                    rv.update_nb()
+                break
+
             prev_rvs_num = len(self.g.rvs)
+            rounds += 1
             self.g.split_factors()
             self.split_rvs()
 
+            self.g.stats.append({
+                'round': rounds, 'rvs': len(self.g.rvs), 'factors': len(self.g.factors),
+                'time': time.time() - start_time
+            })
+
+        self.compression_ratio = self.g.compression_ratio
+
     @staticmethod
     def norm_pdf(x, eta):
         u = (x - eta[0])
@@ -299,8 +328,29 @@ class VarInference:
         for rv, table in self.eta_tau.items():
             self.eta[rv] = self.softmax(table, 1)
 
-    def run(self, iteration=100, lr=0.1, is_log=True):
+    def parameters(self):
+        # the flat array of the parameters of the hidden super rvs and the mixture weights
+        return np.concatenate([self.w] + [self.eta[rv].ravel() for rv in self.g.rvs if rv.value is None])
+
+    def log(self):
+        # the log likelihood of the map assignment of the ground graph
+        rvs = list(self.g.g.rvs)
+        return log_likelihood(self.g.g, dict(zip(rvs, self.batch_map(rvs))))
+
+    def run(self, iteration=100, lr=0.1, is_log=False, log_every=1,
+            tol=None, patience=1, criterion='param', check_every=1):
+        """
+        Args:
+            iteration: The maximum number of iterations.
+            lr: The learning rate of Adam.
+            is_log: Record the log likelihood of the map assignment in time_log every log_every iterations.
+            log_every: The number of iterations between two records of the log likelihood.
+            tol, patience, criterion, check_every: The convergence criterion, see ConvergenceMonitor, each partial run
+                                                   between two evidence splits stops when it is converged. The values
+                                                   of the criterion are kept in self.monitor.history.
+        """
         self.is_log = is_log
+        self.log_every = log_every
 
         if self.is_log:
             self.time_log = list()
@@ -315,6 +365,7 @@ class VarInference:
         self.adam = AdamOptimizer(lr)
         self.moments = dict()
         self.t = 0
+        self.monitor = ConvergenceMonitor(criterion, tol, patience, check_every)
 
         # initial color passing run
         self.cp_run()
@@ -329,19 +380,23 @@ class VarInference:
         # Bethe iteration
         for itr in range(int(iteration / self.update_obs_its)):
             # split evidence
-            self.split_evidence(epsilon)
+            self.split_evidence(epsilon, self.split_method)
             self.cp_run()
             epsilon = max(epsilon - d, self.min_obs_var)
             print('split, num of rvs:', len(self.g.rvs))
             self.partial_run(self.update_obs_its)
 
     def partial_run(self, iteration):
+        # the super rvs are split before each partial run, so the convergence is checked from scratch
+        self.monitor.reset()
+
         for _ in range(iteration):
             start_time = time.process_time()
             self.t += 1
 
             # update parameters
-            step, moment = self.adam(self.gradient_w_tau(), self.moments.get('tau', (0, 0)), self.t)
+            gradients = [self.gradient_w_tau()]
+            step, moment = self.adam(gradients[0], self.moments.get('tau', (0, 0)), self.t)
             self.moments['tau'] = moment
             self.w_tau = self.w_tau - step
             self.w = self.softmax(self.w_tau)
@@ -349,46 +404,49 @@ class VarInference:
                 if rv.value is not None:
                     continue
                 elif rv.domain.continuous:
-                    step, moment = self.adam(self.gradient_mu_var(rv), self.moments.get(rv, (0, 0)), self.t)
+                    gradients.append(self.gradient_mu_var(rv))
+                    step, moment = self.adam(gradients[-1], self.moments.get(rv, (0, 0)), self.t)
                     self.moments[rv] = moment
                     temp = self.eta[rv] - step
                     temp[:, 1] = np.clip(temp[:, 1], a_min=self.var_threshold, a_max=np.inf)
                     self.eta[rv] = temp
                 else:
-                    step, moment = self.adam(self.gradient_category_tau(rv), self.moments.get(rv, (0, 0)), self.t)
+                    gradients.append(self.gradient_category_tau(rv))
+                    step, moment = self.adam(gradients[-1], self.moments.get(rv, (0, 0)), self.t)
                     self.moments[rv] = moment
                     temp = self.eta_tau[rv] - step
                     self.eta_tau[rv] = temp
                     self.eta[rv] = self.softmax(temp, 1)
 
+            converged = self.monitor(self.t, self, gradients)
+
             # logger
             if self.is_log:
-                current_time = time.process_time()
-                self.total_time += current_time - start_time
-                # fe = self.free_energy()
-                map_res = dict()
-                for rv in self.g.g.rvs:
-                    map_res[rv] = self.map(rv)
-                fe = log_likelihood(self.g.g, map_res)
-                print(fe, self.total_time)
-                self.time_log.append([self.total_time, fe])
+                self.total_time += time.process_time() - start_time
+                if self.t % self.log_every == 0 or converged:
+                    fe = self.log()
+                    print(fe, self.total_time)
+                    self.time_log.append([self.total_time, fe])
+
+            if converged:
+                break
 
     def belief(self, x, rv):
         return self.rvs_belief((x,), (rv.cluster,))
 
+    def batch_map(self, rvs):
+        """
+        Args:
+            rvs: A list of ground rvs.
+
+        Returns: The list of the MAP of each rv, see clusters_map.
+        """
+        return clusters_map(rvs, self.w, self.eta, self.map)
+
     def map(self, rv):
         if rv.value is None:
             if rv.domain.continuous:
-                p = dict()
-                for x in self.eta[rv.cluster][:, 0]:
-                    p[x] = self.belief(x, rv)
-                x0 = max(p.keys(), key=(lambda k: p[k]))
-
-                res = minimize(
-                    lambda val: -self.belief(val, rv),
-                    x0=np.array([x0]),
-                    options={'disp': False}
-                )['x'][0]
+                res = self.batch_map([rv])[0]
             else:
                 p = dict()
                 for x in rv.domain.values:
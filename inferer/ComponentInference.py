@@ -0,0 +1,120 @@
+import numpy as np
+import multiprocessing
+import pickle
+import io
+
+
+class SharedPickler(pickle.Pickler):
+    # pickle the objects of a list by their positions, so they are not copied but resolved in the other process
+
+    def __init__(self, file, objects):
+        pickle.Pickler.__init__(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.ids = {id(obj): idx for idx, obj in enumerate(objects)}
+
+    def persistent_id(self, obj):
+        return self.ids.get(id(obj))
+
+
+class SharedUnpickler(pickle.Unpickler):
+    def __init__(self, file, objects):
+        pickle.Unpickler.__init__(self, file)
+        self.objects = objects
+
+    def persistent_load(self, pid):
+        return self.objects[pid]
+
+
+class ComponentInference:
+    # run an inferer on each connected component of the graph independently, optionally in a pool of processes
+
+    shared = None  # The component graphs, their shared objects and the inferer factory, read by the worker processes
+
+    def __init__(self, g, inferer, workers=None):
+        """
+        Args:
+            g: The Graph instance.
+            inferer: A callable that creates an inferer from a Graph instance, e.g. an inferer class, or
+                     lambda g: VarInference(g, num_mixtures=1).
+            workers: The number of processes. If it is more than 1, the components are inferred by a pool of forked
+                     processes, otherwise they are inferred one by one in this process.
+        """
+        self.g = g
+        self.inferer = inferer
+        self.workers = workers
+
+        # the components without hidden rvs need no inference
+        self.components = [c for c in g.components() if any(rv.value is None for rv in c.rvs)]
+        self.inferers = list()
+        self.rv_inferer = dict()  # key=rv, value=the inferer of its component
+
+    @staticmethod
+    def shared_objects(g):
+        """
+        Returns: The objects that an inferer of the graph may refer to, and that exist in every forked process, i.e.
+                 the graph, its rvs, factors, potentials and domains. The potentials may be unpicklable, e.g. neural
+                 networks with lambda functions, so they are passed by reference.
+        """
+        objects = [g, g.condition_rvs] + list(g.rvs) + list(g.factors)
+        objects.extend({id(f.potential): f.potential for f in g.factors}.values())
+        objects.extend({id(rv.domain): rv.domain for rv in g.rvs}.values())
+        return objects
+
+    @staticmethod
+    def infer_component(job):
+        c, args, kwargs = job
+        components, objects, inferer = ComponentInference.shared
+
+        infer = inferer(components[c])
+        infer.run(*args, **kwargs)
+
+        # the clusters of a lifted inferer are linked from the rvs and factors, which are not copied back, so the
+        # links are sent together with the inferer
+        clusters = [getattr(obj, 'cluster', None) for obj in objects[c]]
+
+        buffer = io.BytesIO()
+        SharedPickler(buffer, objects[c]).dump((infer, clusters))
+        return buffer.getvalue()
+
+    @staticmethod
+    def load_component(res, objects):
+        # unpickle the inferer of a component, and link the rvs and factors of this process to its clusters
+        infer, clusters = SharedUnpickler(io.BytesIO(res), objects).load()
+        for obj, cluster in zip(objects, clusters):
+            if cluster is not None:
+                obj.cluster = cluster
+        return infer
+
+    def run(self, *args, **kwargs):
+        """
+        Create an inferer for each component and call its run method with the given arguments.
+        """
+        if self.workers is None or self.workers <= 1 or len(self.components) <= 1:
+            self.inferers = list()
+            for c in self.components:
+                infer = self.inferer(c)
+                infer.run(*args, **kwargs)
+                self.inferers.append(infer)
+        else:
+            # the forked processes read the components from the class, so the inferer factory need not be picklable
+            objects = [self.shared_objects(c) for c in self.components]
+            ComponentInference.shared = (self.components, objects, self.inferer)
+            try:
+                jobs = [(c, args, kwargs) for c in range(len(self.components))]
+                with multiprocessing.get_context('fork').Pool(self.workers) as pool:
+                    results = pool.map(ComponentInference.infer_component, jobs, chunksize=1)
+            finally:
+                ComponentInference.shared = None
+
+            self.inferers = [self.load_component(res, objects[c]) for c, res in enumerate(results)]
+
+        self.rv_inferer = {rv: infer for c, infer in zip(self.components, self.inferers) for rv in c.rvs}
+
+    def belief(self, x, rv):
+        if rv in self.rv_inferer:
+            return self.rv_inferer[rv].belief(x, rv)
+        return np.array(x == rv.value, dtype=float)
+
+    def map(self, rv):
+        if rv in self.rv_inferer:
+            return self.rv_inferer[rv].map(rv)
+        return rv.value
@@ -1,4 +1,5 @@
 from functions.Potentials import GaussianFunction
+import numpy as np
 from numpy import exp, Inf
 from numpy.linalg import inv
 
@@ -10,7 +11,9 @@ class GaBP:
 
     def __init__(self, g=None):
         self.g = g
-        self.message = dict()
+        self.cg = None  # The compiled view of the graph, created at the beginning of each run
+        self.message = list()  # Message (mu, sig) from factor to rv, indexed by edge id
+        self.message_rv = list()  # Message (mu, sig) from rv to factor, indexed by edge id
 
     @staticmethod
     def norm_pdf(x, mu, sig):
@@ -18,12 +21,12 @@ class GaBP:
         y = exp(-u * u * 0.5 / sig) / (2.506628274631 * sig)
         return y
 
-    def message_rv_to_f(self, rv, f):
-        if rv.value is None:
+    def message_rv_to_f(self, i, e):
+        if not self.cg.observed[i]:
             mu, sig = 0, 0
-            for nb in rv.nb:
-                if nb != f:
-                    mu_nb, sig_nb = self.message[(nb, rv)]
+            for e_ in self.cg.rv_edges(i):
+                if e_ != e:
+                    mu_nb, sig_nb = self.message[e_]
                     mu += mu_nb / sig_nb
                     sig += 1 / sig_nb
             sig = 1 / sig
@@ -32,22 +35,22 @@ class GaBP:
         else:
             return None
 
-    def message_f_to_rv(self, f, rv):
+    def message_f_to_rv(self, e):
         # only for pairwise potential
-        if rv.value is not None:
+        cg = self.cg
+        if cg.observed[cg.f_nb[e]]:
             return None
 
+        j = cg.edge_f[e]
+        f = cg.factors[j]
+
         if type(f.potential) == GaussianFunction:
             u = f.potential.mu
             a = inv(f.potential.sig)
 
-            rv_idx = 0
-            rv_ = None
-            for idx, nb in enumerate(f.nb):
-                if nb == rv:
-                    rv_idx = idx
-                else:
-                    rv_ = nb
+            rv_idx = cg.edge_pos[e]
+            e_ = cg.f_ptr[j] + 1 - rv_idx  # the edge of the other neighboring rv
+            i_ = cg.f_nb[e_]
 
             if rv_idx == 1:
                 a1, a2, a3 = a[0, 0], a[0, 1], a[1, 1]
@@ -56,14 +59,14 @@ class GaBP:
                 a1, a2, a3 = a[1, 1], a[0, 1], a[0, 0]
                 u1, u2 = u[1], u[0]
 
-            if rv_.value is None:
-                m = self.message[(rv_, f)]
+            if not cg.observed[i_]:
+                m = self.message_rv[e_]
                 a4, u3 = m[1] ** -1, m[0]
                 temp = a3 * (a4 + a1) - a2 ** 2
                 mu = a2 * a4 * (u1 - u3) / temp + u2
                 sig = (a3 - a2 ** 2 / (a4 + a1)) ** -1
             else:
-                mu = -u2 - a2 * (rv_.value - u1) / a3
+                mu = u2 - a2 * (cg.values[i_] - u1) / a3
                 sig = (a3) ** -1
 
             return mu, sig
@@ -71,41 +74,41 @@ class GaBP:
         return 0, Inf
 
     def run(self, iteration=10, log_enable=False):
+        self.cg = self.g.compile()
+        cg = self.cg
+
         # initialize message to 1 (message from f to rv)
-        for rv in self.g.rvs:
-            for f in rv.nb:
-                self.message[(f, rv)] = [0, 1]
-                self.message[(rv, f)] = [0, 1]
+        self.message = [[0, 1] for _ in range(cg.num_edges)]
+        self.message_rv = [[0, 1] for _ in range(cg.num_edges)]
 
         # BP iteration
         for i in range(iteration):
             print(f'iteration: {i + 1}')
             if log_enable:
-                time_start = time.clock()
+                time_start = time.time()
             # calculate messages from rv to f
-            for rv in self.g.rvs:
-                for f in rv.nb:
-                    self.message[(rv, f)] = self.message_rv_to_f(rv, f)
+            for e in range(cg.num_edges):
+                self.message_rv[e] = self.message_rv_to_f(cg.f_nb[e], e)
 
             if log_enable:
-                print(f'\trv to f {time.clock() - time_start}')
-                time_start = time.clock()
+                print(f'\trv to f {time.time() - time_start}')
+                time_start = time.time()
 
             if i < iteration - 1:
                 # calculate messages from f to rv
-                for f in self.g.factors:
-                    for rv in f.nb:
-                        if rv.value is None:
-                            self.message[(f, rv)] = self.message_f_to_rv(f, rv)
+                for e in np.flatnonzero(~cg.observed[cg.f_nb]):
+                    self.message[e] = self.message_f_to_rv(e)
 
                 if log_enable:
-                    print(f'\tf to rv {time.clock() - time_start}')
+                    print(f'\tf to rv {time.time() - time_start}')
+
+    def incoming_messages(self, rv):
+        return [self.message[e] for e in self.cg.rv_edges(self.cg.rv_idx[rv])]
 
     def belief(self, x, rv):
         if rv.value is None:
             mu, sig = 0, 0
-            for nb in rv.nb:
-                mu_nb, sig_nb = self.message[(nb, rv)]
+            for mu_nb, sig_nb in self.incoming_messages(rv):
                 mu += sig_nb ** -1 * mu_nb
                 sig += sig_nb ** -1
             sig = sig ** -1
@@ -117,8 +120,7 @@ class GaBP:
     def get_belief_params(self, rv):
         assert rv.value is None
         mu, sig = 0, 0
-        for nb in rv.nb:
-            mu_nb, sig_nb = self.message[(nb, rv)]
+        for mu_nb, sig_nb in self.incoming_messages(rv):
             mu += sig_nb ** -1 * mu_nb
             sig += sig_nb ** -1
         sig = sig ** -1
@@ -129,8 +131,7 @@ class GaBP:
     def map(self, rv):
         if rv.value is None:
             mu, sig = 0, 0
-            for nb in rv.nb:
-                mu_nb, sig_nb = self.message[(nb, rv)]
+            for mu_nb, sig_nb in self.incoming_messages(rv):
                 mu += sig_nb ** -1 * mu_nb
                 sig += sig_nb ** -1
             sig = sig ** -1
@@ -0,0 +1,112 @@
+from functions.Potentials import GaussianFunction
+import numpy as np
+from numpy.linalg import inv
+import time
+
+
+class GridGaBP:
+    # Gaussian belief propagation on GridGraph, with all messages of the same direction updated by array shifting
+
+    def __init__(self, g=None):
+        self.g = g
+        self.prec = None  # Precision of the messages from factor to rv, [node, left, right, up, down]
+        self.h = None  # Precision times mean of the messages from factor to rv
+
+    @staticmethod
+    def norm_pdf(x, mu, sig):
+        u = (x - mu)
+        y = np.exp(-u * u * 0.5 / sig) / (2.506628274631 * np.sqrt(sig))
+        return y
+
+    @staticmethod
+    def potential_params(potential):
+        if type(potential) is not GaussianFunction:
+            raise Exception('Cannot handle class type:' + str(type(potential)))
+        return potential.mu, inv(potential.sig)
+
+    @staticmethod
+    def pairwise_message(a, u, target, prec_in, mu_in):
+        # the message to the target argument of a pairwise gaussian potential, given the message of the other argument
+        a1, a2, a3 = a[1 - target, 1 - target], a[0, 1], a[target, target]
+        u1, u2 = u[1 - target], u[target]
+        prec = a3 - a2 ** 2 / (prec_in + a1)
+        mu = a2 * prec_in * (u1 - mu_in) / (a3 * (prec_in + a1) - a2 ** 2) + u2
+        return prec, prec * mu
+
+    def message_rv_to_f(self):
+        # compute the messages from each pixel to its 4 neighboring edge factors
+        g = self.g
+        prec_total = self.prec[0] + np.sum(self.prec[1:] * g.mask, axis=0)
+        h_total = self.h[0] + np.sum(self.h[1:] * g.mask, axis=0)
+
+        prec = prec_total - self.prec[1:]
+        mu = (h_total - self.h[1:]) / np.where(g.mask, prec, 1)
+
+        return prec, mu
+
+    def message_f_to_rv(self, prec_out, mu_out):
+        g = self.g
+
+        # node factor, with the observed pixel as the second argument
+        u, a = self.node_params
+        self.prec[0] = a[0, 0]
+        self.h[0] = a[0, 0] * (u[0] - a[0, 1] * (g.evidence - u[1]) / a[0, 0])
+
+        # edge factors, horizontal edges (left pixel, right pixel) and vertical edges (upper pixel, lower pixel)
+        u, a = self.edge_params
+        for axis, (d_first, d_second) in enumerate(((1, 0), (3, 2))):
+            first, second = g.edges(axis)
+            # message to the second pixel, arriving from the opposite of d_first
+            prec, h = self.pairwise_message(a, u, 1, prec_out[d_first][first], mu_out[d_first][first])
+            self.prec[1 + d_second][second], self.h[1 + d_second][second] = prec, h
+            # message to the first pixel
+            prec, h = self.pairwise_message(a, u, 0, prec_out[d_second][second], mu_out[d_second][second])
+            self.prec[1 + d_first][first], self.h[1 + d_first][first] = prec, h
+
+    def run(self, iteration=10, log_enable=False):
+        self.node_params = self.potential_params(self.g.node_potential)
+        self.edge_params = self.potential_params(self.g.edge_potential)
+
+        # initialize message to 1 (message from f to rv)
+        self.prec = np.ones((5,) + self.g.shape)
+        self.h = np.zeros((5,) + self.g.shape)
+
+        # BP iteration
+        for i in range(iteration):
+            print(f'iteration: {i + 1}')
+            if log_enable:
+                time_start = time.time()
+
+            prec_out, mu_out = self.message_rv_to_f()
+
+            if log_enable:
+                print(f'\trv to f {time.time() - time_start}')
+                time_start = time.time()
+
+            if i < iteration - 1:
+                self.message_f_to_rv(prec_out, mu_out)
+
+                if log_enable:
+                    print(f'\tf to rv {time.time() - time_start}')
+
+    def belief_params(self):
+        """
+        Returns: Two (row, col) arrays of the mean and the variance of the belief of each pixel.
+        """
+        prec = self.prec[0] + np.sum(self.prec[1:] * self.g.mask, axis=0)
+        h = self.h[0] + np.sum(self.h[1:] * self.g.mask, axis=0)
+        return h / prec, 1 / prec
+
+    def belief(self, x, rv):
+        mu, var = self.belief_params()
+        return self.norm_pdf(x, mu[rv], var[rv])
+
+    def map(self, rv):
+        """
+        Args:
+            rv: The (i, j) index of the pixel.
+        """
+        return self.belief_params()[0][rv]
+
+    def map_image(self):
+        return self.belief_params()[0]
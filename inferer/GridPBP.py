@@ -0,0 +1,197 @@
+import numpy as np
+from scipy.optimize import fminbound
+import time
+
+
+class GridPBP:
+    # Particle belief propagation with dynamic proposal on GridGraph, with all pixels updated by array shifting
+
+    var_threshold = 0.05
+    max_log_value = 700
+    max_batch_points = 1000000  # The maximum number of points evaluated in one potential.batch_call
+
+    def __init__(self, g=None, n=50):
+        self.g = g
+        self.n = n
+        self.message = None  # (5, row, col, n) log message from factor to rv, [node, left, right, up, down]
+        self.message_rv = None  # (4, row, col, n) log message from rv to the edge factor in each direction
+        self.x = None  # (row, col, n) sampling points of the pixels
+        self.q = None  # (mu, sig) proposal of the pixels, each with the shape of (row, col)
+
+    @staticmethod
+    def norm_pdf(x, mu, std):
+        u = (x - mu) / std
+        return np.exp(-u * u * 0.5) / (2.506628274631 * std)
+
+    def generate_sample(self):
+        mu, sig = self.q
+        return np.clip(
+            np.random.randn(*self.g.shape, self.n) * np.sqrt(sig)[..., np.newaxis] + mu[..., np.newaxis],
+            a_min=self.g.domain.values[0],
+            a_max=self.g.domain.values[1]
+        )
+
+    def initial_proposal(self):
+        self.q = (np.zeros(self.g.shape), np.ones(self.g.shape))
+
+    def important_weight(self, x):
+        mu, sig = self.q
+        values = self.g.domain.values
+        res = 1 / self.norm_pdf(x, mu[..., np.newaxis], np.sqrt(sig)[..., np.newaxis]).clip(1e-200)
+        res[x == values[0]] = 1e-200
+        res[x == values[1]] = 1e-200
+        return res
+
+    def incoming_message(self):
+        # the sum of the log messages from all neighboring factors of each pixel
+        return self.message[0] + np.sum(self.message[1:] * self.g.mask[..., np.newaxis], axis=0)
+
+    def update_proposal(self):
+        b = np.log(self.important_weight(self.x)) + self.incoming_message()
+        b = np.exp(self.batch_log_message_balance(b))
+        b /= np.sum(b, axis=-1, keepdims=True)
+
+        mu = np.sum(self.x * b, axis=-1)
+        sig = np.sum((self.x - mu[..., np.newaxis]) ** 2 * b, axis=-1)
+
+        self.q = (mu, np.maximum(sig, self.var_threshold))
+
+    def message_rv_to_f(self):
+        total = np.log(self.important_weight(self.x)) + self.incoming_message()
+        return self.batch_log_message_balance(total - self.message[1:])
+
+    def pairwise_message(self, target, x, x_other, m):
+        """
+        Compute the log messages of a batch of edge factors to the pixels at the target argument.
+
+        Args:
+            target: The argument index (0 or 1) of the receiving pixel in the edge potential.
+            x: A (..., n) array of the points of the receiving pixels.
+            x_other: A (..., n) array of the sampling points of the other pixels.
+            m: A (..., n) array of the balanced log messages from the other pixels.
+
+        Returns: A (..., n) array of log messages.
+        """
+        m = np.exp(m)[..., np.newaxis, :]
+
+        f_x = np.empty(x.shape + x_other.shape[-1:] + (2,))
+        f_x[..., target] = x[..., np.newaxis]
+        f_x[..., 1 - target] = x_other[..., np.newaxis, :]
+
+        res = self.g.edge_potential.batch_call(f_x.reshape(-1, 2)).reshape(f_x.shape[:-1])
+        res = np.sum(res * m, axis=-1)
+        res[res == 0] = np.exp(-700)
+
+        return np.log(res)
+
+    def message_f_to_rv(self, x):
+        g = self.g
+
+        # node factors, the observed pixels have no incoming messages
+        f_x = np.stack([x, np.broadcast_to(g.evidence[..., np.newaxis], x.shape)], -1)
+        res = g.node_potential.batch_call(f_x.reshape(-1, 2)).reshape(x.shape)
+        res[res == 0] = np.exp(-700)
+        self.message[0] = np.log(res)
+
+        # edge factors, horizontal edges (left pixel, right pixel) and vertical edges (upper pixel, lower pixel)
+        chunk = max(1, self.max_batch_points // (g.col * self.n * self.n))
+        for axis, (d_first, d_second) in enumerate(((1, 0), (3, 2))):
+            first, second = g.edges(axis)
+            x_first, x_second = x[first], x[second]
+            x_first_old, x_second_old = self.x[first], self.x[second]
+            m_first, m_second = self.message_rv[d_first][first], self.message_rv[d_second][second]
+
+            to_second, to_first = np.empty(x_second.shape), np.empty(x_first.shape)
+            for start in range(0, len(x_first), chunk):
+                s = slice(start, start + chunk)
+                to_second[s] = self.pairwise_message(1, x_second[s], x_first_old[s], m_first[s])
+                to_first[s] = self.pairwise_message(0, x_first[s], x_second_old[s], m_second[s])
+
+            self.message[1 + d_second][second] = to_second
+            self.message[1 + d_first][first] = to_first
+
+    def log_belief(self, x, rv):
+        """
+        Args:
+            x: A 1 dimensional array of the values of the pixel.
+            rv: The (i, j) index of the pixel.
+        """
+        g = self.g
+        i, j = rv
+
+        res = g.node_potential.batch_call(np.stack([x, np.full(len(x), g.evidence[i, j])], -1))
+        res[res == 0] = np.exp(-700)
+        res = np.log(res)
+
+        for d, (di, dj) in enumerate(g.directions):
+            if g.mask[d, i, j]:
+                # the neighbor is the first argument of the edge if it is on the left or up side
+                target = 1 if d in (0, 2) else 0
+                nb = (i + di, j + dj)
+                res += self.pairwise_message(target, x, self.x[nb], self.message_rv[g.opposite[d]][nb])
+
+        return res
+
+    def batch_log_message_balance(self, m):
+        # balance the log messages along the last axis independently
+        mean_m = np.mean(m, axis=-1, keepdims=True)
+        max_m = np.max(m, axis=-1, keepdims=True)
+
+        shift = np.where(max_m - mean_m > self.max_log_value, max_m - self.max_log_value, mean_m)
+
+        return m - shift
+
+    def run(self, iteration=10, log_enable=False):
+        if not self.g.domain.continuous:
+            raise Exception('GridPBP only supports continuous pixels')
+
+        self.initial_proposal()
+        self.x = self.generate_sample()
+
+        # Message initialization
+        self.message = np.zeros((5,) + self.g.shape + (self.n,))
+        self.message_rv = np.zeros((4,) + self.g.shape + (self.n,))
+
+        # BP iteration
+        for i in range(iteration):
+            print(f'iteration: {i + 1}')
+            if log_enable:
+                time_start = time.time()
+
+            # Compute messages from rv to f
+            self.message_rv = self.message_rv_to_f()
+
+            if log_enable:
+                print(f'\trv to f {time.time() - time_start}')
+                time_start = time.time()
+
+            if i < iteration - 1:
+                self.update_proposal()
+
+                if log_enable:
+                    print(f'\tproposal {time.time() - time_start}')
+
+                x_new = self.generate_sample()
+
+                # Compute messages from f to rv
+                self.message_f_to_rv(x_new)
+
+                self.x = x_new
+
+                if log_enable:
+                    print(f'\tf to rv {time.time() - time_start}')
+                    time_start = time.time()
+
+    def map(self, rv):
+        return fminbound(
+            lambda x: -np.squeeze(self.log_belief(x.reshape(-1), rv)),
+            self.g.domain.values[0], self.g.domain.values[1],
+            disp=False
+        )
+
+    def map_image(self):
+        """
+        Returns: A (row, col) array of the sampling points with the highest belief of each pixel.
+        """
+        b = self.incoming_message()
+        return np.take_along_axis(self.x, np.argmax(b, axis=-1)[..., np.newaxis], -1)[..., 0]
@@ -0,0 +1,188 @@
+import numpy as np
+from numpy.polynomial.hermite import hermgauss
+from math import sqrt, pi, e
+import time
+from optimization_tools import AdamOptimizer, gaussian_mixture_map
+
+
+class GridVarInference:
+    # mixture variational inference on GridGraph, the same updates of VarInference computed for all pixels at once
+    var_threshold = 0.01
+    max_batch_points = 1000000  # The maximum number of points evaluated in one potential.batch_call
+
+    def __init__(self, g, num_mixtures=5, num_quadrature_points=3):
+        self.g = g
+
+        self.K = num_mixtures
+        self.T = num_quadrature_points
+        self.quad_x, self.quad_w = hermgauss(self.T)
+        self.quad_w /= sqrt(pi)
+
+        self.w_tau = np.zeros(self.K)
+        self.w = np.zeros(self.K)
+        self.eta = None  # (row, col, k, [mu, var])
+
+    @staticmethod
+    def norm_pdf(x, eta):
+        u = (x - eta[0])
+        y = np.exp(-u * u * 0.5 / eta[1]) / (2.5066282746310002 * np.sqrt(eta[1]))
+        return y
+
+    @staticmethod
+    def softmax(x, axis=0):
+        res = e ** x
+        if axis == 0:
+            return res / np.sum(res, 0)
+        else:
+            return res / np.sum(res, 1)[:, np.newaxis]
+
+    def batch_call(self, potential, x):
+        # evaluate the potential on a (..., arity) array of points, in chunks of at most max_batch_points
+        shape, x = x.shape[:-1], x.reshape(-1, x.shape[-1])
+        res = np.empty(len(x))
+        for start in range(0, len(x), self.max_batch_points):
+            res[start:start + self.max_batch_points] = potential.batch_call(x[start:start + self.max_batch_points])
+        return res.reshape(shape)
+
+    def quadrature(self):
+        """
+        Returns: The (row, col, k, T) quadrature points of each mixture component, and the (row, col, k, T, k)
+                 densities of all mixture components on the points.
+        """
+        eta = self.eta
+        x = np.sqrt(2 * eta[..., 1])[..., np.newaxis] * self.quad_x + eta[..., 0][..., np.newaxis]
+        density = self.norm_pdf(
+            x[..., np.newaxis],
+            (eta[:, :, np.newaxis, np.newaxis, :, 0], eta[:, :, np.newaxis, np.newaxis, :, 1])
+        )
+        return x, density
+
+    def expectation_terms(self):
+        """
+        Compute the integrands of the free energy on the quadrature points.
+
+        Returns: A (row, col, k, T) array of the integrand of each pixel, where the terms of the neighboring factors
+                 are already integrated over the other pixel, and a (k,) array of the expectation of the whole free
+                 energy (without the minus sign) under each mixture component.
+        """
+        g, qw = self.g, self.quad_w
+        x, density = self.quadrature()
+        b = density @ self.w
+
+        # rv terms and node factors, the observed pixels have N = 1 so they have no rv term
+        y = np.broadcast_to(g.evidence[:, :, np.newaxis, np.newaxis], x.shape)
+        node = np.log(self.batch_call(g.node_potential, np.stack([x, y], -1)) + 1e-100)
+        a = (g.N - 1)[:, :, np.newaxis, np.newaxis] * np.log(b + 1e-100) + node - np.log(b + 1e-100)
+        energy = np.einsum('ijkt,t->k', a, qw)
+
+        # edge factors, evaluated on the T x T grid of each pair of neighboring pixels
+        for axis in (0, 1):
+            first, second = g.edges(axis)
+            xp, xq = x[first], x[second]
+            points = np.stack(np.broadcast_arrays(xp[..., :, np.newaxis], xq[..., np.newaxis, :]), -1)
+            b_edge = np.einsum('ijktl,ijksl,l->ijkts', density[first], density[second], self.w)
+            f = np.log(self.batch_call(g.edge_potential, points) + 1e-100) - np.log(b_edge + 1e-100)
+
+            energy += np.einsum('ijkts,t,s->k', f, qw, qw)
+            a[first] += f @ qw
+            a[second] += np.einsum('ijkts,t->ijks', f, qw)
+
+        return a, energy
+
+    def gradient_w_tau(self):
+        return self.gradients()[0]
+
+    def gradient_mu_var(self):
+        return self.gradients()[1]
+
+    def gradients(self):
+        """
+        Compute the gradients of all parameters from a single evaluation of the potentials on the quadrature points.
+
+        Returns: The (k,) gradient of w_tau, and the (row, col, k, 2) gradients of the means and the variances.
+        """
+        a, energy = self.expectation_terms()
+        x, _ = self.quadrature()
+
+        g_w = -energy
+        g_w_tau = self.w * (g_w - np.sum(g_w * self.w))
+
+        mu, var = self.eta[..., 0], self.eta[..., 1]
+        u = x - mu[..., np.newaxis]
+        g_mu_var = np.empty(self.eta.shape)
+        g_mu_var[..., 0] = -(a * u) @ self.quad_w / var
+        g_mu_var[..., 1] = -(a * (u ** 2 - var[..., np.newaxis])) @ self.quad_w / (2 * var ** 2)
+
+        return g_w_tau, g_mu_var
+
+    def free_energy(self):
+        _, energy = self.expectation_terms()
+        return -np.sum(self.w * energy)
+
+    def init_param(self):
+        if not self.g.domain.continuous:
+            raise Exception('GridVarInference only supports continuous pixels')
+
+        self.w_tau = np.zeros(self.K)
+        self.eta = np.ones(self.g.shape + (self.K, 2))
+        self.eta[..., 0] = np.random.uniform(*self.g.domain.values, size=self.g.shape + (self.K,))
+
+        self.w = self.softmax(self.w_tau)
+
+    def run(self, iteration=100, lr=0.1, is_log=False):
+        if is_log:
+            self.time_log = list()
+            self.total_time = 0
+
+        self.init_param()
+
+        adam = AdamOptimizer(lr)
+        moments = dict()
+
+        for t in range(1, iteration + 1):
+            start_time = time.process_time()
+
+            # update all parameters at once, from the gradients of a single evaluation of the potentials
+            g_w_tau, g_mu_var = self.gradients()
+
+            step, moment = adam(g_w_tau, moments.get('tau', (0, 0)), t)
+            moments['tau'] = moment
+            self.w_tau = self.w_tau - step
+            self.w = self.softmax(self.w_tau)
+
+            step, moment = adam(g_mu_var, moments.get('eta', (0, 0)), t)
+            moments['eta'] = moment
+            temp = self.eta - step
+            temp[..., 1] = np.clip(temp[..., 1], a_min=self.var_threshold, a_max=np.inf)
+            self.eta = temp
+
+            # logger
+            if is_log:
+                current_time = time.process_time()
+                self.total_time += current_time - start_time
+                fe = self.g.log_likelihood(self.map_image())
+                print(fe, self.total_time)
+                self.time_log.append([self.total_time, fe])
+
+    def belief(self, x, rv):
+        """
+        Args:
+            x: The value of the pixel.
+            rv: The (i, j) index of the pixel.
+        """
+        eta = self.eta[rv]
+        return np.sum(self.w * self.norm_pdf(x, (eta[:, 0], eta[:, 1])))
+
+    def map(self, rv):
+        return self.map_image()[rv]
+
+    def map_image(self, iteration=100, tol=1e-8):
+        """
+        Find the modes of the mixture beliefs of all pixels at once, see gaussian_mixture_map.
+
+        Returns: A (row, col) array of the MAP of the pixels.
+        """
+        mu, var = self.eta[..., 0], self.eta[..., 1]
+        return gaussian_mixture_map(
+            self.w, mu.reshape(-1, self.K), var.reshape(-1, self.K), iteration, tol
+        ).reshape(mu.shape[:-1])
@@ -1,20 +1,27 @@
 from CompressedGraphWithObs import CompressedGraph
 import numpy as np
 from numpy.polynomial.hermite import hermgauss
-from scipy.optimize import minimize
 from math import sqrt, pi, e, log
 from itertools import product
 import time
 from utils import log_likelihood
-from optimization_tools import AdamOptimizer
+from optimization_tools import AdamOptimizer, ConvergenceMonitor, clusters_map
 
 
 class VarInference:
     var_threshold = 0.1
 
-    def __init__(self, g, num_mixtures=5, num_quadrature_points=3):
+    def __init__(self, g, num_mixtures=5, num_quadrature_points=3, max_rounds=None, min_compression_ratio=None):
+        """
+        Args:
+            g: The Graph instance.
+            num_mixtures: The number of mixture components.
+            num_quadrature_points: The number of quadrature points of each continuous rv.
+            max_rounds: The maximum number of rounds of color passing, see CompressedGraph.run.
+            min_compression_ratio: Stop color passing when the number of rvs per super rv drops below this value.
+        """
         self.g = CompressedGraph(g)
-        self.g.run()
+        self.compression_ratio = self.g.run(max_rounds, min_compression_ratio)
 
         self.K = num_mixtures
         self.T = num_quadrature_points
@@ -236,7 +243,27 @@ class VarInference:
         for rv, table in self.eta_tau.items():
             self.eta[rv] = self.softmax(table, 1)
 
-    def run(self, iteration=100, lr=0.1, is_log=True):
+    def parameters(self):
+        # the flat array of the parameters of the hidden super rvs and the mixture weights
+        return np.concatenate([self.w] + [self.eta[rv].ravel() for rv in self.g.rvs if rv.value is None])
+
+    def log(self):
+        # the log likelihood of the map assignment of the ground graph
+        rvs = list(self.g.g.rvs)
+        return log_likelihood(self.g.g, dict(zip(rvs, self.batch_map(rvs))))
+
+    def run(self, iteration=100, lr=0.1, is_log=False, log_every=1,
+            tol=None, patience=1, criterion='param', check_every=1):
+        """
+        Args:
+            iteration: The maximum number of iterations.
+            lr: The learning rate of Adam.
+            is_log: Record the log likelihood of the map assignment in time_log every log_every iterations.
+            log_every: The number of iterations between two records of the log likelihood.
+            tol, patience, criterion, check_every: The convergence criterion, see ConvergenceMonitor, the run stops
+                                                   when it is converged. The values of the criterion are kept in
+                                                   self.monitor.history.
+        """
         if is_log:
             self.time_log = list()
             self.total_time = 0
@@ -246,12 +273,14 @@ class VarInference:
 
         adam = AdamOptimizer(lr)
         moments = dict()
+        self.monitor = ConvergenceMonitor(criterion, tol, patience, check_every)
 
         for t in range(1, iteration + 1):
             start_time = time.process_time()
 
             # update parameters
-            step, moment = adam(self.gradient_w_tau(), moments.get('tau', (0, 0)), t)
+            gradients = [self.gradient_w_tau()]
+            step, moment = adam(gradients[0], moments.get('tau', (0, 0)), t)
             moments['tau'] = moment
             self.w_tau = self.w_tau - step
             self.w = self.softmax(self.w_tau)
@@ -259,46 +288,50 @@ class VarInference:
                 if rv.value is not None:
                     continue
                 elif rv.domain.continuous:
-                    step, moment = adam(self.gradient_mu_var(rv), moments.get(rv, (0, 0)), t)
+                    gradients.append(self.gradient_mu_var(rv))
+                    step, moment = adam(gradients[-1], moments.get(rv, (0, 0)), t)
                     moments[rv] = moment
                     temp = self.eta[rv] - step
                     temp[:, 1] = np.clip(temp[:, 1], a_min=self.var_threshold, a_max=np.inf)
                     self.eta[rv] = temp
                 else:
-                    step, moment = adam(self.gradient_category_tau(rv), moments.get(rv, (0, 0)), t)
+                    gradients.append(self.gradient_category_tau(rv))
+                    step, moment = adam(gradients[-1], moments.get(rv, (0, 0)), t)
                     moments[rv] = moment
                     temp = self.eta_tau[rv] - step
                     self.eta_tau[rv] = temp
                     self.eta[rv] = self.softmax(temp, 1)
 
+            self.iterations = t
+            converged = self.monitor(t, self, gradients)
+
             # logger
             if is_log:
-                current_time = time.process_time()
-                self.total_time += current_time - start_time
-                # fe = self.free_energy()
-                map_res = dict()
-                for rv in self.g.g.rvs:
-                    map_res[rv] = self.map(rv)
-                fe = log_likelihood(self.g.g, map_res)
-                print(fe, self.total_time)
-                self.time_log.append([self.total_time, fe])
+                self.total_time += time.process_time() - start_time
+                if t % log_every == 0 or converged or t == iteration:
+                    fe = self.log()
+                    print(fe, self.total_time)
+                    self.time_log.append([self.total_time, fe])
+
+            if converged:
+                break
 
     def belief(self, x, rv):
         return self.rvs_belief((x,), (rv.cluster,))
 
+    def batch_map(self, rvs):
+        """
+        Args:
+            rvs: A list of ground rvs.
+
+        Returns: The list of the MAP of each rv, see clusters_map.
+        """
+        return clusters_map(rvs, self.w, self.eta, self.map)
+
     def map(self, rv):
         if rv.value is None:
             if rv.domain.continuous:
-                p = dict()
-                for x in self.eta[rv.cluster][:, 0]:
-                    p[x] = self.belief(x, rv)
-                x0 = max(p.keys(), key=(lambda k: p[k]))
-
-                res = minimize(
-                    lambda val: -self.belief(val, rv),
-                    x0=np.array([x0]),
-                    options={'disp': False}
-                )['x'][0]
+                res = self.batch_map([rv])[0]
             else:
                 p = dict()
                 for x in rv.domain.values:
@@ -1,3 +1,4 @@
+from Graph import FactorBatch
 import numpy as np
 from scipy.optimize import fminbound
 from itertools import product
@@ -9,83 +10,135 @@ class PBP:
 
     var_threshold = 0.05
     max_log_value = 700
+    max_batch_points = 1000000  # The maximum number of points evaluated in one potential.batch_call
 
     def __init__(self, g=None, n=50):
+        """
+        Args:
+            g: The Graph instance, or a FrameGraph to run all its frames together.
+            n: The number of particles of each continuous rv.
+        """
         self.g = g
         self.n = n
-        self.message = dict()  # Log message, message in log space
-        self.x = dict()  # Sampling points for continuous variables, and domain points for discrete variables
-        self.q = dict()  # Proposal of variable
+        self.cg = None  # The compiled view of the graph, created at the beginning of each run
+        self.message = list()  # Log message from factor to rv, indexed by edge id
+        self.message_rv = list()  # Log message from rv to factor, indexed by edge id
+        self.x = list()  # Sampling points for continuous variables, and domain points for discrete variables
+        self.q = list()  # Proposal of variable
 
     @staticmethod
     def norm_pdf(x, mu, std):
         u = (x - mu) / std
         return np.exp(-u * u * 0.5) / (2.506628274631 * std)
 
+    def hidden_rvs(self):
+        return np.flatnonzero(~self.cg.observed)
+
     def generate_sample(self):
-        x = dict()
-        for rv in self.g.rvs:
-            if rv.value is None:
-                if rv.domain.continuous:
-                    mu, sig = self.q[rv]
-                    x[rv] = np.clip(
-                        np.random.randn(self.n) * np.sqrt(sig) + mu,
-                        a_min=rv.domain.values[0],
-                        a_max=rv.domain.values[1]
-                    )
-                else:
-                    x[rv] = np.array(rv.domain.values)
+        # the particles of all hidden continuous rvs are drawn at once, in the order of their ids
+        x = [None] * self.cg.num_rvs
+        ids = self.hidden_continuous
+        if len(ids) > 0:
+            mu, sig = np.array([self.q[i] for i in ids]).T
+            sample = np.clip(
+                np.random.randn(len(ids), self.n) * np.sqrt(sig)[:, np.newaxis] + mu[:, np.newaxis],
+                a_min=self.lower[ids, np.newaxis],
+                a_max=self.upper[ids, np.newaxis]
+            )
+            for i, x_ in zip(ids, sample):
+                x[i] = x_
+        for i in self.hidden_rvs():
+            if not self.cg.continuous[i]:
+                x[i] = np.array(self.cg.rvs[i].domain.values)
         return x
 
     def initial_proposal(self):
-        for rv in self.g.rvs:
-            if rv.value is None:
-                self.q[rv] = (0, 1)
+        self.q = [None] * self.cg.num_rvs
+        for i in self.hidden_rvs():
+            self.q[i] = (0, 1)
 
     def update_proposal(self):
-        for rv in self.g.rvs:
-            if rv.value is None and rv.domain.continuous:
-                x = self.x[rv]
+        ids = self.hidden_continuous
+        if len(ids) == 0:
+            return
+        x = np.stack([self.x[i] for i in ids])
 
-                b = np.log(self.important_weight(x, rv))
-                for nb in rv.nb:
-                    b += self.message[(nb, rv)]
-                b, _ = self.log_message_balance(b)
-                b = np.exp(b)
-                b /= np.sum(b)
+        _, _, _, b = self.incoming_messages(ids)
+        b = np.exp(self.batch_log_message_balance(np.log(self.batch_important_weight(x, ids)) + b))
+        b /= np.sum(b, axis=1, keepdims=True)
 
-                mu = np.sum(x * b)
-                sig = np.sum((x - mu) ** 2 * b)
+        mu = np.sum(x * b, axis=1)
+        sig = np.sum((x - mu[:, np.newaxis]) ** 2 * b, axis=1)
 
-                self.q[rv] = (mu, max(sig, self.var_threshold))
+        for i, mu_, sig_ in zip(ids, mu, sig):
+            self.q[i] = (mu_, max(sig_, self.var_threshold))
 
-    def important_weight(self, x, rv):
-        mu, sig = self.q[rv]
+    def important_weight(self, x, i):
+        mu, sig = self.q[i]
+        values = self.cg.rvs[i].domain.values
         res = 1 / self.norm_pdf(x, mu, np.sqrt(sig)).clip(1e-200)
-        res[x == rv.domain.values[0]] = 1e-200
-        res[x == rv.domain.values[1]] = 1e-200
+        res[x == values[0]] = 1e-200
+        res[x == values[1]] = 1e-200
         return res
 
-    def message_rv_to_f(self, x, rv, f):
-        res = np.log(self.important_weight(x, rv)) if rv.domain.continuous else np.zeros(x.shape)
-        for nb in rv.nb:
-            if nb != f:
-                res += self.message[(nb, rv)]
+    def batch_important_weight(self, x, ids):
+        # the important weights of the (m, n) particles x of the continuous rvs ids
+        mu, sig = np.array([self.q[i] for i in ids]).T
+        res = 1 / self.norm_pdf(x, mu[:, np.newaxis], np.sqrt(sig)[:, np.newaxis]).clip(1e-200)
+        res[x == self.lower[ids, np.newaxis]] = 1e-200
+        res[x == self.upper[ids, np.newaxis]] = 1e-200
         return res
 
-    def message_f_to_rv(self, x, f, rv):
-        rv_idx = f.nb.index(rv)
+    def incoming_messages(self, ids):
+        """
+        Args:
+            ids: An array of m hidden rv ids with the same number of sampling points s.
+
+        Returns: The edges of the rvs, the row of the rv of each edge, the (num_edges, s) array of the messages from
+                 the factors of the edges, and the (m, s) array of the sum of the messages to each rv.
+        """
+        cg = self.cg
+        counts = cg.N[ids]
+        offset = np.arange(int(np.sum(counts))) - np.repeat(np.cumsum(counts) - counts, counts)
+        edges = cg.rv_edge[np.repeat(cg.rv_ptr[ids], counts) + offset]
+        rows = np.repeat(np.arange(len(ids)), counts)
+
+        s = self.sample_size[ids[0]]
+        m = np.stack([self.message[e] for e in edges]) if len(edges) else np.zeros((0, s))
+        total = np.zeros((len(ids), s))
+        np.add.at(total, rows, m)
+        return edges, rows, m, total
+
+    def batch_message_rv_to_f(self, ids):
+        # compute the messages from a group of hidden rvs with the same layout to all their factors
+        edges, rows, m, total = self.incoming_messages(ids)
+        if len(edges) == 0:
+            return
+
+        if self.cg.continuous[ids[0]]:
+            x = np.stack([self.x[i] for i in ids])
+            total = total + np.log(self.batch_important_weight(x, ids))
+
+        res = self.batch_log_message_balance(total[rows] - m)
+        for e, r in zip(edges, res):
+            self.message_rv[e] = r
+
+    def message_f_to_rv(self, x, e):
+        cg = self.cg
+        j = cg.edge_f[e]
+        rv_idx = cg.edge_pos[e]
         f_x = list()
         m = list()
 
-        for nb in f.nb:
-            if nb == rv:
+        for e_ in range(cg.f_ptr[j], cg.f_ptr[j + 1]):
+            i = cg.f_nb[e_]
+            if e_ == e:
                 f_x.append([0])
-            elif nb.value is None:
-                f_x.append(self.x[nb])
-                m.append(self.message[(nb, f)])
+            elif not cg.observed[i]:
+                f_x.append(self.x[i])
+                m.append(self.message_rv[e_])
             else:
-                f_x.extend(np.array([nb.value]).reshape(-1, 1))
+                f_x.append([cg.values[i]])
 
         f_x = np.array(list(product(*f_x)), dtype=float)
         m = np.exp(
@@ -98,16 +151,64 @@ class PBP:
         f_x = np.tile(f_x, (len(x), 1))
         f_x[:, rv_idx] = np.repeat(x, batch_len)
 
-        res = f.potential.batch_call(f_x).reshape(len(x), -1) * m.reshape(1, -1)
+        res = cg.factors[j].potential.batch_call(f_x).reshape(len(x), -1) * m.reshape(1, -1)
         res = np.sum(res, axis=1)
         res[res == 0] = np.exp(-700)
 
         return np.log(res)
 
-    def log_belief(self, x, rv):
+    def batch_message_f_to_rv(self, batch, p, x):
+        # compute the messages from all factors in the batch to their hidden rv at position p
+        cg = self.cg
+        rows = np.flatnonzero(~batch.observed[:, p])
+        if len(rows) == 0:
+            return
+
+        others = [k for k in range(batch.arity) if k != p]
+        signature = np.hstack([batch.observed[rows], self.sample_size[batch.nb[rows]]])
+
+        for group in FactorBatch.row_groups(signature):
+            group = rows[group]
+            nb, edge_base = batch.nb[group], cg.f_ptr[batch.factor_ids[group]]
+            observed = batch.observed[group[0]]
+
+            # sampling points of each position, and the incoming messages of the hidden neighbors
+            xs = [np.stack([x[i] for i in nb[:, p]])]
+            m = 0
+            for axis, k in enumerate(others):
+                if observed[k]:
+                    xs.append(cg.values[nb[:, k]].astype(float)[:, np.newaxis])
+                else:
+                    xs.append(np.stack([self.x[i] for i in nb[:, k]]))
+                    temp = np.stack([self.message_rv[e] for e in edge_base + k])
+                    m = m + temp.reshape((len(group),) + (1,) * axis + (-1,) + (1,) * (len(others) - axis - 1))
+
+            shape = tuple(x_.shape[1] for x_ in xs[1:])
+            m = np.broadcast_to(m, (len(group),) + shape).reshape(len(group), -1)
+            m = np.exp(self.batch_log_message_balance(m))
+
+            chunk = max(1, self.max_batch_points // (xs[0].shape[1] * m.shape[1]))
+            for start in range(0, len(group), chunk):
+                s = slice(start, start + chunk)
+                f_x = np.empty((len(group[s]), xs[0].shape[1]) + shape + (batch.arity,))
+                f_x[..., p] = xs[0][s].reshape(xs[0][s].shape + (1,) * len(others))
+                for axis, k in enumerate(others):
+                    f_x[..., k] = xs[axis + 1][s].reshape(
+                        (len(group[s]), 1) + (1,) * axis + (-1,) + (1,) * (len(others) - axis - 1)
+                    )
+
+                res = batch.potential.batch_call(f_x.reshape(-1, batch.arity)).reshape(len(group[s]), -1, m.shape[1])
+                res = np.sum(res * m[s, np.newaxis, :], axis=2)
+                res[res == 0] = np.exp(-700)
+                res = np.log(res)
+
+                for e, r in zip(edge_base[s] + p, res):
+                    self.message[e] = r
+
+    def log_belief(self, x, rv, frame=None):
         res = 0.0
-        for nb in rv.nb:
-            res += self.message_f_to_rv(x, nb, rv)
+        for e in self.cg.rv_edges(self.cg.rv_id(rv, frame)):
+            res += self.message_f_to_rv(x, e)
         return res
 
     def log_message_balance(self, m):
@@ -123,19 +224,42 @@ class PBP:
 
         return m, shift
 
+    def batch_log_message_balance(self, m):
+        # balance each row of m independently
+        mean_m = np.mean(m, axis=1, keepdims=True)
+        max_m = np.max(m, axis=1, keepdims=True)
+
+        shift = np.where(max_m - mean_m > self.max_log_value, max_m - self.max_log_value, mean_m)
+
+        return m - shift
+
     def run(self, iteration=10, log_enable=False):
+        self.cg = self.g.compile()
+        cg = self.cg
+
+        self.sample_size = np.ones(cg.num_rvs, dtype=np.int64)
+        for i in self.hidden_rvs():
+            self.sample_size[i] = self.n if cg.continuous[i] else len(cg.rvs[i].domain.values)
+
+        # the bounds of the continuous rvs, and the hidden rvs grouped by layout, whose particles are stacked
+        self.lower = np.array([rv.domain.values[0] if rv.domain.continuous else np.nan for rv in cg.rvs])
+        self.upper = np.array([rv.domain.values[1] if rv.domain.continuous else np.nan for rv in cg.rvs])
+        hidden = self.hidden_rvs()
+        self.hidden_continuous = hidden[cg.continuous[hidden]]
+        self.rv_groups = [
+            hidden[group] for group in
+            FactorBatch.row_groups(np.stack([cg.continuous[hidden], self.sample_size[hidden]], axis=1))
+        ] if len(hidden) else list()
+
         self.initial_proposal()
         self.x = self.generate_sample()
 
         # Message initialization
-        for rv in self.g.rvs:
-            if rv.value is None:
-                if rv.domain.continuous:
-                    for f in rv.nb:
-                        self.message[(f, rv)] = np.zeros(self.n)
-                else:
-                    for f in rv.nb:
-                        self.message[(f, rv)] = np.zeros(len(rv.domain.values))
+        self.message = [None] * cg.num_edges
+        self.message_rv = [None] * cg.num_edges
+        for i in self.hidden_rvs():
+            for e in cg.rv_edges(i):
+                self.message[e] = np.zeros(self.sample_size[i])
 
         # BP iteration
         for i in range(iteration):
@@ -144,12 +268,8 @@ class PBP:
                 time_start = time.time()
 
             # Compute messages from rv to f
-            for rv in self.g.rvs:
-                if rv.value is None:
-                    for f in rv.nb:
-                        m = self.message_rv_to_f(self.x[rv], rv, f)
-                        # print(f'{rv.name} to {f.name}', m)
-                        self.message[(rv, f)], _ = self.log_message_balance(m)
+            for ids in self.rv_groups:
+                self.batch_message_rv_to_f(ids)
 
             if log_enable:
                 print(f'\trv to f {time.time() - time_start}')
@@ -164,11 +284,9 @@ class PBP:
                 x_new = self.generate_sample()
 
                 # Compute messages from f to rv
-                for f in self.g.factors:
-                    for rv in f.nb:
-                        if rv.value is None:
-                            self.message[(f, rv)] = self.message_f_to_rv(x_new[rv], f, rv)
-                            # print(f'{f.name} to {rv.name}', self.message[(f, rv)])
+                for batch in cg.factor_batches:
+                    for p in range(batch.arity):
+                        self.batch_message_f_to_rv(batch, p, x_new)
 
                 self.x = x_new
 
@@ -176,10 +294,10 @@ class PBP:
                     print(f'\tf to rv {time.time() - time_start}')
                     time_start = time.time()
 
-    def belief_integration(self, rv, a, b, n, shift=None):
+    def belief_integration(self, rv, a, b, n, shift=None, frame=None):
         x = np.linspace(a, b, n, endpoint=True)
 
-        b = self.log_belief(x, rv)
+        b = self.log_belief(x, rv, frame)
         if shift is None:
             b, shift = self.log_message_balance(b)
         else:
@@ -188,47 +306,50 @@ class PBP:
 
         return np.sum(b[:-1] + b[1:]) * (x[1] - x[0]) * 0.5, b, shift
 
-    def belief(self, x, rv):
+    def belief(self, x, rv, frame=None):
+        # the belief of the rv, which is in the frame if the graph has frames
         x = np.array(x)
-        if rv.value is None:
+        i = self.cg.rv_id(rv, frame)
+        if not self.cg.observed[i]:
             if rv.domain.continuous:
                 # z = quad(
                 #     lambda val: np.exp(self.belief_rv(val, rv, self.sample)),
                 #     rv.domain.values[0], rv.domain.values[1]
                 # )[0]
 
-                z, _, shift = self.belief_integration(rv, rv.domain.values[0], rv.domain.values[1], 20)
+                z, _, shift = self.belief_integration(rv, rv.domain.values[0], rv.domain.values[1], 20, frame=frame)
 
-                return np.exp(self.log_belief(x.reshape(-1), rv) - shift).squeeze() / z
+                return np.exp(self.log_belief(x.reshape(-1), rv, frame) - shift).squeeze() / z
             else:
                 xs = np.array(rv.domain.values)
-                ys = self.log_belief(xs.reshape(-1), rv)
+                ys = self.log_belief(xs.reshape(-1), rv, frame)
                 ys, shift = self.log_message_balance(ys)
                 ys = np.exp(ys)
-                return np.exp(self.log_belief(x.reshape(-1), rv) - shift).squeeze() / np.sum(ys)
+                return np.exp(self.log_belief(x.reshape(-1), rv, frame) - shift).squeeze() / np.sum(ys)
         else:
-            return np.array(x == rv.value, dtype=float)
+            return np.array(x == self.cg.values[i], dtype=float)
 
-    def probability(self, a, b, rv):
+    def probability(self, a, b, rv, frame=None):
         # Only for continuous hidden variable
-        if rv.value is None:
+        if not self.cg.observed[self.cg.rv_id(rv, frame)]:
             if rv.domain.continuous:
-                z, _, shift = self.belief_integration(rv, rv.domain.values[0], rv.domain.values[1], 20)
-                b, _, _ = self.belief_integration(rv, a, b, 5, shift)
+                z, _, shift = self.belief_integration(rv, rv.domain.values[0], rv.domain.values[1], 20, frame=frame)
+                b, _, _ = self.belief_integration(rv, a, b, 5, shift, frame)
                 return b / z
         return None
 
-    def map(self, rv):
-        if rv.value is None:
+    def map(self, rv, frame=None):
+        i = self.cg.rv_id(rv, frame)
+        if not self.cg.observed[i]:
             if rv.domain.continuous:
                 return fminbound(
-                    lambda x: -np.squeeze(self.log_belief(x.reshape(-1), rv)),
+                    lambda x: -np.squeeze(self.log_belief(x.reshape(-1), rv, frame)),
                     rv.domain.values[0], rv.domain.values[1],
                     disp=False
                 )
             else:
                 x = np.array(rv.domain.values)
-                b = self.log_belief(x, rv)
+                b = self.log_belief(x, rv, frame)
                 return x[np.argmax(b)]
         else:
-            return rv.value
+            return self.cg.values[i]
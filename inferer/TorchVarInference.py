@@ -0,0 +1,167 @@
+import numpy as np
+import torch
+from inferer.VarInference import VarInference
+
+
+class TorchVarInference(VarInference):
+    """
+    The variational inference with the gradients of the Bethe free energy from torch autograd. The free energy of all
+    work items is built as a batched torch computation, where the quadrature grids and the mixture beliefs are
+    computed in torch from the parameters and taken as constants, and the expectations over the continuous rvs are
+    differentiated by the score log q(x) - log q(x).detach() of the fixed points. So the potentials need not be
+    differentiable, and any potential with a batch_call, in numpy or torch, can be used. The run, belief and map
+    methods are the ones of VarInference.
+    """
+
+    def __init__(self, g, num_mixtures=5, num_quadrature_points=3, quadrature_rules=None):
+        """
+        Args:
+            g: The Graph instance.
+            num_mixtures: The number of mixture components.
+            num_quadrature_points: The number of quadrature points of each continuous rv.
+            quadrature_rules: The multivariate rules of the factors, see VarInference.
+
+        The torch CPU kernels use the number of threads of the torch setting, see torch.set_num_threads.
+        """
+        VarInference.__init__(self, g, num_mixtures, num_quadrature_points, quadrature_rules=quadrature_rules)
+
+    @staticmethod
+    def tensor(a):
+        # a torch copy of a numpy array, which may be a broadcast view
+        return torch.from_numpy(np.ascontiguousarray(a, dtype=float))
+
+    @staticmethod
+    def torch_norm_pdf(x, mu, var):
+        return torch.exp(-(x - mu) ** 2 * 0.5 / var) / (2.5066282746310002 * torch.sqrt(var))
+
+    def potential_values(self, potential, points):
+        # the potentials of torch modules take a tensor on their device, the other potentials take the numpy points
+        if hasattr(potential, 'device'):
+            with torch.no_grad():
+                return potential.batch_call(points.float().to(potential.device)).reshape(-1).cpu().double()
+        return self.tensor(np.asarray(potential.batch_call(points.numpy()), dtype=float).reshape(-1))
+
+    def factor_values(self, potential, xs, b):
+        # the numpy version for VarInference.expectations, e.g. of free_energy
+        points = self.grid_points(xs, b.shape).reshape(-1, len(xs))
+        self.num_evaluations += len(points)
+        value = self.potential_values(potential, torch.from_numpy(points)).numpy().reshape(b.shape)
+        return np.log(value + 1e-100) - np.log(b + 1e-100)
+
+    def rv_quadrature_tensor(self, ids, eta_c, eta_d):
+        """
+        The quadrature of VarInference.rv_quadrature, computed from the tensors of the parameters.
+        """
+        cg, m, K = self.cg, len(ids), self.K
+        idx = torch.from_numpy(ids)
+
+        if cg.observed[ids[0]]:
+            x = self.tensor(cg.values[ids].astype(float)).reshape(m, 1, 1).expand(m, K, 1)
+            return x, torch.ones((m, K, 1), dtype=torch.float64), torch.ones((m, K, 1, K), dtype=torch.float64)
+
+        if cg.continuous[ids[0]]:
+            eta = eta_c[idx]
+            x = torch.sqrt(2 * eta[:, :, 1:]) * self.tensor(self.quad_x) + eta[:, :, :1]
+            b = self.torch_norm_pdf(x.unsqueeze(-1), eta[:, None, None, :, 0], eta[:, None, None, :, 1])
+            return x, self.tensor(self.quad_w).expand(x.shape), b
+        else:
+            eta = eta_d[idx, :, :self.point_size[ids[0]]]
+            x = self.tensor(cg.rvs[ids[0]].domain.values).expand(eta.shape)
+            return x, eta, eta.transpose(1, 2).unsqueeze(1).expand((m, K) + tuple(eta.shape[2:0:-1]))
+
+    def quadrature_tensor(self, nb, w, eta_c, eta_d):
+        """
+        The quadrature of VarInference.quadrature, computed from the tensors of the parameters, see energy.
+
+        Returns: The list of the points of each column and the list of the weights of each axis, both in tensors that
+                 broadcast to the (m, K, P_1, ..., P_a) grid, the tensor of the mixture belief on the grid, and the
+                 list of the axis of each column.
+        """
+        cols, rule, axes = self.grid_axes(nb)
+        n = max(axes) + 1
+
+        xs, ws, b = list(), [None] * n, 1
+        for j, axis in enumerate(axes):
+            if rule is not None and j in cols:
+                eta = eta_c[torch.from_numpy(nb[:, j])]
+                x = torch.sqrt(eta[:, :, 1:]) * self.tensor(rule[0][:, cols.index(j)]) + eta[:, :, :1]
+                b_ = self.torch_norm_pdf(x.unsqueeze(-1), eta[:, None, None, :, 0], eta[:, None, None, :, 1])
+                ws[axis] = self.place(self.tensor(rule[1]).reshape(1, 1, -1), axis, n)
+            else:
+                x, w_, b_ = self.rv_quadrature_tensor(nb[:, j], eta_c, eta_d)
+                ws[axis] = self.place(w_, axis, n)
+            xs.append(self.place(x, axis, n))
+            b = b * self.place(b_, axis, n)
+
+        if self.cg.frame is None:
+            b = b @ w
+        else:
+            b = torch.einsum('m...k,mk->m...', b, w[torch.from_numpy(self.cg.frame[nb[:, 0]])])
+        return xs, ws, b, axes
+
+    def energy(self, batch, nb, w, eta_c, eta_d, weight=1):
+        """
+        Args:
+            batch, nb: A work item, see work_items.
+            w: The (K,) tensor of the mixture weights, or the (M, K) tensor of the frames if the graph has frames.
+            eta_c: The (n_rv, K, 2) tensor of the means and the variances.
+            eta_d: The (n_rv, K, D) tensor of the categorical distributions.
+            weight: The weight of the expectations of the work item.
+
+        Returns: The tensor of the free energy terms of the work item, whose autograd gradients are the gradients of
+                 the free energy, see VarInference.gradients.
+        """
+        cg = self.cg
+
+        # the points of the grid and the belief are constants, only the weights of the discrete rvs and the score of
+        # the continuous rvs are differentiated
+        xs, ws, b, axes = self.quadrature_tensor(nb, w.detach(), eta_c.detach(), eta_d.detach())
+        if batch is None:
+            v = self.tensor(cg.N[nb[:, 0]] - 1)[:, None, None] * torch.log(b + 1e-100)
+        else:
+            points = torch.stack([x.expand(b.shape) for x in xs], -1).reshape(-1, len(xs))
+            self.num_evaluations += len(points)
+            value = self.potential_values(batch.potential, points).reshape(b.shape)
+            v = torch.log(value + 1e-100) - torch.log(b + 1e-100)
+        v = v * weight
+
+        score = 0
+        for j in np.flatnonzero(~cg.observed[nb[0]]):
+            idx = torch.from_numpy(nb[:, j])
+            if cg.continuous[nb[0, j]]:
+                shape = (len(nb), self.K) + (1,) * len(ws)
+                u = xs[j] - eta_c[idx, :, 0].reshape(shape)
+                var = eta_c[idx, :, 1].reshape(shape)
+                log_q = -0.5 * torch.log(2 * np.pi * var) - u * u * 0.5 / var
+                score = score + log_q - log_q.detach()
+            else:
+                ws[axes[j]] = eta_d[idx, :, :self.point_size[nb[0, j]]].reshape(ws[axes[j]].shape)
+
+        for w_ in ws:
+            v = v * w_
+        e = torch.sum(v * (1 + score) if torch.is_tensor(score) else v, dim=tuple(range(2, v.dim())))
+
+        # as in VarInference, the gradients of the parameters of a mixture component are not scaled by its weight
+        if cg.frame is not None:
+            w = w[torch.from_numpy(cg.frame[nb[:, 0]])]
+        return -torch.sum(e.detach() * w) - torch.sum(e - e.detach())
+
+    def gradients(self, factor_batch=None):
+        """
+        Compute the gradients of all parameters by autograd, see VarInference.gradients.
+        """
+        w_tau = torch.from_numpy(self.w_tau).requires_grad_()
+        eta_c = torch.from_numpy(self.eta_c).requires_grad_()
+        eta_d_tau = torch.from_numpy(self.eta_d_tau).requires_grad_()
+        w, eta_d = torch.softmax(w_tau, -1), torch.softmax(eta_d_tau, -1)
+
+        energy = torch.zeros((), dtype=torch.float64)
+        for work, weight in [(self.work, 1)] if factor_batch is None else self.sample_work(factor_batch):
+            for batch, nb in work:
+                energy = energy + self.energy(batch, nb, w, eta_c, eta_d, weight)
+        energy.backward()
+
+        return tuple(
+            np.zeros(x.shape) if x.grad is None else x.grad.numpy()
+            for x in (w_tau, eta_c, eta_d_tau)
+        )
@@ -1,23 +1,45 @@
 import numpy as np
 from numpy.polynomial.hermite import hermgauss
-from scipy.optimize import minimize
-from math import sqrt, pi, e, log
-from itertools import product
+from math import sqrt, pi, e
 import time
-from utils import log_likelihood
-from optimization_tools import AdamOptimizer
+import multiprocessing
+from multiprocessing import shared_memory
+from Graph import FactorBatch
+from clustering import group_indices
+from utils import values_log_likelihood
+from optimization_tools import AdamOptimizer, ConvergenceMonitor, gaussian_mixture_map
+from quadrature import make_rule
 
 
 class VarInference:
     var_threshold = 0.01
-
-    def __init__(self, g, num_mixtures=5, num_quadrature_points=3):
+    max_batch_points = 1000000  # The maximum number of points evaluated in one potential.batch_call
+    shared = None  # The inferer that the worker processes read
+
+    def __init__(self, g, num_mixtures=5, num_quadrature_points=3, workers=None, quadrature_rules=None):
+        """
+        Args:
+            g: The Graph instance, or a FrameGraph to run all its frames together, each with its own parameters.
+            num_mixtures: The number of mixture components.
+            num_quadrature_points: The number of quadrature points of each continuous rv.
+            workers: The number of processes. If it is more than 1, the gradients of each iteration are computed by a
+                     pool of forked processes, with the parameters in shared memory.
+            quadrature_rules: A dictionary of the multivariate rule of the factors by their number of hidden continuous
+                              neighbors, e.g. {3: 'smolyak', 4: ('qmc', 128)}, see quadrature.make_rule. The other
+                              factors use the product of the 1 dimensional rules. The number of potential evaluations
+                              of a gradient pass is given by evaluation_cost, and counted in num_evaluations.
+        """
         self.g = g
+        self.workers = workers
+        self.pool = None
 
         self.K = num_mixtures
         self.T = num_quadrature_points
         self.quad_x, self.quad_w = hermgauss(self.T)
         self.quad_w /= sqrt(pi)
+        self.quadrature_rules = dict() if quadrature_rules is None else quadrature_rules
+        self.rule_cache = dict()
+        self.num_evaluations = 0
 
         self.w_tau = np.zeros(self.K)
         self.w = np.zeros(self.K)
@@ -38,323 +60,790 @@ class VarInference:
         else:
             return res / np.sum(res, 1)[:, np.newaxis]
 
-    def expectation(self, f, *args):  # arg = (is_continuous, eta), discrete eta = (domains, values)
-        xs, ws = list(), list()
-
-        for is_continuous, eta in args:
-            if is_continuous:
-                xs.append(sqrt(2 * eta[1]) * self.quad_x + eta[0])
-                ws.append(self.quad_w)
-            else:
-                xs.append(eta[0])
-                ws.append(eta[1])
-
-        res = 0
-        for x, w in zip(product(*xs), product(*ws)):
-            res += np.prod(w) * f(x)
-
+    def frame_weights(self, ids):
+        # the mixture weights of the frames of the rvs ids, or the shared mixture weights of a graph without frames
+        if self.cg.frame is None:
+            return self.w
+        return self.w[self.cg.frame[ids]]
+
+    def mix(self, b, ids):
+        # the mixture belief of the rows from the (m, ..., K) densities of the components, ids are the rvs of the rows
+        if self.cg.frame is None:
+            return b @ self.w
+        return np.einsum('m...k,mk->m...', b, self.w[self.cg.frame[ids]])
+
+    def frame_sum(self, e, ids):
+        # the sum of the (m, K) rows of e, for each frame of the rvs ids of the rows if the graph has frames
+        if self.cg.frame is None:
+            return np.sum(e, axis=0)
+        res = np.zeros(self.w.shape)
+        np.add.at(res, self.cg.frame[ids], e)
         return res
 
-    def gradient_w_tau(self):
-        g_w = np.zeros(self.K)
-
-        for rv in self.g.rvs:
-            def f_w(x):
-                return (rv.N - 1) * log(self.rvs_belief(x, [rv]) + 1e-100)
-
-            for k in range(self.K):
-                if rv.value is not None:
-                    arg = (False, ((rv.value,), (1,)))
-                elif rv.domain.continuous:
-                    arg = (True, self.eta[rv][k])
-                else:
-                    arg = (False, (rv.domain.values, self.eta[rv][k]))
-
-                g_w[k] -= self.expectation(f_w, arg)
-
-        for f in self.g.factors:
-            def f_w(x):
-                return log(f.potential(*x) + 1e-100) - log(self.rvs_belief(x, f.nb) + 1e-100)
-
-            for k in range(self.K):
-                args = list()
-                for rv in f.nb:
-                    if rv.value is not None:
-                        args.append((False, ((rv.value,), (1,))))
-                    elif rv.domain.continuous:
-                        args.append((True, self.eta[rv][k]))
-                    else:
-                        args.append((False, (rv.domain.values, self.eta[rv][k])))
-
-                g_w[k] -= self.expectation(f_w, *args)
-
-        return self.w * (g_w - np.sum(g_w * self.w))
+    def rv_quadrature(self, ids):
+        """
+        Compute the quadrature of all mixture components of rvs with the same layout (observed, continuous and number
+        of points), the points of the k-th component are the quadrature points of the k-th component of the rv.
 
-    def gradient_mu_var(self, rv):
-        g_mu_var = np.zeros((self.K, 2))
-        eta = self.eta[rv]
+        Args:
+            ids: An integer array of m rv ids.
 
-        for k in range(self.K):
-            def f_mu(x):
-                return ((rv.N - 1) * log(self.rvs_belief(x, [rv]) + 1e-100)) * (x[0] - eta[k][0])
+        Returns: The (m, K, P) arrays of the points and the weights, and the (m, K, P, K) array of the density of each
+                 mixture component on the points.
+        """
+        cg, m, K = self.cg, len(ids), self.K
 
-            def f_var(x):
-                return ((rv.N - 1) * log(self.rvs_belief(x, [rv]) + 1e-100)) * ((x[0] - eta[k][0]) ** 2 - eta[k][1])
+        if cg.observed[ids[0]]:
+            x = np.broadcast_to(cg.values[ids].astype(float).reshape(m, 1, 1), (m, K, 1))
+            return x, np.ones((m, K, 1)), np.ones((m, K, 1, K))
 
-            arg = (True, self.eta[rv][k])
-
-            g_mu_var[k, 0] -= self.expectation(f_mu, arg) / eta[k][1]
-            g_mu_var[k, 1] -= self.expectation(f_var, arg) / (2 * eta[k][1] ** 2)
-
-        for f in rv.nb:
-            idx = f.nb.index(rv)
-            for k in range(self.K):
-                def f_mu(x):
-                    return (log(f.potential(*x) + 1e-100) - log(self.rvs_belief(x, f.nb) + 1e-100)) * \
-                           (x[idx] - eta[k][0])
+        if cg.continuous[ids[0]]:
+            eta = self.eta_c[ids]
+            x = np.sqrt(2 * eta[:, :, 1:]) * self.quad_x + eta[:, :, :1]
+            b = self.norm_pdf(x[..., np.newaxis], np.moveaxis(eta, 2, 0)[:, :, np.newaxis, np.newaxis])
+            return x, np.broadcast_to(self.quad_w, x.shape), b
+        else:
+            eta = self.eta_d[ids, :, :self.point_size[ids[0]]]
+            x = np.broadcast_to(np.array(cg.rvs[ids[0]].domain.values, dtype=float), eta.shape)
+            return x, eta, np.broadcast_to(eta.transpose(0, 2, 1)[:, np.newaxis], (m, K) + eta.shape[2:0:-1])
+
+    def rule(self, d):
+        # the multivariate rule of d hidden continuous rvs, or None for the product of their 1 dimensional rules
+        if d < 2 or d not in self.quadrature_rules:
+            return None
+        if d not in self.rule_cache:
+            self.rule_cache[d] = make_rule(self.quadrature_rules[d], d, self.T)
+        return self.rule_cache[d]
+
+    def grid_size(self, ids):
+        # the number of quadrature points of a factor with the neighbors ids, for each mixture component
+        hidden_c = self.cg.continuous[ids] & ~self.cg.observed[ids]
+        rule = self.rule(int(np.sum(hidden_c)))
+        if rule is None:
+            return int(np.prod(self.point_size[ids]))
+        return int(np.prod(self.point_size[ids[~hidden_c]])) * len(rule[1])
+
+    def grid_axes(self, nb):
+        """
+        Args:
+            nb: A (m, d) array of rv ids, the rvs in a column have the same layout.
+
+        Returns: The columns of the hidden continuous rvs, their multivariate rule or None, and the list of the axis of
+                 the grid of each column, see quadrature.
+        """
+        d = nb.shape[1]
+        cols = [j for j in range(d) if self.cg.continuous[nb[0, j]] and not self.cg.observed[nb[0, j]]]
+        rule = self.rule(len(cols))
+
+        axes = list()
+        for j in range(d):
+            if rule is not None and j in cols[1:]:
+                axes.append(axes[cols[0]])
+            else:
+                axes.append(max(axes, default=-1) + 1)
+        return cols, rule, axes
 
-                def f_var(x):
-                    return (log(f.potential(*x) + 1e-100) - log(self.rvs_belief(x, f.nb) + 1e-100)) * \
-                           ((x[idx] - eta[k][0]) ** 2 - eta[k][1])
+    @staticmethod
+    def place(a, axis, n):
+        # reshape the (., ., P, ...) array to put its points on the axis of a grid of n axes
+        return a.reshape(tuple(a.shape[:2]) + (1,) * axis + (-1,) + (1,) * (n - axis - 1) + tuple(a.shape[3:]))
+
+    def quadrature(self, nb):
+        """
+        Compute the quadrature of all mixture components for rows of rvs with the same layout. The columns of the
+        discrete and the observed rvs are product axes of the grid. The columns of the hidden continuous rvs are
+        product axes too, unless a multivariate rule is set for their number, then they share a single axis of the
+        points of the rule.
+
+        Args:
+            nb: A (m, d) array of rv ids, the rvs in a column have the same layout.
+
+        Returns: The list of the points of each column and the list of the weights of each axis, both in arrays that
+                 broadcast to the (m, K, P_1, ..., P_a) grid, the (m, K, P_1, ..., P_a) array of the mixture belief on
+                 the grid, and the list of the axis of each column.
+        """
+        cols, rule, axes = self.grid_axes(nb)
+        n = max(axes) + 1
+
+        xs, ws, b = list(), [None] * n, 1
+        for j, axis in enumerate(axes):
+            if rule is not None and j in cols:
+                eta = self.eta_c[nb[:, j]]
+                x = np.sqrt(eta[:, :, 1:]) * rule[0][:, cols.index(j)] + eta[:, :, :1]
+                b_ = self.norm_pdf(x[..., np.newaxis], np.moveaxis(eta, 2, 0)[:, :, np.newaxis, np.newaxis])
+                ws[axis] = self.place(rule[1].reshape(1, 1, -1), axis, n)
+            else:
+                x, w, b_ = self.rv_quadrature(nb[:, j])
+                ws[axis] = self.place(w, axis, n)
+            xs.append(self.place(x, axis, n))
+            b = b * self.place(b_, axis, n)
+        return xs, ws, self.mix(b, nb[:, 0]), axes
 
-                args = list()
-                for rv_ in f.nb:
-                    if rv_.value is not None:
-                        args.append((False, ((rv_.value,), (1,))))
-                    elif rv_.domain.continuous:
-                        args.append((True, self.eta[rv_][k]))
-                    else:
-                        args.append((False, (rv_.domain.values, self.eta[rv_][k])))
+    @staticmethod
+    def grid_points(xs, shape):
+        # the (m, K, P_1, ..., P_a, d) array of the points of the grid
+        points = np.empty(shape + (len(xs),))
+        for j, x in enumerate(xs):
+            points[..., j] = x
+        return points
+
+    def factor_values(self, potential, xs, b):
+        # the log potential minus the log belief on the grid, with a single batch call of the potential
+        points = self.grid_points(xs, b.shape).reshape(-1, len(xs))
+        self.num_evaluations += len(points)
+        value = potential.batch_call(points).reshape(b.shape)
+        return np.log(value + 1e-100) - np.log(b + 1e-100)
 
-                g_mu_var[k, 0] -= self.expectation(f_mu, *args) / eta[k][1]
-                g_mu_var[k, 1] -= self.expectation(f_var, *args) / (2 * eta[k][1] ** 2)
+    @staticmethod
+    def marginal(v, ws, axis):
+        """
+        Args:
+            v: A (m, K, P_1, ..., P_a) array of values on the grid.
+            ws: The list of the weights of each axis, see quadrature.
+            axis: The axis.
+
+        Returns: The (m, K, P_axis) array of the expectation of the values over the other axes, given each point of
+                 the axis. If axis is None, the (m, K) array of the expectation over all axes.
+        """
+        for i, w in enumerate(ws):
+            if i != axis:
+                v = v * w
+        return np.sum(v, axis=tuple(2 + i for i in range(len(ws)) if i != axis))
+
+    def node_moments(self, table, var):
+        """
+        Args:
+            table: A (..., K, T) array of the expectation of a value given each quadrature point of continuous rvs.
+            var: The (..., K) array of the variances of the rvs.
+
+        Returns: The (..., K, 2) array of the moments E[v u] and E[v (u^2 - var)], where u = x - mu.
+        """
+        u = np.sqrt(2 * var)[..., np.newaxis] * self.quad_x
+        table = table * self.quad_w
+        return np.stack([np.sum(table * u, axis=-1), np.sum(table * (u * u - var[..., np.newaxis]), axis=-1)], -1)
+
+    def column_expectation(self, v, xs, ws, axes, nb, j):
+        """
+        Returns: The (m, K, P) array of the expectation of the values v on the grid given each category of the rvs of
+                 a discrete column j, or the (m, K, 2) moments E[v u] and E[v (u^2 - var)] of a continuous column,
+                 see gaussian_gradient.
+        """
+        if not self.cg.continuous[nb[0, j]]:
+            return self.marginal(v, ws, axes[j])
+
+        eta = self.eta_c[nb[:, j]]
+        if axes.count(axes[j]) == 1:
+            return self.node_moments(self.marginal(v, ws, axes[j]), eta[:, :, 1])
+
+        # the points of a multivariate rule
+        shape = eta.shape[:2] + (1,) * len(ws)
+        u = xs[j] - eta[:, :, 0].reshape(shape)
+        return np.stack([
+            self.marginal(v * u, ws, None),
+            self.marginal(v * (u * u - eta[:, :, 1].reshape(shape)), ws, None)
+        ], -1)
+
+    def expectations(self):
+        """
+        Compute the expectation of the energy terms of all rvs and factors, under each mixture component.
+
+        Yields: The ids of the first rv of each row, and the (m, K) array of the expectations, of the groups of rvs and
+                factors with the same layout.
+        """
+        for batch, nb in self.work:
+            xs, ws, b, _ = self.quadrature(nb)
+            if batch is None:
+                v = (self.cg.N[nb[:, 0]] - 1)[:, np.newaxis, np.newaxis] * np.log(b + 1e-100)
+                yield nb[:, 0], np.sum(v * ws[0], axis=2)
+            else:
+                yield nb[:, 0], self.marginal(self.factor_values(batch.potential, xs, b), ws, None)
+
+    def rv_tables(self, rv, frame=None):
+        """
+        Compute the expectation of the energy terms that involve the rv (of the frame, if the graph has frames).
+
+        Returns: The (K, P) array of the expectations given each category of a discrete rv, or the (K, 2) moments of a
+                 continuous rv, see gaussian_gradient.
+        """
+        cg = self.cg
+        i = cg.rv_id(rv, frame)
+        _, _, b, _ = self.quadrature(np.array([[i]]))
+        table = (cg.N[i] - 1) * np.log(b[0] + 1e-100)
+        if cg.continuous[i]:
+            table = self.node_moments(table, self.eta_c[i, :, 1])
+
+        # the neighboring factors, grouped by the layout of the factor and the position of the rv
+        fs, pos = cg.rv_factors(i)
+        if len(fs) == 0:
+            return table
+
+        key = self.factor_layout[fs] * (int(np.max(pos)) + 1) + pos
+        for group in FactorBatch.row_groups(key.reshape(-1, 1)):
+            batch = self.batches[self.factor_batch[fs[group[0]]]]
+            nb = batch.nb[self.factor_row[fs[group]]]
+            xs, ws, b, axes = self.quadrature(nb)
+            v = self.factor_values(batch.potential, xs, b)
+            table = table + np.sum(self.column_expectation(v, xs, ws, axes, nb, pos[group[0]]), 0)
+
+        return table
 
+    @staticmethod
+    def gaussian_gradient(moments, eta):
+        """
+        Args:
+            moments: A (..., K, 2) array of the moments E[v u] and E[v (u^2 - var)] of the expected energy v, where
+                     u = x - mu, under each mixture component of the rvs.
+            eta: A (..., K, 2) array of the mean and the variance of each mixture component of the rvs.
+
+        Returns: The (..., K, 2) array of the gradients of the means and the variances.
+        """
+        var = eta[..., 1]
+        g_mu_var = np.empty(eta.shape)
+        g_mu_var[..., 0] = -moments[..., 0] / var
+        g_mu_var[..., 1] = -moments[..., 1] / (2 * var ** 2)
         return g_mu_var
 
-    def gradient_category_tau(self, rv):
-        g_c = np.zeros((self.K, len(rv.domain.values)))
-        eta = self.eta[rv]
-
-        for k in range(self.K):
-            for d, xi in enumerate(rv.domain.values):
-                g_c[k, d] -= (rv.N - 1) * log(self.rvs_belief([xi], [rv]) + 1e-100)
-
-            for f in rv.nb:
-                args = list()
-                for rv_ in f.nb:
-                    if rv_ is not rv:
-                        if rv_.value is not None:
-                            args.append((False, ((rv_.value,), (1,))))
-                        elif rv.domain.continuous:
-                            args.append((True, self.eta[rv_][k]))
-                        else:
-                            args.append((False, (rv.domain.values, self.eta[rv_][k])))
+    @staticmethod
+    def category_gradient(table, eta):
+        # the gradient of the logits of the categorical distributions, from the expected energy of each category
+        g_c = -table
+        return eta * (g_c - np.sum(g_c * eta, axis=-1)[..., np.newaxis])
 
-                idx = f.nb.index(rv)
-                for d, xi in enumerate(rv.domain.values):
-                    def f_c(x):
-                        new_x = x[:idx] + (xi,) + x[idx:]
-                        return log(f.potential(*new_x) + 1e-100) - log(self.rvs_belief(new_x, f.nb) + 1e-100)
+    def gradient_w_tau(self):
+        g_w = np.zeros(self.w.shape)
+        for ids, e in self.expectations():
+            g_w -= self.frame_sum(e, ids)
+
+        return self.w * (g_w - np.sum(g_w * self.w, axis=-1, keepdims=True))
+
+    def gradient_mu_var(self, rv, frame=None):
+        return self.gaussian_gradient(self.rv_tables(rv, frame), self.rv_eta(rv, frame))
+
+    def gradient_category_tau(self, rv, frame=None):
+        return self.category_gradient(self.rv_tables(rv, frame), self.rv_eta(rv, frame))
+
+    def accumulate(self, work, g_w, table_c, table_d, weight=1):
+        """
+        Evaluate the work items on their quadrature grids, and add their expectations to the gradient of the mixture
+        weights and to the expectation tables of their hidden rvs.
+
+        Args:
+            work: A list of work items, see work_items.
+            g_w: The (K,) array of the negative expected energy of each mixture component, or the (M, K) array of
+                 each frame if the graph has frames.
+            table_c: The (n_rv, K, 2) array of the moments of the expected energy of the continuous rvs, see
+                     gaussian_gradient.
+            table_d: The (n_rv, K, D) array of the expected energy given each category of the discrete rvs.
+            weight: The weight of the expectations of the work items.
+        """
+        cg = self.cg
+
+        def scatter(ids, table):
+            if cg.continuous[ids[0]]:
+                np.add.at(table_c, ids, table)
+            else:
+                np.add.at(table_d[:, :, :table.shape[2]], ids, table)
+
+        for batch, nb in work:
+            xs, ws, b, axes = self.quadrature(nb)
+            if batch is None:
+                ids = nb[:, 0]
+                table = (cg.N[ids] - 1)[:, np.newaxis, np.newaxis] * np.log(b + 1e-100)
+                if weight != 1:
+                    table *= weight
+                g_w -= self.frame_sum(np.sum(table * ws[0], axis=2), ids)
+                scatter(ids, self.node_moments(table, self.eta_c[ids, :, 1]) if cg.continuous[ids[0]] else table)
+            else:
+                v = self.factor_values(batch.potential, xs, b)
+                if weight != 1:
+                    v *= weight
+                g_w -= self.frame_sum(self.marginal(v, ws, None), nb[:, 0])
+                for j in np.flatnonzero(~cg.observed[nb[0]]):
+                    scatter(nb[:, j], self.column_expectation(v, xs, ws, axes, nb, j))
 
-                    g_c[k, d] -= self.expectation(f_c, *args)
+    @staticmethod
+    def accumulate_block(i):
+        # the task of a worker process, which writes the partial sums of its block to the shared arrays
+        # the potential evaluations are counted in the forked copy of the inferer, so they are written to the shared
+        # arrays as well
+        infer = VarInference.shared
+        g_w, table_c, table_d = (part[i] for part in infer.parts[:3])
+        g_w[:], table_c[:], table_d[:] = 0, 0, 0
+        num_evaluations = infer.num_evaluations
+        infer.accumulate(infer.blocks[i], g_w, table_c, table_d)
+        infer.parts[3][i] = infer.num_evaluations - num_evaluations
+
+    def gradients(self, factor_batch=None):
+        """
+        Compute the gradients of all parameters in a single pass, where each rv and each factor is evaluated on its
+        quadrature grid once, and its expectations are scattered to the mixture weights and to all its hidden rvs.
+        With worker processes, each worker evaluates a block of the work items, and the partial sums of the blocks
+        are added up in a fixed order.
+
+        Args:
+            factor_batch: If it is not None, the gradients are unbiased estimates from a sample of factor_batch
+                          factors and the same fraction of the rvs, see sample_work.
+
+        Returns: The gradients of w_tau, the (n_rv, K, 2) gradients of eta_c and the (n_rv, K, D) gradients of
+                 eta_d_tau, which are 0 for the rows of the other rvs and the padded categories.
+        """
+        if self.pool is None:
+            g_w = np.zeros(self.w.shape)
+            table_c = np.zeros(self.eta_c.shape)
+            table_d = np.zeros(self.eta_d.shape)
+            if factor_batch is None:
+                self.accumulate(self.work, g_w, table_c, table_d)
+            else:
+                for work, weight in self.sample_work(factor_batch):
+                    self.accumulate(work, g_w, table_c, table_d, weight)
+        else:
+            self.pool.map(VarInference.accumulate_block, range(len(self.blocks)), chunksize=1)
+            g_w, table_c, table_d = (np.sum(part, axis=0) for part in self.parts[:3])
+            self.num_evaluations += int(np.sum(self.parts[3]))
 
-        return eta * (g_c - np.sum(g_c * eta, 1)[:, np.newaxis])
+        return (
+            self.w * (g_w - np.sum(g_w * self.w, axis=-1, keepdims=True)),
+            self.gaussian_gradient(table_c, self.eta_c),
+            self.category_gradient(table_d, self.eta_d)
+        )
 
     def free_energy(self):
         energy = 0
+        for ids, e in self.expectations():
+            energy -= np.sum(e * self.frame_weights(ids))
 
-        for rv in self.g.rvs:
-            def f_bfe(x):
-                return (rv.N - 1) * log(self.rvs_belief(x, [rv]) + 1e-100)
-
-            for k in range(self.K):
-                if rv.value is not None:
-                    arg = (False, ((rv.value,), (1,)))
-                elif rv.domain.continuous:
-                    arg = (True, self.eta[rv][k])
-                else:
-                    arg = (False, (rv.domain.values, self.eta[rv][k]))
-
-                energy -= self.w[k] * self.expectation(f_bfe, arg)
-
-        for f in self.g.factors:
-            def f_bfe(x):
-                return log(f.potential(*x) + 1e-100) - log(self.rvs_belief(x, f.nb) + 1e-100)
+        return energy
 
-            for k in range(self.K):
-                args = list()
-                for rv in f.nb:
-                    if rv.value is not None:
-                        args.append((False, ((rv.value,), (1,))))
-                    elif rv.domain.continuous:
-                        args.append((True, self.eta[rv][k]))
-                    else:
-                        args.append((False, (rv.domain.values, self.eta[rv][k])))
+    def compile_graph(self):
+        self.cg = self.g.compile()
+        cg = self.cg
+
+        # the number of quadrature points of each rv
+        self.point_size = np.ones(cg.num_rvs, dtype=np.int64)
+        for i in np.flatnonzero(~cg.observed):
+            self.point_size[i] = self.T if cg.continuous[i] else len(cg.rvs[i].domain.values)
+
+        # the hidden rvs, grouped by layout (the energy terms of the observed rvs are 0)
+        self.hidden = hidden = np.flatnonzero(~cg.observed)
+        self.rv_groups = [
+            hidden[group] for group in
+            FactorBatch.row_groups(np.stack([cg.continuous[hidden], self.point_size[hidden]], axis=1))
+        ] if len(hidden) else list()
+        self.rv_layout = np.zeros(cg.num_rvs, dtype=np.int64)
+        for layout, ids in enumerate(self.rv_groups):
+            self.rv_layout[ids] = layout
+
+        # the factors of each batch, grouped by the layout of their neighbors
+        self.batches = cg.factor_batches
+        self.factor_groups = list()
+        self.factor_batch = np.zeros(cg.num_factors, dtype=np.int64)
+        self.factor_row = np.zeros(cg.num_factors, dtype=np.int64)
+        self.factor_layout = np.zeros(cg.num_factors, dtype=np.int64)
+        for b, batch in enumerate(self.batches):
+            self.factor_batch[batch.factor_ids] = b
+            self.factor_row[batch.factor_ids] = np.arange(len(batch))
+            signature = np.hstack([batch.observed, cg.continuous[batch.nb], self.point_size[batch.nb]])
+            for group in FactorBatch.row_groups(signature):
+                self.factor_layout[batch.factor_ids[group]] = len(self.factor_groups)
+                self.factor_groups.append((batch, group))
+
+        self.work = self.work_items()
+
+    def work_items(self, parts=1):
+        """
+        Args:
+            parts: The minimum number of chunks of each group of factors, to balance the blocks of the workers.
+
+        Returns: The list of work items (batch, nb), each evaluated with a single quadrature, where nb is a (m, d) array
+                 of rv ids with the same layout in each column. The items of the rv groups have batch None and d = 1,
+                 and the factor groups are split into chunks of at most max_batch_points points.
+        """
+        items = [(None, ids[:, np.newaxis]) for ids in self.rv_groups]
+        for batch, group in self.factor_groups:
+            chunk = min(self.chunk_size(batch.nb[group[0]]), -(-len(group) // parts))
+            for start in range(0, len(group), chunk):
+                items.append((batch, batch.nb[group[start:start + chunk]]))
+        return items
+
+    def chunk_size(self, nb):
+        # the number of factors with the neighbors layout of nb that are evaluated in one batch call
+        return max(1, self.max_batch_points // (self.K * self.grid_size(nb)))
+
+    def evaluation_cost(self):
+        """
+        Returns: A dictionary of the number of potential evaluations of a full gradient pass, by the number of hidden
+                 continuous neighbors of the factors.
+        """
+        cost = dict()
+        for batch, group in self.factor_groups:
+            ids = batch.nb[group[0]]
+            d = int(np.sum(self.cg.continuous[ids] & ~self.cg.observed[ids]))
+            cost[d] = cost.get(d, 0) + len(group) * self.K * self.grid_size(ids)
+        return cost
+
+    def sample_work(self, factor_batch):
+        """
+        Sample factor_batch factors, and the same fraction of the hidden rvs, uniformly with replacement, so the cost
+        does not depend on the size of the graph.
+
+        Returns: The list of (work items, weight) of the sampled rvs and factors, where the weight is the inverse of
+                 the fraction of the samples, which makes the weighted sums unbiased estimates of the full sums.
+        """
+        cg = self.cg
+        res = list()
+
+        if len(self.hidden) > 0:
+            num_rvs = max(1, int(round(factor_batch * len(self.hidden) / cg.num_factors)))
+            rvs = self.hidden[np.random.randint(len(self.hidden), size=num_rvs)]
+            items = [
+                (None, rvs[group, np.newaxis])
+                for group in group_indices(self.rv_layout[rvs], len(self.rv_groups)) if len(group) > 0
+            ]
+            res.append((items, len(self.hidden) / num_rvs))
+
+        factors = np.random.randint(cg.num_factors, size=factor_batch)
+        items = list()
+        for layout, group in enumerate(group_indices(self.factor_layout[factors], len(self.factor_groups))):
+            if len(group) > 0:
+                batch = self.factor_groups[layout][0]
+                nb = batch.nb[self.factor_row[factors[group]]]
+                chunk = self.chunk_size(nb[0])
+                items.extend((batch, nb[start:start + chunk]) for start in range(0, len(nb), chunk))
+        res.append((items, cg.num_factors / factor_batch))
 
-                energy -= self.w[k] * self.expectation(f_bfe, *args)
+        return res
 
-        return energy
+    def schedule(self, workers):
+        """
+        Split the work items into blocks of about the same number of quadrature points, by assigning the largest
+        items first to the least loaded block. The schedule only depends on the graph, so a run with a fixed seed
+        and number of workers is deterministic.
+
+        Returns: The list of the blocks of work items.
+        """
+        items = self.work_items(workers)
+        cost = [len(nb) * self.K * self.grid_size(nb[0]) for _, nb in items]
+        blocks, load = [list() for _ in range(workers)], np.zeros(workers)
+        for i in sorted(range(len(items)), key=lambda i: -cost[i]):
+            b = int(np.argmin(load))
+            blocks[b].append(items[i])
+            load[b] += cost[i]
+        return blocks
 
     def init_param(self):
-        self.w_tau = np.zeros(self.K)
-        self.eta, self.eta_tau = dict(), dict()
-        for rv in self.g.rvs:
-            if rv.value is not None:
+        cg, K = self.cg, self.K
+        # each frame of a graph with frames has its own mixture weights
+        self.w_tau = np.zeros(K if cg.frame is None else (cg.num_frames, K))
+
+        # the parameters of all rvs are stacked and indexed by the rv ids of the compiled graph, the categories of the
+        # discrete rvs are padded to the largest domain, and the dictionaries eta and eta_tau hold views of the rows
+        num_categories = [len(cg.rvs[i].domain.values) for i in np.flatnonzero(~cg.observed & ~cg.continuous)]
+        self.eta_c = np.ones((cg.num_rvs, K, 2))
+        self.eta_d_tau = np.zeros((cg.num_rvs, K, max(num_categories, default=0)))
+        self.eta_d = np.zeros(self.eta_d_tau.shape)
+        for i, rv in enumerate(cg.rvs):
+            if cg.observed[i]:
                 continue
             elif rv.domain.continuous:
-                temp = np.ones((self.K, 2))
-                temp[:, 0] = np.random.rand(self.K) * 100
-                self.eta[rv] = temp
+                self.eta_c[i, :, 0] = np.random.rand(K) * 100
             else:
-                self.eta_tau[rv] = np.random.rand(self.K, len(rv.domain.values))
+                d = len(rv.domain.values)
+                self.eta_d_tau[i, :, :d] = np.random.rand(K, d)
+                self.eta_d_tau[i, :, d:] = -np.inf
+        self.bind_views()
 
         # update w and categorical distribution
-        self.w = self.softmax(self.w_tau)
-        for rv, table in self.eta_tau.items():
-            self.eta[rv] = self.softmax(table, 1)
+        self.w = self.softmax(self.w_tau, self.w_tau.ndim - 1)
+        self.update_categories()
+
+    def bind_views(self):
+        # the dictionaries eta and eta_tau of the views of the rows of the stacked parameters, with a graph with frames
+        # the views of an rv have a leading axis of the frames
+        cg = self.cg
+        if cg.frame is None:
+            eta_c, eta_d_tau, eta_d, observed = self.eta_c, self.eta_d_tau, self.eta_d, cg.observed
+        else:
+            shape = (cg.num_frames, cg.frame_rvs, self.K)
+            eta_c, eta_d_tau, eta_d = (
+                np.moveaxis(a.reshape(shape + a.shape[2:]), 0, 1) for a in (self.eta_c, self.eta_d_tau, self.eta_d)
+            )
+            observed = np.all(cg.observed.reshape(cg.num_frames, -1), axis=0)
+
+        self.eta, self.eta_tau = dict(), dict()
+        for i, rv in enumerate(cg.rvs[:len(observed)]):
+            if observed[i]:
+                continue
+            elif rv.domain.continuous:
+                self.eta[rv] = eta_c[i]
+            else:
+                d = len(rv.domain.values)
+                self.eta_tau[rv] = eta_d_tau[i, ..., :d]
+                self.eta[rv] = eta_d[i, ..., :d]
+
+    def rv_eta(self, rv, frame=None):
+        # the parameters of the rv (of the frame, if the graph has frames)
+        i = self.cg.rv_id(rv, frame)
+        return self.eta_c[i] if rv.domain.continuous else self.eta_d[i, :, :len(rv.domain.values)]
+
+    def start_workers(self):
+        """
+        Move the parameters that the workers read and the partial sums that they write to shared memory, and fork the
+        worker processes, which read the inferer from the class.
+        """
+        self.shared_memory = list()
+
+        def share(a):
+            shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+            self.shared_memory.append(shm)
+            res = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+            res[...] = a
+            return res
 
-    def run(self, iteration=100, lr=0.1, is_log=True):
+        self.w, self.eta_c, self.eta_d = share(self.w), share(self.eta_c), share(self.eta_d)
+        self.bind_views()
+
+        self.blocks = self.schedule(self.workers)
+        self.parts = (
+            share(np.zeros((self.workers,) + self.w.shape)),
+            share(np.zeros((self.workers,) + self.eta_c.shape)),
+            share(np.zeros((self.workers,) + self.eta_d.shape)),
+            share(np.zeros(self.workers, dtype=np.int64))  # The number of potential evaluations of each block
+        )
+
+        VarInference.shared = self
+        self.pool = multiprocessing.get_context('fork').Pool(self.workers)
+
+    def stop_workers(self):
+        # stop the worker processes, and copy the parameters back from the shared memory before releasing it
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+        VarInference.shared = None
+
+        self.w, self.eta_c, self.eta_d = np.array(self.w), np.array(self.eta_c), np.array(self.eta_d)
+        self.bind_views()
+        del self.parts, self.blocks
+
+        for shm in self.shared_memory:
+            shm.close()
+            shm.unlink()
+        self.shared_memory = list()
+
+    def update_categories(self):
+        # the softmax of the logits of all discrete rvs, in place to keep the views
+        if self.eta_d.size:
+            np.exp(self.eta_d_tau - np.max(self.eta_d_tau, axis=2, keepdims=True), out=self.eta_d)
+            self.eta_d /= np.sum(self.eta_d, axis=2, keepdims=True)
+
+    def parameters(self):
+        # the flat array of the parameters of the hidden rvs and the mixture weights
+        cg = self.cg
+        return np.concatenate([
+            self.w.ravel(),
+            self.eta_c[~cg.observed & cg.continuous].ravel(),
+            self.eta_d[~cg.observed & ~cg.continuous].ravel()
+        ])
+
+    def log(self):
+        # the log likelihood of the map assignment, summed over the frames if the graph has frames
+        cg = self.cg
+        x = np.array(cg.values, dtype=float)
+        x[self.hidden] = self.map_ids(self.hidden)
+        return values_log_likelihood(cg, x)
+
+    def run(self, iteration=100, lr=0.1, is_log=False, log_every=1,
+            tol=None, patience=1, criterion='param', check_every=1, factor_batch=None, lr_decay=0.6):
+        """
+        Args:
+            iteration: The maximum number of iterations.
+            lr: The learning rate of Adam.
+            factor_batch: If it is not None, each iteration is a stochastic step on factor_batch sampled factors and
+                          the same fraction of the rvs, with the learning rate lr * t ** -lr_decay at iteration t.
+            lr_decay: The decay exponent of the learning rate of the stochastic steps, in (0.5, 1] for convergence.
+            is_log: Record the log likelihood of the map assignment in time_log every log_every iterations.
+            log_every: The number of iterations between two records of the log likelihood.
+            tol, patience, criterion, check_every: The convergence criterion, see ConvergenceMonitor, the run stops
+                                                   when it is converged. The values of the criterion are kept in
+                                                   self.monitor.history.
+        """
         if is_log:
             self.time_log = list()
             self.total_time = 0
 
-        # initiate parameters
+        # compile graph and initiate parameters
+        self.compile_graph()
         self.init_param()
 
         adam = AdamOptimizer(lr)
         moments = dict()
-
-        for t in range(1, iteration + 1):
-            start_time = time.process_time()
-
-            # update parameters
-            step, moment = adam(self.gradient_w_tau(), moments.get('tau', (0, 0)), t)
-            moments['tau'] = moment
-            self.w_tau = self.w_tau - step
-            self.w = self.softmax(self.w_tau)
-            for rv in self.g.rvs:
-                if rv.value is not None:
-                    continue
-                elif rv.domain.continuous:
-                    step, moment = adam(self.gradient_mu_var(rv), moments.get(rv, (0, 0)), t)
-                    moments[rv] = moment
-                    temp = self.eta[rv] - step
-                    temp[:, 1] = np.clip(temp[:, 1], a_min=self.var_threshold, a_max=np.inf)
-                    self.eta[rv] = temp
-                else:
-                    step, moment = adam(self.gradient_category_tau(rv), moments.get(rv, (0, 0)), t)
-                    moments[rv] = moment
-                    temp = self.eta_tau[rv] - step
-                    self.eta_tau[rv] = temp
-                    self.eta[rv] = self.softmax(temp, 1)
-
-            # logger
-            if is_log:
-                current_time = time.process_time()
-                self.total_time += current_time - start_time
-                # fe = self.free_energy()
-                map_res = dict()
-                for rv in self.g.rvs:
-                    map_res[rv] = self.map(rv)
-                fe = log_likelihood(self.g, map_res)
-                print(fe, self.total_time)
-                self.time_log.append([self.total_time, fe])
-
-    def belief(self, x, rv):
-        return self.rvs_belief((x,), (rv,))
-
-    def rvs_belief(self, x, rvs):
-        b = np.copy(self.w)
+        self.monitor = ConvergenceMonitor(criterion, tol, patience, check_every)
+
+        if factor_batch is not None and factor_batch >= self.cg.num_factors:
+            factor_batch = None
+
+        # the stochastic steps are cheap, so they are computed in this process
+        if self.workers is not None and self.workers > 1 and factor_batch is None:
+            self.start_workers()
+
+        try:
+            for t in range(1, iteration + 1):
+                start_time = time.process_time()
+
+                # update all parameters at once, from the gradients of a single pass over the graph
+                if factor_batch is not None:
+                    adam.lr = lr * t ** -lr_decay
+                gradients = self.gradients(factor_batch)
+                g_w_tau, g_mu_var, g_category_tau = gradients
+
+                step, moments['tau'] = adam(g_w_tau, moments.get('tau', (0, 0)), t)
+                self.w_tau = self.w_tau - step
+                self.w[:] = self.softmax(self.w_tau, self.w_tau.ndim - 1)
+
+                step, moments['c'] = adam(g_mu_var, moments.get('c', (0, 0)), t)
+                self.eta_c -= step
+                np.clip(self.eta_c[:, :, 1], self.var_threshold, np.inf, out=self.eta_c[:, :, 1])
+
+                step, moments['d'] = adam(g_category_tau, moments.get('d', (0, 0)), t)
+                self.eta_d_tau -= step
+                self.update_categories()
+
+                self.iterations = t
+                converged = self.monitor(t, self, gradients)
+
+                # logger
+                if is_log:
+                    self.total_time += time.process_time() - start_time
+                    if t % log_every == 0 or converged or t == iteration:
+                        fe = self.log()
+                        print(fe, self.total_time)
+                        self.time_log.append([self.total_time, fe])
+
+                if converged:
+                    break
+        finally:
+            if self.pool is not None:
+                self.stop_workers()
+
+    def belief(self, x, rv, frame=None):
+        return self.rvs_belief((x,), (rv,), frame)
+
+    def rvs_belief(self, x, rvs, frame=None):
+        # the joint belief of the rvs, which are in the frame if the graph has frames
+        cg = self.cg
+        b = np.copy(self.w if cg.frame is None else self.w[frame])
 
         for i, rv in enumerate(rvs):
-            if rv.value is not None:
-                if x[i] != rv.value:
+            idx = cg.rv_id(rv, frame)
+            if cg.observed[idx]:
+                if x[i] != cg.values[idx]:
                     return 0
             elif rv.domain.continuous:
-                eta = self.eta[rv]
+                eta = self.eta_c[idx]
                 for k in range(self.K):
                     b[k] *= self.norm_pdf(x[i], eta[k])
             else:
-                eta = self.eta[rv]
+                eta = self.eta_d[idx]
                 d = rv.domain.values.index(x[i])
                 for k in range(self.K):
                     b[k] *= eta[k, d]
 
         return np.sum(b)
 
-    def map(self, rv):
-        if rv.value is None:
-            if rv.domain.continuous:
-                p = dict()
-                for x in self.eta[rv][:, 0]:
-                    p[x] = self.belief(x, rv)
-                x0 = max(p.keys(), key=(lambda k: p[k]))
-
-                res = minimize(
-                    lambda val: -self.belief(val, rv),
-                    x0=np.array([x0]),
-                    options={'disp': False}
-                )['x'][0]
-            else:
-                p = dict()
-                for x in rv.domain.values:
-                    p[x] = self.belief(x, rv)
-                res = max(p.keys(), key=(lambda k: p[k]))
-
-            return res
+    def category_map(self, i):
+        # the most probable category of the hidden discrete rv of id i
+        values = self.cg.rvs[i].domain.values
+        p = self.frame_weights(i) @ self.eta_d[i, :, :len(values)]
+        return values[int(np.argmax(p))]
+
+    def map(self, rv, frame=None):
+        cg = self.cg
+        i = cg.rv_id(rv, frame)
+        if cg.observed[i]:
+            return cg.values[i]
+        elif rv.domain.continuous:
+            return self.map_ids(np.array([i]))[0]
         else:
-            return rv.value
+            return self.category_map(i)
+
+    def map_ids(self, ids):
+        """
+        Args:
+            ids: An integer array of rv ids.
+
+        Returns: The array of the MAP of each rv, where the modes of the beliefs of all continuous rvs are found at
+                 once by gaussian_mixture_map.
+        """
+        cg = self.cg
+        res = np.empty(len(ids))
+        observed = cg.observed[ids]
+        res[observed] = cg.values[ids[observed]]
+
+        continuous = ~observed & cg.continuous[ids]
+        if np.any(continuous):
+            c = ids[continuous]
+            res[continuous] = gaussian_mixture_map(self.frame_weights(c), self.eta_c[c, :, 0], self.eta_c[c, :, 1])
 
-    def rvs_map(self, rvs):
+        for k in np.flatnonzero(~observed & ~cg.continuous[ids]):
+            res[k] = self.category_map(ids[k])
+
+        return res
+
+    def batch_map(self, rvs):
+        """
+        Args:
+            rvs: A list of rvs.
+
+        Returns: The array of the MAP of each rv, see map_ids. If the graph has frames, the (M, len(rvs)) array of the
+                 MAP of the rvs in each frame.
+        """
+        cg = self.cg
+        ids = cg.rv_ids(rvs)
+        if cg.frame is None:
+            return self.map_ids(ids)
+        return self.map_ids(cg.frame_ids(ids).reshape(-1)).reshape(cg.num_frames, len(ids))
+
+    def rvs_map(self, rvs, frame=None):
+        cg = self.cg
         res = dict()
+        ids = {rv: cg.rv_id(rv, frame) for rv in rvs}
+        hidden = [rv for rv in rvs if not cg.observed[ids[rv]]]
 
         # compute initial assignment
         for rv in rvs:
-            if rv.value is not None:
-                res[rv] = rv.value
+            if cg.observed[ids[rv]]:
+                res[rv] = cg.values[ids[rv]]
             else:
                 if rv.domain.continuous:
-                    candidate_values = self.eta[rv][:, 0]
+                    candidate_values = self.eta_c[ids[rv], :, 0]
                 else:
                     candidate_values = rv.domain.values
 
                 b = dict()
                 for v in candidate_values:
-                    b[v] = self.belief(v, rv)
+                    b[v] = self.belief(v, rv, frame)
                 res[rv] = max(b.keys(), key=(lambda x: b[x]))
 
-        b = np.copy(self.w)
-        for rv in rvs:
-            if rv.value is not None:
-                continue
-            elif rv.domain.continuous:
-                eta = self.eta[rv]
+        b = np.copy(self.w if cg.frame is None else self.w[frame])
+        for rv in hidden:
+            eta = self.rv_eta(rv, frame)
+            if rv.domain.continuous:
                 for k in range(self.K):
                     b[k] *= self.norm_pdf(res[rv], eta[k])
             else:
-                eta = self.eta[rv]
                 d = rv.domain.values.index(res[rv])
                 for k in range(self.K):
                     b[k] *= eta[k, d]
 
         # coordinate ascent
         for i in range(10):
-            for rv in rvs:
-                if rv.value is not None:
-                    continue
-                elif rv.domain.continuous:
+            for rv in hidden:
+                eta = self.rv_eta(rv, frame)
+                if rv.domain.continuous:
                     prev_x = res[rv]
-                    eta = self.eta[rv]
                     for k in range(self.K):
                         b[k] /= self.norm_pdf(prev_x, eta[k])
 
-                    def f(x):
-                        b_res = 0
-                        for k in range(self.K):
-                            b_res += b[k] * self.norm_pdf(x, eta[k])
-                        return -b_res
-
-                    new_x = minimize(f, x0=np.array([prev_x]), options={'disp': False})['x']
+                    new_x = gaussian_mixture_map(b[np.newaxis], eta[np.newaxis, :, 0], eta[np.newaxis, :, 1])[0]
 
                     for k in range(self.K):
                         b[k] *= self.norm_pdf(new_x, eta[k])
@@ -363,7 +852,6 @@ class VarInference:
                 else:
                     prev_x = res[rv]
                     prev_d = rv.domain.values.index(prev_x)
-                    eta = self.eta[rv]
                     for k in range(self.K):
                         b[k] /= eta[k, prev_d]
 
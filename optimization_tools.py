@@ -1,4 +1,5 @@
 from numpy import maximum, abs, sqrt
+import numpy as np
 
 
 class AdamOptimizer:
@@ -113,3 +114,185 @@ class NadamOptimizer:
 
     def step(self):
         self.t += 1
+
+
+class ParameterChange:
+    # the relative change of the parameters since the last check, from infer.parameters()
+
+    def __init__(self):
+        self.prev = None
+
+    def reset(self):
+        self.prev = None
+
+    def __call__(self, infer, gradients):
+        x = infer.parameters()
+        prev, self.prev = self.prev, x
+        if prev is None or prev.shape != x.shape:
+            return np.inf
+        return np.linalg.norm(x - prev) / max(np.linalg.norm(prev), 1e-12)
+
+
+class FreeEnergyChange:
+    # the relative change of the free energy since the last check, from infer.free_energy()
+
+    def __init__(self):
+        self.prev = None
+
+    def reset(self):
+        self.prev = None
+
+    def __call__(self, infer, gradients):
+        fe = infer.free_energy()
+        prev, self.prev = self.prev, fe
+        if prev is None:
+            return np.inf
+        return abs(fe - prev) / max(abs(prev), 1e-12)
+
+
+class GradientNorm:
+    # the largest absolute gradient of the last update, which is not diluted by the padded or fixed parameters
+
+    def reset(self):
+        pass
+
+    def __call__(self, infer, gradients):
+        return max((np.max(np.abs(g), initial=0) for g in gradients), default=0)
+
+
+class ConvergenceMonitor:
+    """
+    Usage:
+        monitor = ConvergenceMonitor('param', tol=1e-4, patience=3, check_every=5)
+
+        for t in range(1, max_iter):
+            gradients = compute_gradients(theta)
+            theta -= step(gradients)
+            if monitor(t, infer, gradients):
+                break
+    """
+    criteria = {
+        'param': ParameterChange,
+        'free_energy': FreeEnergyChange,
+        'gradient': GradientNorm
+    }
+
+    def __init__(self, criterion='param', tol=None, patience=1, check_every=1):
+        """
+        Args:
+            criterion: 'param' for the relative change of the parameters, 'free_energy' for the relative change of the
+                       free energy, 'gradient' for the largest absolute gradient, or a callable that takes the inferer
+                       and the list of gradients and returns a number.
+            tol: It is converged when the criterion is at most tol in patience consecutive checks, if tol is None the
+                 criterion is only recorded.
+            patience: The number of consecutive checks below tol.
+            check_every: The number of iterations between two checks.
+        """
+        self.criterion = self.criteria[criterion]() if isinstance(criterion, str) else criterion
+        self.tol = tol
+        self.patience = patience
+        self.check_every = check_every
+        self.history = list()  # [iteration, criterion value] of each check
+        self.count = 0
+
+    def reset(self):
+        # restart the counting, e.g. when the model is changed between iterations
+        self.count = 0
+        if hasattr(self.criterion, 'reset'):
+            self.criterion.reset()
+
+    def __call__(self, t, infer, gradients=()):
+        """
+        Returns: True if it is converged at iteration t.
+        """
+        if t % self.check_every != 0:
+            return False
+
+        value = self.criterion(infer, gradients)
+        self.history.append([t, value])
+        self.count = self.count + 1 if self.tol is not None and value <= self.tol else 0
+
+        return self.count >= self.patience
+
+
+def gaussian_mixture_map(w, mu, var, iteration=100, tol=1e-8):
+    """
+    Find the modes of a batch of 1 dimensional Gaussian mixtures, starting from every component mean and keeping the
+    point with the largest density. Each step is a Newton step on the density where it is concave and increases the
+    density, otherwise it is the fixed point step x = sum(r * mu / var) / sum(r / var), where r are the weighted
+    densities of the components at x, which always increases the density. The mixtures whose points have all
+    converged are not updated anymore.
+
+    Args:
+        w: The (K,) or (n, K) array of the mixture weights.
+        mu: The (n, K) array of the means.
+        var: The (n, K) array of the variances.
+        iteration: The maximum number of iterations.
+        tol: A point is converged when it moves less than tol.
+
+    Returns: The (n,) array of the modes.
+    """
+    w = np.broadcast_to(w, mu.shape)
+
+    def density(x, rows):
+        # the (m, K, K) weighted densities of the components (last axis) at the point of each seed (middle axis)
+        u = x[..., np.newaxis] - mu[rows, np.newaxis]
+        v = var[rows, np.newaxis]
+        return w[rows, np.newaxis] * np.exp(-u * u * 0.5 / v) / np.sqrt(2 * np.pi * v), u, v
+
+    x = np.array(mu, dtype=float)
+    active = np.arange(len(x))
+    for _ in range(iteration):
+        if len(active) == 0:
+            break
+
+        x_a = x[active]
+        a, u, v = density(x_a, active)
+        s = np.sum(a / v, -1)
+        g = -np.sum(a * u / v, -1)
+        h = np.sum(a * (u * u / v - 1) / v, -1)
+
+        shift = np.where(s > 0, x_a + g / np.where(s > 0, s, 1), x_a)
+        newton = np.where(h < 0, x_a - g / np.where(h < 0, h, -1), shift)
+        improved = np.sum(density(newton, active)[0], -1) >= np.sum(a, -1)
+        x_new = np.where(improved & (h < 0), newton, shift)
+
+        moved = np.max(np.abs(x_new - x_a), -1) >= tol
+        x[active] = x_new
+        active = active[moved]
+
+    best = np.argmax(np.sum(density(x, slice(None))[0], -1), -1)
+    return np.take_along_axis(x, best[:, np.newaxis], -1)[:, 0]
+
+
+def clusters_map(rvs, w, eta, discrete_map):
+    """
+    Find the MAP of a batch of ground rvs of a lifted inferer, where the modes of the beliefs of the clusters of all
+    hidden continuous rvs are found at once by gaussian_mixture_map.
+
+    Args:
+        rvs: A list of ground rvs.
+        w: The (K,) array of the mixture weights.
+        eta: A dictionary of super rv to the (K, 2) array of the means and variances of its belief.
+        discrete_map: A function that gives the MAP of a hidden discrete rv.
+
+    Returns: The list of the MAP of each rv, so the values of discrete rvs keep their type.
+    """
+    res = [None] * len(rvs)
+    clusters = dict()  # key=cluster, value=the indices of its hidden continuous rvs
+    for i, rv in enumerate(rvs):
+        if rv.value is not None:
+            res[i] = rv.value
+        elif rv.domain.continuous:
+            clusters.setdefault(rv.cluster, list()).append(i)
+        else:
+            res[i] = discrete_map(rv)
+
+    if clusters:
+        params = np.array([eta[cluster] for cluster in clusters])
+        modes = gaussian_mixture_map(w, params[:, :, 0], params[:, :, 1])
+        for mode, idx in zip(modes.tolist(), clusters.values()):
+            for i in idx:
+                res[i] = mode
+
+    return res
@@ -0,0 +1,112 @@
+import numpy as np
+from numpy.polynomial.hermite import hermgauss
+from itertools import product
+from math import comb
+
+
+# The multivariate integration rules for the expectation of a function of d independent standard normal variables.
+# A rule is a pair of the (R, d) array of the points and the (R,) array of the weights, with E[f(x)] ~ sum(w * f(x)).
+
+
+def gauss_hermite(n):
+    # the 1 dimensional Gauss-Hermite rule of n points for the standard normal distribution
+    x, w = hermgauss(n)
+    return x * np.sqrt(2), w / np.sqrt(np.pi)
+
+
+def merge_points(x, w, decimals=12):
+    # merge the repeated points of a rule by adding up their weights, and drop the points of weight 0
+    x, inv = np.unique(np.round(x, decimals), axis=0, return_inverse=True)
+    w = np.bincount(inv.reshape(-1), weights=w, minlength=len(x))
+    keep = w != 0
+    return x[keep], w[keep]
+
+
+def tensor_product(d, n):
+    """
+    The product of d Gauss-Hermite rules of n points, i.e. n ** d points, exact for the polynomials of degree at most
+    2n - 1 in each variable.
+    """
+    x, w = gauss_hermite(n)
+    points = np.array(list(product(x, repeat=d))).reshape(-1, d)
+    weights = np.prod(np.array(list(product(w, repeat=d))).reshape(-1, d), axis=1)
+    return points, weights
+
+
+def smolyak(d, level):
+    """
+    The Smolyak sparse grid of the Gauss-Hermite rules of 1 to level points, by the combination technique. It is exact
+    for the polynomials of total degree at most 2 level - 1, with a number of points that grows polynomially in d
+    instead of exponentially. Some weights may be negative.
+    """
+    rules = [None] + [gauss_hermite(n) for n in range(1, level + 1)]
+    q = level + d - 1
+
+    points, weights = list(), list()
+    for ls in product(range(1, level + 1), repeat=d):
+        s = sum(ls)
+        if s < max(d, q - d + 1) or s > q:
+            continue
+        coef = (-1) ** (q - s) * comb(d - 1, q - s)
+        points.append(np.array(list(product(*(rules[l][0] for l in ls)))).reshape(-1, d))
+        weights.append(coef * np.prod(np.array(list(product(*(rules[l][1] for l in ls)))).reshape(-1, d), axis=1))
+
+    return merge_points(np.concatenate(points), np.concatenate(weights))
+
+
+def unscented(d, kappa=None):
+    """
+    The unscented transform of 2d + 1 sigma points, exact for the polynomials of degree at most 3. The default kappa is
+    3 - d, which also matches the 4th moment of each variable, but makes the weight of the center negative for d > 3.
+    """
+    kappa = 3 - d if kappa is None else kappa
+    scale = np.sqrt(d + kappa)
+    points = np.concatenate([np.zeros((1, d)), np.eye(d) * scale, -np.eye(d) * scale])
+    weights = np.r_[kappa / (d + kappa), np.full(2 * d, 0.5 / (d + kappa))]
+    return points, weights
+
+
+def cubature(d):
+    """
+    The spherical radial cubature rule of 2d points with equal weights, exact for the polynomials of degree at most 3.
+    """
+    scale = np.sqrt(d)
+    return np.concatenate([np.eye(d) * scale, -np.eye(d) * scale]), np.full(2 * d, 0.5 / d)
+
+
+def qmc(d, n=64, seed=0):
+    """
+    The quasi-Monte Carlo rule of n scrambled Sobol points with equal weights, mapped by the inverse normal CDF. The
+    points are fixed by the seed, so the rule is deterministic.
+    """
+    from scipy.stats import norm, qmc as scipy_qmc
+
+    u = scipy_qmc.Sobol(d, scramble=True, seed=seed).random(n)
+    return norm.ppf(np.clip(u, 1e-12, 1 - 1e-12)), np.full(n, 1 / n)
+
+
+rules = {
+    'product': tensor_product,
+    'smolyak': smolyak,
+    'unscented': unscented,
+    'cubature': cubature,
+    'qmc': qmc
+}
+
+
+def make_rule(spec, d, n):
+    """
+    Args:
+        spec: The name of a rule in rules, or a tuple of the name and its arguments after d, e.g. ('qmc', 128). The
+              product and smolyak rules take n by default.
+        d: The number of variables.
+        n: The number of points of the 1 dimensional rule.
+
+    Returns: The (R, d) array of the points and the (R,) array of the weights.
+    """
+    name, args = (spec, ()) if isinstance(spec, str) else (spec[0], tuple(spec[1:]))
+    if name not in rules:
+        raise Exception('unknown quadrature rule ' + str(name))
+    if name in ('product', 'smolyak') and len(args) == 0:
+        args = (n,)
+    return rules[name](d, *args)
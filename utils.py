@@ -10,13 +10,18 @@ from Graph import Graph
 
 
 def log_likelihood(g, assignment):
+    g = g.compile()
+    return values_log_likelihood(g, g.value_array(assignment.get(rv) for rv in g.rvs))
+
+
+def values_log_likelihood(cg, x):
+    # log_likelihood of the array x of the values of the rvs of the compiled graph cg, indexed by the rv ids
     res = 0
-    for f in g.factors:
-        parameters = [assignment[rv] for rv in f.nb]
-        value = f.potential(*parameters)
-        if value == 0:
+    for batch in cg.factor_batches:
+        value = batch.potential.batch_call(x[batch.nb])
+        if np.any(value == 0):
             return -np.Inf
-        res += log(value)
+        res += np.sum(np.log(value))
 
     return -res
 